@@ -0,0 +1,61 @@
+"""
+Helper functions for the meter attributes payload
+"""
+
+
+class AttributePolicy:
+    """
+    Which attributes of a meter to publish and how often.
+    """
+    def __init__(self, include=None, exclude=None, interval=0, on_change=False):
+        """
+        include: Only publish these fields (allow-list)
+        exclude: Never publish these fields (deny-list)
+        interval: Publish the attributes at most every interval seconds
+        on_change: Publish the attributes only if they have changed
+        """
+        self.include = set(include) if include else None
+        self.exclude = set(exclude) if exclude else set()
+        self.interval = int(interval)
+        self.on_change = bool(on_change)
+
+    def select(self, items):
+        """
+        Yield only the selected (key, value) pairs.
+        """
+        include, exclude = self.include, self.exclude
+        for key, value in items:
+            if (include is None or key in include) and key not in exclude:
+                yield key, value
+
+    def should_publish(self, payload, last_sent, now):
+        """
+        Check if the payload has to be published.
+        last_sent is the (payload, time) previously published, or None.
+        """
+        if last_sent is None:
+            return True
+        last_payload, last_time = last_sent
+        if self.on_change and payload == last_payload:
+            return False
+        if self.interval > 0 and now - last_time < self.interval:
+            return False
+        return True
+
+
+
+DEFAULT_POLICY = AttributePolicy()
+
+def build_policies(meters):
+    """
+    Build the attribute policy of each meter from the meters configuration.
+    """
+    return {
+        meter_id: AttributePolicy(
+            include=meter.get('attributes_include'),
+            exclude=meter.get('attributes_exclude'),
+            interval=meter.get('attributes_interval', 0),
+            on_change=meter.get('attributes_on_change', False),
+        )
+        for meter_id, meter in meters.items()
+    }
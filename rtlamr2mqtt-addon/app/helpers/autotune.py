@@ -0,0 +1,172 @@
+"""
+Helper functions to fit rtlamr in a CPU budget.
+
+rtlamr asks rtl_tcp for 32768 * symbol length samples per second and most of
+its CPU time is spent filtering them, so the symbol length and the decimation
+(rtlamr keeps every nth sample) set its CPU cost. Each candidate setting is run
+for a while on the real receiver, its CPU time and decoded messages are
+measured, and the one decoding the most messages within the budget is kept.
+"""
+
+import os
+import json
+import subprocess
+from tempfile import TemporaryFile
+from time import monotonic, sleep, time
+
+
+DATA_RATE = 32768
+# (symbol length, decimation), from the rtlamr default to the cheapest
+CANDIDATES = [ (72, 1), (64, 1), (48, 1), (40, 1), (32, 1), (72, 2), (64, 4), (8, 1) ]
+# Kept between restarts of the add-on, calibration takes a few minutes
+CACHE_PATH = '/data/autotune.json'
+# Calibrate again after this many seconds
+MAX_AGE = 30 * 86400
+
+
+def sample_rate(symbol_length):
+    """
+    Sample rate used by rtlamr for a symbol length.
+    """
+    return DATA_RATE * int(symbol_length)
+
+def valid_sample_rate(rate):
+    """
+    Check if a RTL-SDR can sample at this rate (225001-300000 or 900001-3200000).
+    """
+    return 225001 <= rate <= 300000 or 900001 <= rate <= 3200000
+
+def candidates():
+    """
+    Candidate (symbol length, decimation) settings the receiver supports.
+    """
+    return [
+        (symbol_length, decimation) for symbol_length, decimation in CANDIDATES
+        if valid_sample_rate(sample_rate(symbol_length)) and symbol_length % decimation == 0
+    ]
+
+def cache_key(meters, budget, custom_parameters=''):
+    """
+    The calibration depends on the protocols, the budget and the custom rtlamr parameters.
+    """
+    protocols = sorted({ str(meter.get('protocol', 'scm')).lower() for meter in meters.values() })
+    return f'{",".join(protocols)}|{int(budget)}|{custom_parameters}'
+
+def process_cpu_time(pid):
+    """
+    User and system CPU seconds used by a process and all its threads, None if it is gone.
+    """
+    try:
+        with open(f'/proc/{pid}/stat', 'r', encoding='utf-8') as f:
+            # The process name can contain spaces, utime and stime are the 12th and 13th fields after it
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+
+def process_tree_cpu_time(pid):
+    """
+    CPU seconds used by a process and its children, e.g. rtlamr started by unbuffer.
+    None if the process is gone.
+    """
+    if process_cpu_time(pid) is None:
+        return None
+    total = 0.0
+    pending = [ pid ]
+    while pending:
+        current = pending.pop()
+        cpu = process_cpu_time(current)
+        if cpu is None:
+            continue
+        total += cpu
+        try:
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children', 'r', encoding='utf-8') as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            pass
+    return total
+
+def measure(command, seconds):
+    """
+    Run a rtlamr command for some seconds.
+    Returns { 'cpu': percent of one core, 'messages': decoded, 'rate': messages per minute },
+    None if rtlamr stopped before the end.
+    """
+    with TemporaryFile() as output:
+        try:
+            process = subprocess.Popen(command, stdout=output, stderr=subprocess.DEVNULL, start_new_session=True)
+        except OSError:
+            return None
+        start = monotonic()
+        cpu = None
+        while monotonic() - start < seconds and process.poll() is None:
+            sleep(min(1, seconds))
+        if process.poll() is None:
+            cpu = process_cpu_time(process.pid)
+        elapsed = monotonic() - start
+        process.terminate()
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        if cpu is None:
+            return None
+        output.seek(0)
+        messages = sum(1 for line in output if line.lstrip().startswith(b'{'))
+    return {
+        'cpu': round(cpu / elapsed * 100, 1),
+        'messages': messages,
+        'rate': round(messages / elapsed * 60, 1),
+    }
+
+def choose(results, budget):
+    """
+    Pick the setting to use from { (symbol length, decimation): measure() result }.
+    Within the budget, the one decoding the most messages, the longest symbol
+    length on a tie. If none fits, the one using the least CPU.
+    Returns { 'symbol_length', 'decimation', 'sample_rate' }, None if nothing could be measured.
+    """
+    measured = { setting: result for setting, result in results.items() if result is not None }
+    if not measured:
+        return None
+    within = [ setting for setting, result in measured.items() if result['cpu'] <= budget ]
+    if within:
+        best = max(within, key=lambda setting: (measured[setting]['messages'], setting[0] // setting[1], setting[0]))
+    else:
+        best = min(measured, key=lambda setting: measured[setting]['cpu'])
+    return { 'symbol_length': best[0], 'decimation': best[1], 'sample_rate': sample_rate(best[0]) }
+
+def load_cached(key, path=CACHE_PATH, max_age=MAX_AGE):
+    """
+    Return the setting chosen by a previous calibration with the same key, None if there is none or it is too old.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get('key') != key or time() - cached.get('time', 0) > max_age:
+        return None
+    return cached.get('setting')
+
+def save_cached(key, setting, results, path=CACHE_PATH):
+    """
+    Keep the chosen setting and the measurements. Returns False if it can not be written.
+    """
+    cached = {
+        'key': key,
+        'time': int(time()),
+        'setting': setting,
+        'results': [
+            dict(symbol_length=symbol_length, decimation=decimation, **(result or { 'failed': True }))
+            for (symbol_length, decimation), result in results.items()
+        ],
+    }
+    try:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(cached, f, indent=2)
+    except OSError:
+        return False
+    return True
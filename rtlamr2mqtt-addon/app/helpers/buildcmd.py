@@ -4,6 +4,7 @@ Helper functions for building command for rtl_tcp and rtlamr
 
 from os import environ
 import helpers.usb_utils as usbutils
+import helpers.hopping as hop
 
 def get_comma_separated_str(key, list_of_dict):
     """
@@ -17,17 +18,14 @@ def get_comma_separated_str(key, list_of_dict):
 
 def partial_match_remove(k, l):
     """
-    Remove items from a list of dictionaries that partially match a key.
+    Remove items from a list of strings that partially match a key.
     Args:
         k (str): The key to check for partial matches.
-        l (list): The list of dictionaries to check.
+        l (list): The list of strings to check.
     Returns:
-        l: The modified list of dictionaries.
+        list: A new list without the matching items.
     """
-    for n in l:
-        if k in n:
-            l.remove(n)
-    return l
+    return [ n for n in l if k not in n ]
 
 def build_rtlamr_args(config):
     """
@@ -45,6 +43,22 @@ def build_rtlamr_args(config):
     if 'rtlamr' in config['custom_parameters']:
         custom_parameters = config['custom_parameters']['rtlamr'].split()
         custom_parameters = partial_match_remove('-server', custom_parameters)
+    # Symbol length and decimation chosen for the CPU budget
+    autotune = config['general'].get('autotune')
+    if autotune:
+        custom_parameters = partial_match_remove('-symbollength', custom_parameters)
+        custom_parameters = partial_match_remove('-decimation', custom_parameters)
+        custom_parameters += [ f'-symbollength={autotune["symbol_length"]}', f'-decimation={autotune["decimation"]}' ]
+    # The gain calibration and the frequency hopping count every message, repeated messages are dropped by the add-on
+    if config['general'].get('gain_calibration') or hop.needs_hopping(meters):
+        custom_parameters = partial_match_remove('-unique', custom_parameters)
+        default_args = [ '-format=json', '-unique=false' ]
+
+    # Meters filtered by rtlamr, chosen at runtime by the filtering controller
+    filter_ids = config['general'].get('filter_ids')
+    if filter_ids:
+        custom_parameters = partial_match_remove('-filterid', custom_parameters)
+        custom_parameters += [ f'-filterid={",".join(filter_ids)}' ]
 
     # Build a comma-separated string of meter IDs
     ids = ','.join(list(meters.keys()))
@@ -72,10 +86,20 @@ def build_rtltcp_args(config):
     custom_parameters = ''
     if 'rtltcp' in config['custom_parameters']:
         custom_parameters = config['custom_parameters']['rtltcp']
+    # Sample at the rate rtlamr will use, chosen for the CPU budget
+    rate_arg = []
+    autotune = config['general'].get('autotune')
+    if autotune:
+        params = custom_parameters.split()
+        if '-s' in params:
+            del params[params.index('-s'):params.index('-s') + 2]
+        custom_parameters = ' '.join(params)
+        rate_arg = [ f'-s {autotune["sample_rate"]}' ]
     device_id = config['general']['device_id']
+    sdl_devices = []
     if 'RTLAMR2MQTT_USE_MOCK' not in dict(environ):
         sdl_devices = usbutils.find_rtl_sdr_devices()
     dev_arg = '-d 0'
     if device_id != '0' and device_id in sdl_devices:
         dev_arg = f'-d {sdl_devices.index(device_id)}'
-    return list(set([ custom_parameters, dev_arg]))
+    return list(set(arg for arg in [ custom_parameters, dev_arg ] + rate_arg if arg))
@@ -0,0 +1,319 @@
+"""
+Helper class to run several rtlamr2mqtt instances that hear the same meters.
+
+Every node shares its readings on a coordination topic. For each meter, the
+node with the best reception rate among the nodes that heard it recently is
+the owner: it is the only one that publishes the readings of that meter,
+including the ones heard only by the other nodes. Readings are de-duplicated
+by (meter_id, consumption). If the owner does not confirm a reading in time,
+it is considered gone and the next node takes over.
+"""
+
+import threading
+from collections import deque
+from json import dumps, loads
+from time import monotonic
+
+
+class Cluster:
+    """
+    Elect one publisher per meter among the nodes of the cluster.
+    """
+    def __init__(self, node_id, topic, logger, owner_timeout=300, rate_window=3600,
+                 heartbeat_interval=15, confirm_timeout=5, dedup_window=10, log_level=4):
+        """
+        node_id: Unique name of this node
+        topic: Coordination topic prefix, the same on all nodes
+        owner_timeout: A node that has not heard a meter for this long can not own it
+        rate_window: Window, in seconds, used to compute the reception rate
+        heartbeat_interval: Seconds between heartbeats, a node is gone after 3 missed heartbeats
+        confirm_timeout: Seconds to wait for the owner to publish a reading before taking over
+        dedup_window: Readings with the same consumption within this window are the same reading
+        """
+        self.node_id = node_id
+        self.topic = topic
+        self.logger = logger
+        self.log_level = log_level
+        self.owner_timeout = owner_timeout
+        self.rate_window = rate_window
+        self.heartbeat_interval = heartbeat_interval
+        self.confirm_timeout = confirm_timeout
+        self.dedup_window = dedup_window
+        self.mqtt_client = None
+        self.on_reading = None
+        self.lock = threading.Lock()
+        self.started = monotonic()
+        self.last_heartbeat = 0
+        # Readings heard by this node, per meter, to compute the reception rate
+        self.heard = {}
+        # Per meter, per node: { 'last': monotonic time, 'rate': readings per hour }
+        self.receptions = {}
+        # When each meter was first heard by a node of the cluster
+        self.first_heard = {}
+        # Last heartbeat received from each node
+        self.nodes = {}
+        # Nodes that failed to publish a reading they owned
+        self.suspects = {}
+        # (meter_id, consumption): time the reading was published by the cluster
+        self.published = {}
+        # (meter_id, consumption): (reading, deadline, expected owner)
+        self.pending = {}
+        self.metrics = { 'local': 0, 'remote': 0, 'published': 0, 'duplicates': 0, 'takeovers': 0 }
+
+    def attach(self, mqtt_client, on_reading):
+        """
+        Start listening to the coordination topic. Its messages are handled by
+        dispatch(), in the main loop like the other MQTT messages.
+        on_reading(reading) is called for the readings this node has to publish
+        that were heard by other nodes.
+        """
+        self.mqtt_client = mqtt_client
+        self.on_reading = on_reading
+        mqtt_client.add_handler(f'{self.topic}/readings/+', self._on_remote_reading, qos=1)
+        mqtt_client.add_handler(f'{self.topic}/published/+', self._on_published, qos=1)
+        mqtt_client.add_handler(f'{self.topic}/nodes/+', self._on_heartbeat, qos=0)
+
+    def _rate(self, meter_id, now):
+        """
+        Reception rate, in readings per hour, of a meter by this node.
+        """
+        heard = self.heard.get(meter_id)
+        if not heard:
+            return 0.0
+        while heard and now - heard[0] > self.rate_window:
+            heard.popleft()
+        return len(heard) * 3600 / self.rate_window
+
+    def _update_reception(self, meter_id, node, rate, now):
+        """
+        Record that a node has heard a meter.
+        """
+        self.first_heard.setdefault(meter_id, now)
+        self.receptions.setdefault(meter_id, {})[node] = { 'last': now, 'rate': rate }
+
+    def _node_alive(self, node, now):
+        """
+        Check if a node is alive and has not failed to publish a reading.
+        """
+        if node == self.node_id:
+            return True
+        if node in self.suspects and self.nodes.get(node, 0) <= self.suspects[node]:
+            return False
+        return now - self.nodes.get(node, now) <= 3 * self.heartbeat_interval
+
+    def owner(self, meter_id, now):
+        """
+        Elect the owner of a meter: the node with the best reception rate among
+        the live nodes that heard the meter recently. Ties go to the lowest node id.
+        """
+        candidates = [
+            (-reception['rate'], node)
+            for node, reception in self.receptions.get(meter_id, {}).items()
+            if now - reception['last'] <= self.owner_timeout and self._node_alive(node, now)
+        ]
+        return min(candidates)[1] if candidates else self.node_id
+
+    def _decide(self, reading, now):
+        """
+        Decide if this node publishes a reading. Otherwise it waits for the owner to do it.
+        """
+        key = (reading['meter_id'], reading['consumption'])
+        if key in self.published:
+            self.metrics['duplicates'] += 1
+            return False
+        owner = self.owner(reading['meter_id'], now)
+        # Right after starting, we do not know the other nodes yet
+        warming_up = now - self.started < 1.5 * self.heartbeat_interval
+        # A meter just heard: the other nodes that heard it too may not have told us yet
+        settle_at = self.first_heard.get(reading['meter_id'], now) + self.confirm_timeout
+        settled = now >= settle_at or not any(self._node_alive(node, now) for node in self.nodes)
+        if owner == self.node_id and not warming_up and settled:
+            self._mark_published(key, now)
+            return True
+        # Heard again, maybe by a better node: wait for the owner elected now
+        if key not in self.pending or self.pending[key][2] != owner:
+            # The owner publishes once the meter is settled, the other nodes give it confirm_timeout more
+            ready_at = now if settled else settle_at
+            if owner != self.node_id or warming_up:
+                ready_at += self.confirm_timeout
+            self.pending[key] = (reading, ready_at, owner)
+        return False
+
+    def _mark_published(self, key, now):
+        """
+        Remember a reading is published and tell the other nodes.
+        """
+        self.published[key] = now
+        self.pending.pop(key, None)
+        self.metrics['published'] += 1
+        self.mqtt_client.publish(
+            topic=f'{self.topic}/published/{key[0]}',
+            payload=dumps({ 'node': self.node_id, 'consumption': key[1] }),
+            qos=1,
+            retain=False
+        )
+
+    def handle_local(self, reading):
+        """
+        Share a reading heard by this node.
+        Returns True if this node has to publish it.
+        """
+        now = monotonic()
+        meter_id = reading['meter_id']
+        with self.lock:
+            self.metrics['local'] += 1
+            self.heard.setdefault(meter_id, deque()).append(now)
+            rate = self._rate(meter_id, now)
+            self._update_reception(meter_id, self.node_id, rate, now)
+            publish = self._decide(reading, now)
+        self.mqtt_client.publish(
+            topic=f'{self.topic}/readings/{meter_id}',
+            payload=dumps({ 'node': self.node_id, 'rate': rate, 'reading': dict(reading) }),
+            qos=1,
+            retain=False
+        )
+        return publish
+
+    def _on_remote_reading(self, topic, payload):
+        """
+        A node has shared a reading.
+        """
+        try:
+            data = loads(payload)
+            node, reading = data['node'], data['reading']
+        except (ValueError, KeyError, TypeError):
+            return
+        if node == self.node_id:
+            return
+        now = monotonic()
+        with self.lock:
+            self.metrics['remote'] += 1
+            self.nodes.setdefault(node, now)
+            self._update_reception(reading['meter_id'], node, float(data.get('rate', 0)), now)
+            publish = self._decide(reading, now)
+        if publish and self.on_reading is not None:
+            self.on_reading(reading)
+
+    def _on_published(self, topic, payload):
+        """
+        A node has published a reading.
+        """
+        try:
+            data = loads(payload)
+            key = (topic.rsplit('/', 1)[-1], data['consumption'])
+        except (ValueError, KeyError, TypeError):
+            return
+        if data.get('node') == self.node_id:
+            return
+        with self.lock:
+            self.published[key] = monotonic()
+            self.pending.pop(key, None)
+            self.suspects.pop(data.get('node'), None)
+
+    def _on_heartbeat(self, topic, payload):
+        """
+        A node is alive and shares its reception rates.
+        """
+        try:
+            data = loads(payload)
+            node = data['node']
+        except (ValueError, KeyError, TypeError):
+            return
+        if node == self.node_id:
+            return
+        now = monotonic()
+        with self.lock:
+            self.nodes[node] = now
+            for meter_id, reception in data.get('meters', {}).items():
+                self.first_heard.setdefault(meter_id, now)
+                self.receptions.setdefault(meter_id, {})[node] = {
+                    'last': now - float(reception.get('age', 0)),
+                    'rate': float(reception.get('rate', 0)),
+                }
+
+    def _prune(self, now):
+        """
+        Forget the meters and nodes not heard within the election window,
+        they can not own a meter anymore.
+        """
+        for meter_id, nodes in list(self.receptions.items()):
+            for node, reception in list(nodes.items()):
+                if now - reception['last'] > self.owner_timeout:
+                    del nodes[node]
+            if not nodes:
+                del self.receptions[meter_id]
+                self.first_heard.pop(meter_id, None)
+        for meter_id, heard in list(self.heard.items()):
+            if not heard or now - heard[-1] > max(self.owner_timeout, self.rate_window):
+                del self.heard[meter_id]
+        for node, last in list(self.nodes.items()):
+            if now - last > max(self.owner_timeout, 3 * self.heartbeat_interval):
+                del self.nodes[node]
+                self.suspects.pop(node, None)
+
+    def heartbeat(self):
+        """
+        Publish the heartbeat of this node, if it is due.
+        """
+        now = monotonic()
+        if now - self.last_heartbeat < self.heartbeat_interval:
+            return
+        self.last_heartbeat = now
+        with self.lock:
+            self._prune(now)
+            meters = {
+                meter_id: {
+                    'rate': self._rate(meter_id, now),
+                    'age': round(now - nodes[self.node_id]['last'], 1),
+                }
+                for meter_id, nodes in self.receptions.items() if self.node_id in nodes
+            }
+        self.mqtt_client.publish(
+            topic=f'{self.topic}/nodes/{self.node_id}',
+            payload=dumps({ 'node': self.node_id, 'meters': meters }),
+            qos=0,
+            retain=False
+        )
+
+    def expire(self):
+        """
+        Take over the readings the owner failed to publish in time.
+        Returns the readings this node has to publish.
+        """
+        now = monotonic()
+        to_publish = []
+        with self.lock:
+            for key, (reading, deadline, owner) in list(self.pending.items()):
+                if now < deadline:
+                    continue
+                if owner != self.node_id and owner == self.owner(key[0], now):
+                    # The owner did not publish it, do not trust it anymore
+                    if self.log_level >= 2 and owner not in self.suspects:
+                        self.logger.warning('Cluster node %s did not publish meter %s, taking over.', owner, key[0])
+                    self.suspects[owner] = self.nodes.get(owner, 0)
+                    self.metrics['takeovers'] += 1
+                new_owner = self.owner(key[0], now)
+                if new_owner == self.node_id:
+                    self._mark_published(key, now)
+                    to_publish.append(reading)
+                else:
+                    self.pending[key] = (reading, now + self.confirm_timeout, new_owner)
+            # Forget old readings
+            for key, published_at in list(self.published.items()):
+                if now - published_at > self.dedup_window:
+                    del self.published[key]
+        return to_publish
+
+    def stats(self):
+        """
+        Return the cluster metrics and the current owner of each meter.
+        """
+        now = monotonic()
+        with self.lock:
+            return dict(
+                self.metrics,
+                node=self.node_id,
+                nodes=sorted(node for node in self.nodes if self._node_alive(node, now)),
+                owners={ meter_id: self.owner(meter_id, now) for meter_id in self.receptions },
+                pending=len(self.pending),
+            )
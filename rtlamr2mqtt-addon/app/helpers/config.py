@@ -3,12 +3,19 @@ Helper functions for loading configuration files
 """
 
 import os
+import socket
 import requests
 from json import load
-from yaml import safe_load
+from yaml import safe_load, YAMLError
+import helpers.buildcmd as cmd
+import helpers.scm_decoder as scm
+import helpers.hopping as hop
 
 
-def get_mqtt_info_from_supervisor(mqtt_config):
+# Seconds to wait for the Supervisor API
+SUPERVISOR_TIMEOUT = 10
+
+def get_mqtt_info_from_supervisor(mqtt_config, timeout=SUPERVISOR_TIMEOUT):
     """
     Get MQTT broker information from the Supervisor API.
     """
@@ -19,7 +26,7 @@ def get_mqtt_info_from_supervisor(mqtt_config):
             "Content-Type": "application/json"
         }
         try:
-            resp = requests.get(api_url, headers=headers)
+            resp = requests.get(api_url, headers=headers, timeout=timeout)
             resp.raise_for_status()
             data = resp.json()['data']
             mqtt_config['host'] = data.get('host')
@@ -27,15 +34,73 @@ def get_mqtt_info_from_supervisor(mqtt_config):
             mqtt_config['user'] = data.get('username', None)
             mqtt_config['password'] = data.get('password', None)
             mqtt_config['tls_enabled'] = data.get('ssl', False)
-        except Exception:
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            # A signal while waiting is not a lookup failure
             return {}
 
     return mqtt_config
 
 
-def load_config(config_path=None):
+def normalize_broker(broker, defaults=None):
+    """
+    Set the default values of a MQTT broker configuration.
+    Topics and QoS not set are taken from defaults (the main broker).
+    """
+    defaults = defaults or {}
+    broker['port'] = int(broker.get('port') or 1883)
+    broker['user'] = broker.get('user', None)
+    broker['password'] = broker.get('password', None)
+    broker['tls_enabled'] = bool(broker.get('tls_enabled', False))
+    broker['tls_insecure'] = bool(broker.get('tls_insecure', False))
+    broker['tls_ca'] = broker.get('tls_ca', None)
+    broker['tls_cert'] = broker.get('tls_cert', None)
+    broker['tls_keyfile'] = broker.get('tls_keyfile', None)
+    broker['base_topic'] = str(broker.get('base_topic', defaults.get('base_topic', 'rtlamr')))
+    broker['ha_status_topic'] = str(broker.get('ha_status_topic', defaults.get('ha_status_topic', 'homeassistant/status')))
+    broker['ha_autodiscovery_topic'] = broker.get('ha_autodiscovery_topic', defaults.get('ha_autodiscovery_topic', 'homeassistant'))
+    broker['qos'] = int(broker.get('qos', defaults.get('qos', 1)))
+    # Named once the host is known, when it comes from the Supervisor
+    if broker.get('name') is not None or broker.get('host') is not None:
+        broker['name'] = str(broker.get('name') or f'{broker["host"]}:{broker["port"]}')
+    return broker
+
+def resolve_brokers(config, timeout=SUPERVISOR_TIMEOUT):
+    """
+    Get the main broker from the Supervisor API, for a configuration loaded
+    with supervisor=False and no MQTT host. Returns (status, message).
+    """
+    mqtt = config['mqtt']
+    if mqtt.get('host') is not None:
+        return ('success', 'MQTT broker configured')
+    info = get_mqtt_info_from_supervisor({}, timeout)
+    if info.get('host') is None:
+        return ('error', 'No MQTT broker information found.')
+    # The Supervisor settings replace the connection ones, the topics are kept
+    mqtt.update(info)
+    mqtt['port'] = int(mqtt.get('port') or 1883)
+    mqtt['tls_enabled'] = bool(mqtt['tls_enabled'])
+    mqtt['name'] = mqtt.get('name') or f'{mqtt["host"]}:{mqtt["port"]}'
+    return ('success', 'MQTT broker found from the Supervisor')
+
+def reuse_supervisor_broker(new_config, old_config):
+    """
+    Keep the main broker found from the Supervisor in a configuration reloaded
+    with supervisor=False and still no MQTT host, instead of looking it up again.
+    """
+    mqtt, resolved = new_config['mqtt'], old_config['mqtt']
+    if mqtt.get('host') is not None or resolved.get('host') is None:
+        return
+    for key in [ 'host', 'port', 'user', 'password', 'tls_enabled' ]:
+        mqtt[key] = resolved.get(key)
+    mqtt['name'] = mqtt.get('name') or resolved.get('name')
+
+
+
+def load_config(config_path=None, supervisor=True):
     """
     Load the configuration file.
+    supervisor: Get the MQTT broker from the Supervisor API if it is not set,
+    False to leave it to resolve_brokers().
     """
     # If no config path is provided, search for the config file in the default locations
     search_paths = [
@@ -62,14 +127,17 @@ def load_config(config_path=None):
 
     # Get file extension
     file_extension = os.path.splitext(config_path)[1]
-    if file_extension in ['.json', '.js']:
-        with open(config_path, 'r', encoding='utf-8') as file:
-            config = load(file)
-    elif file_extension in ['.yaml', '.yml']:
-        with open(config_path, 'r', encoding='utf-8') as file:
-            config = safe_load(file)
-    else:
-        return ('error', 'Config file format not supported.', None)
+    try:
+        if file_extension in ['.json', '.js']:
+            with open(config_path, 'r', encoding='utf-8') as file:
+                config = load(file)
+        elif file_extension in ['.yaml', '.yml']:
+            with open(config_path, 'r', encoding='utf-8') as file:
+                config = safe_load(file)
+        else:
+            return ('error', 'Config file format not supported.', None)
+    except (ValueError, YAMLError) as e:
+        return ('error', f'Config file can not be parsed: {e}', None)
 
     # Get values and set defauls
     general, mqtt, custom_parameters = {}, {}, {}
@@ -84,31 +152,116 @@ def load_config(config_path=None):
     # General section
     general['sleep_for'] = int(general.get('sleep_for', 0))
     general['verbosity'] = str(general.get('verbosity', 'info'))
+    # Most messages of each high volume category (rtlamr, reading, publish) logged per minute, 0 for all
+    general['log_rate_limit'] = int(general.get('log_rate_limit', 30))
     general['device_id'] = str(general.get('device_id', '0'))
-    general['rtltcp_host'] = str(general.get('rtltcp_host', '127.0.0.1:1234'))
+    # rtltcp_host can be a list of remote servers to fail over between
+    rtltcp_hosts = general.get('rtltcp_host', '127.0.0.1:1234')
+    if not isinstance(rtltcp_hosts, list):
+        rtltcp_hosts = str(rtltcp_hosts).split(',')
+    general['rtltcp_hosts'] = [ str(host).strip() for host in rtltcp_hosts if str(host).strip() ]
+    if not general['rtltcp_hosts']:
+        general['rtltcp_hosts'] = [ '127.0.0.1:1234' ]
+    if len(general['rtltcp_hosts']) > 1 and any(host.split(':')[0] in [ '127.0.0.1', 'localhost' ] for host in general['rtltcp_hosts']):
+        return ('error', 'Only remote rtl_tcp servers can be listed in rtltcp_host.', None)
+    # The server in use, it changes on fail over
+    general['rtltcp_host'] = general['rtltcp_hosts'][0]
+    general['rtltcp_probe_interval'] = int(general.get('rtltcp_probe_interval', 30))
+    general['rtltcp_probe_timeout'] = int(general.get('rtltcp_probe_timeout', 2))
+    # Decoder engine: rtlamr, or the NumPy decoder for SCM/SCM+ meters only
+    general['decoder'] = str(general.get('decoder', 'rtlamr')).lower()
+    if general['decoder'] not in [ 'rtlamr', 'numpy' ]:
+        return ('error', 'Decoder must be rtlamr or numpy.', None)
+    general['decoder_symbol_length'] = int(general.get('decoder_symbol_length', 72))
+    # Slot limits, in seconds, when the meters are on more than one frequency
+    general['hop_min_dwell'] = int(general.get('hop_min_dwell', 5))
+    general['hop_max_dwell'] = int(general.get('hop_max_dwell', 120))
+    # rtlamr CPU budget, in percent of one core, 0 to keep the rtlamr defaults
+    general['cpu_budget'] = int(general.get('cpu_budget', 0))
+    general['autotune_seconds'] = int(general.get('autotune_seconds', 30))
+    # The rtlamr symbol length and decimation chosen for the budget, set at runtime
+    general['autotune'] = None
+    # Tuner gain calibration from the decoded messages
+    general['gain_calibration'] = bool(general.get('gain_calibration', False))
+    general['gain_dwell'] = int(general.get('gain_dwell', 60))
+    general['gain_recalibrate'] = int(general.get('gain_recalibrate', 168))
+    if general['gain_calibration'] and general['sleep_for'] > 0:
+        return ('error', 'Gain calibration needs continuous readings, set sleep_for to 0.', None)
+    # Missed readings in a row before a meter is unavailable, 0 to never mark them unavailable
+    general['missed_readings'] = int(general.get('missed_readings', 3))
+    # Per-meter availability in Home Assistant
+    general['meter_availability'] = bool(general.get('meter_availability', False))
+    # Announce the meters heard that are not in the meters section
+    general['discovery'] = bool(general.get('discovery', True))
+    # Where the unwatched meters are dropped: by rtlamr, by the add-on, or measured (auto)
+    general['filtering'] = str(general.get('filtering', 'auto')).lower()
+    if general['filtering'] not in [ 'auto', 'python', 'rtlamr' ]:
+        return ('error', 'Filtering must be auto, python or rtlamr.', None)
+    general['filter_evaluation'] = int(general.get('filter_evaluation', 600))
+    # The meter IDs rtlamr filters on, set at runtime
+    general['filter_ids'] = None
     # MQTT section
     mqtt['host'] = mqtt.get('host', None)
-    if mqtt['host'] is None:
+    if mqtt['host'] is None and supervisor:
         mqtt = get_mqtt_info_from_supervisor(mqtt)
-    else:
-        mqtt['port'] = int(mqtt.get('port', 1883))
-        mqtt['user'] = mqtt.get('user', None)
-        mqtt['password'] = mqtt.get('password', None)
-        mqtt['tls_enabled'] = bool(mqtt.get('tls_enabled', False))
-    if mqtt['host'] is None:
-            return ('error', 'No MQTT broker information found.', None)
-    mqtt['tls_insecure'] = bool(mqtt.get('tls_insecure', False))
-    mqtt['tls_ca'] = mqtt.get('tls_ca', None)
-    mqtt['tls_cert'] = mqtt.get('tls_cert', None)
-    mqtt['tls_keyfile'] = mqtt.get('tls_keyfile', None)
-    mqtt['base_topic'] = str(mqtt.get('base_topic', 'rtlamr'))
-    mqtt['ha_status_topic'] = str(mqtt.get('ha_status_topic', 'homeassistant/status'))
-    mqtt['ha_autodiscovery_topic'] = mqtt.get('ha_autodiscovery_topic', 'homeassistant')
+    if mqtt.get('host') is None and supervisor:
+        return ('error', 'No MQTT broker information found.', None)
+    mqtt = normalize_broker(mqtt)
+    # Optional list of extra brokers to mirror the readings to
+    brokers = [ mqtt ]
+    for mirror in mqtt.pop('mirrors', None) or []:
+        if mirror.get('host') is None:
+            return ('error', 'Every MQTT mirror needs a host.', None)
+        brokers.append(normalize_broker(mirror, defaults=mqtt))
+    names = [ broker.get('name') for broker in brokers ]
+    if len(names) != len(set(names)):
+        return ('error', 'MQTT broker names must be unique.', None)
 
     # Custom parameters section
     custom_parameters['rtltcp'] = str(custom_parameters.get('rtltcp', '-s 2048000'))
     custom_parameters['rtlamr'] = str(custom_parameters.get('rtlamr', '-unique=true'))
 
+    # Sinks section
+    sinks = []
+    sinks_common_keys = [ 'type', 'name', 'batch_size', 'flush_interval', 'max_queue', 'retries', 'retry_backoff' ]
+    sinks_allowed_keys = {
+        'influxdb': [ 'url', 'measurement', 'database', 'bucket', 'org', 'token', 'username', 'password', 'timeout' ],
+        'file': [ 'path', 'file_format', 'max_bytes', 'backup_count' ],
+        'webhook': [ 'url', 'headers', 'timeout' ],
+    }
+    for s in config.get('sinks') or []:
+        sink_type = s.get('type')
+        if sink_type not in sinks_allowed_keys:
+            return ('error', f'Unknown sink type: {sink_type}', None)
+        if sink_type == 'file' and s.get('path') is None:
+            return ('error', 'File sink needs a path.', None)
+        if sink_type != 'file' and s.get('url') is None:
+            return ('error', f'{sink_type} sink needs an url.', None)
+        if s.get('file_format', 'ndjson') not in [ 'ndjson', 'csv' ]:
+            return ('error', 'File sink format must be ndjson or csv.', None)
+        sinks.append({ key: value for key, value in s.items() if key in sinks_common_keys + sinks_allowed_keys[sink_type] })
+    # Named after their type, numbered if there are several sinks of the same type
+    types = [ s['type'] for s in sinks ]
+    counts = {}
+    for s in sinks:
+        counts[s['type']] = counts.get(s['type'], 0) + 1
+        if s.get('name') is None:
+            s['name'] = s['type'] if types.count(s['type']) == 1 else f'{s["type"]}-{counts[s["type"]]}'
+        s['name'] = str(s['name'])
+    names = [ s['name'] for s in sinks ]
+    if len(names) != len(set(names)):
+        return ('error', 'Sink names must be unique.', None)
+
+    # Cluster section
+    cluster = config.get('cluster') or {}
+    cluster['enabled'] = bool(cluster.get('enabled', False))
+    cluster['node_id'] = str(cluster.get('node_id', socket.gethostname()))
+    cluster['topic'] = str(cluster.get('topic', f'{mqtt["base_topic"]}/cluster'))
+    cluster['owner_timeout'] = int(cluster.get('owner_timeout', 300))
+    cluster['heartbeat_interval'] = int(cluster.get('heartbeat_interval', 15))
+    cluster['confirm_timeout'] = int(cluster.get('confirm_timeout', 5))
+    cluster['dedup_window'] = int(cluster.get('dedup_window', 10))
+
     # Convert meters to a dictionary with IDs as keys
     meters = {}
     meters_allowed_keys = [
@@ -122,19 +275,80 @@ def load_config(config_path=None):
         'device_class',
         'state_class',
         'expire_after',
-        'force_update'
+        'force_update',
+        'attributes_include',
+        'attributes_exclude',
+        'attributes_interval',
+        'attributes_on_change',
+        'frequency',
+        'transmit_interval'
     ]
     for m in config['meters']:
         # Get only allowed keys and drop anything else
         m['state_class'] = m.get('state_class', 'total_increasing')  # Default to 'total_increasing' if not set
         meters[str(m['id'])] = { key: value for key, value in m.items() if key in meters_allowed_keys }
+        try:
+            if 'frequency' in m:
+                meters[str(m['id'])]['frequency'] = int(float(m['frequency']))
+            if 'transmit_interval' in m:
+                meters[str(m['id'])]['transmit_interval'] = int(m['transmit_interval'])
+        except (TypeError, ValueError):
+            return ('error', f'Meter {m["id"]} has an invalid frequency or transmit_interval.', None)
+        if general['meter_availability']:
+            meters[str(m['id'])]['meter_availability'] = True
+        if general['decoder'] == 'numpy' and str(m.get('protocol', 'scm')).lower() not in [ 'scm', 'scm+' ]:
+            return ('error', f'The numpy decoder only supports SCM and SCM+ meters, meter {m["id"]} is {m["protocol"]}.', None)
 
     # Build config
     config = {
         'general': general,
         'mqtt': mqtt,
+        'brokers': brokers,
         'custom_parameters': custom_parameters,
         'meters': meters,
+        'sinks': sinks,
+        'cluster': cluster,
     }
 
     return ('success', 'Config loaded successfully', config)
+
+
+def diff_config(old_config, new_config):
+    """
+    Compare two loaded configurations and find out what has to be reloaded.
+    Returns a dictionary with:
+        rtltcp: The rtl_tcp device settings have changed
+        rtlamr: The rtlamr command line (-filterid, custom parameters, ...), the decoder settings,
+                or whether the decoder reads from the frequency hopping have changed
+        mqtt: The MQTT broker settings have changed
+        sinks: The sinks settings have changed
+        cluster: The cluster settings have changed
+        meters_added, meters_removed, meters_changed: Lists of meter IDs
+    """
+    old_general, new_general = old_config['general'], new_config['general']
+    rtltcp_changed = (
+        old_general['device_id'] != new_general['device_id']
+        or old_general['rtltcp_hosts'] != new_general['rtltcp_hosts']
+        or old_config['custom_parameters']['rtltcp'] != new_config['custom_parameters']['rtltcp']
+    )
+    rtlamr_changed = (
+        set(cmd.build_rtlamr_args(old_config)) != set(cmd.build_rtlamr_args(new_config))
+        or old_general['decoder'] != new_general['decoder']
+        or old_general['decoder_symbol_length'] != new_general['decoder_symbol_length']
+        # rtlamr gets the protocols from its command line, the NumPy decoder from the meters
+        or new_general['decoder'] == 'numpy' and scm.meter_protocols(old_config['meters']) != scm.meter_protocols(new_config['meters'])
+        # The decoder reads from the proxy when the meters are on several frequencies, which the hopping tunes
+        or hop.needs_hopping(old_config['meters']) != hop.needs_hopping(new_config['meters'])
+    )
+
+    old_meters, new_meters = old_config['meters'], new_config['meters']
+    return {
+        'rtltcp': rtltcp_changed,
+        'rtlamr': rtltcp_changed or rtlamr_changed,
+        'mqtt': old_config['brokers'] != new_config['brokers'],
+        'sinks': old_config['sinks'] != new_config['sinks'],
+        'cluster': old_config['cluster'] != new_config['cluster'],
+        'meters_added': [ m for m in new_meters if m not in old_meters ],
+        'meters_removed': [ m for m in old_meters if m not in new_meters ],
+        'meters_changed': [ m for m in new_meters if m in old_meters and new_meters[m] != old_meters[m] ],
+    }
@@ -0,0 +1,211 @@
+"""
+Helper class to choose where the meters are filtered.
+
+rtlamr can drop the unwatched meters itself (-filterid), but the watched set
+is then fixed until rtlamr is restarted, and the meters around are not heard
+anymore, so they can not be discovered. Without it, every message goes
+through the pipe and the add-on drops the unwatched ones, which costs more
+the more meters are around. The meter ID is looked up in the raw line first,
+so the unwatched lines are dropped without being parsed.
+
+In 'auto' mode, both placements are measured in turn: the CPU time of the
+add-on and of the rtlamr processes per minute, over an evaluation window.
+The cheapest one is kept, and the other one is tried again from time to time
+because the meters around change. With discovery, every meter heard is
+watched and rtlamr must let the new ones through, so 'auto' filters in the
+add-on and measures nothing: it needs discovery to be off.
+"""
+
+import re
+from time import monotonic, process_time
+import helpers.autotune as tune
+
+
+MODES = [ 'auto', 'python', 'rtlamr' ]
+# The keys read_output looks for, the number is the meter ID
+ID_PATTERN = re.compile(r'"(?:EndpointID|ID|ERTSerialNumber)":\s*(\d+)')
+
+
+def line_meter_id(rtlamr_output):
+    """
+    Return the meter ID of a rtlamr line or a NumPy decoder message, None if it has none.
+    """
+    if isinstance(rtlamr_output, dict):
+        message = rtlamr_output.get('Message', {})
+        for key in [ 'EndpointID', 'ID', 'ERTSerialNumber' ]:
+            if key in message:
+                return str(message[key])
+        return None
+    match = ID_PATTERN.search(rtlamr_output)
+    # As json.loads would read it
+    return str(int(match.group(1))) if match else None
+
+
+class FilterController:
+    """
+    Keep track of the placement of the filter, 'python' or 'rtlamr'.
+    """
+    def __init__(self, logger, mode='auto', discovery=True, can_filter=True, evaluation=600, retry=6,
+                 min_unwatched_rate=10, margin=0.1, log_level=4):
+        """
+        mode: 'auto', or a placement to always use
+        discovery: Meters that are not watched are announced, rtlamr must not filter them
+        can_filter: The decoder is rtlamr (the NumPy decoder runs in the add-on)
+        evaluation: Seconds of each measurement
+        retry: Evaluations before measuring the other placement again
+        min_unwatched_rate: Unwatched lines per minute worth trying rtlamr
+        margin: Share of CPU time the other placement must save to switch
+        """
+        self.logger = logger
+        self.log_level = log_level
+        self.mode = mode
+        self.discovery = discovery
+        self.can_filter = can_filter
+        self.evaluation = evaluation
+        self.retry = retry
+        self.min_unwatched_rate = min_unwatched_rate
+        self.margin = margin
+        self.placement = self._allowed('rtlamr' if mode == 'rtlamr' else 'python')
+        self._log_auto()
+        # Last measurement of each placement: { 'cpu': seconds per minute, 'rate': lines per minute, 'time' }
+        self.measured = {}
+        self.switches = 0
+        self.lines = 0
+        self.unwatched = 0
+        self.window_start = None
+        self.window_pid = None
+        self.window_cpu = None
+
+    def _allowed(self, placement):
+        """
+        The placement to use instead if this one is not possible.
+        """
+        if placement == 'rtlamr' and (self.discovery and self.mode != 'rtlamr' or not self.can_filter):
+            return 'python'
+        return placement
+
+    def _log_auto(self):
+        """
+        Tell why 'auto' does not measure anything.
+        """
+        if self.mode == 'auto' and self.discovery and self.can_filter and self.log_level >= 3:
+            self.logger.info('Filtering the meters in python: filtering: auto needs discovery: false to try rtlamr.')
+
+    def configure(self, mode, discovery, can_filter):
+        """
+        Apply new settings. Returns True if the placement has changed.
+        """
+        changed = (mode, discovery, can_filter) != (self.mode, self.discovery, self.can_filter)
+        self.mode, self.discovery, self.can_filter = mode, discovery, can_filter
+        if changed:
+            self._log_auto()
+        if mode in [ 'python', 'rtlamr' ]:
+            target = self._allowed(mode)
+        else:
+            target = self._allowed(self.placement)
+        return self._switch(target, 'settings changed')
+
+    def filter_ids(self, meter_ids):
+        """
+        The IDs rtlamr has to filter on, None to let every meter through.
+        """
+        return sorted(meter_ids) if self.placement == 'rtlamr' and meter_ids else None
+
+    def on_line(self, watched):
+        """
+        A message has been read, from a watched meter or not.
+        """
+        self.lines += 1
+        if not watched:
+            self.unwatched += 1
+
+    def _cpu_time(self, pid):
+        """
+        CPU seconds used by the add-on and the decoder processes.
+        """
+        cpu = process_time()
+        if pid is not None:
+            decoder = tune.process_tree_cpu_time(pid)
+            if decoder is None:
+                return None
+            cpu += decoder
+        return cpu
+
+    def _start_window(self, now, pid):
+        self.window_start = now
+        self.window_pid = pid
+        self.window_cpu = self._cpu_time(pid)
+        self.lines = 0
+        self.unwatched = 0
+
+    def _switch(self, target, reason):
+        if target == self.placement:
+            return False
+        if self.log_level >= 3:
+            self.logger.info('Filtering the meters in %s instead of %s (%s).', target, self.placement, reason)
+        self.placement = target
+        self.switches += 1
+        # The measurement restarts with the decoder
+        self.window_start = None
+        return True
+
+    def tick(self, pid, now=None):
+        """
+        Measure the current placement, called from the main loop with the decoder PID,
+        None when it runs in the add-on. Returns True when the placement has changed
+        and the decoder has to be restarted.
+        """
+        now = monotonic() if now is None else now
+        if self.mode != 'auto' or self._allowed('rtlamr') != 'rtlamr':
+            # Nothing to choose from
+            return False
+        if self.window_start is None or pid != self.window_pid or self.window_cpu is None:
+            # A new decoder, its CPU time so far was not spent with this placement
+            self._start_window(now, pid)
+            return False
+        if now - self.window_start < self.evaluation:
+            return False
+        cpu = self._cpu_time(pid)
+        if cpu is None:
+            self._start_window(now, pid)
+            return False
+        minutes = (now - self.window_start) / 60
+        self.measured[self.placement] = {
+            'cpu': round((cpu - self.window_cpu) / minutes, 3),
+            'rate': round(self.lines / minutes, 1),
+            'unwatched_rate': round(self.unwatched / minutes, 1),
+            'time': now,
+        }
+        if self.log_level >= 4:
+            self.logger.debug('Filtering in %s: %s', self.placement, self.measured[self.placement])
+        target, reason = self._choose(now)
+        self._start_window(now, pid)
+        return self._switch(target, reason)
+
+    def _choose(self, now):
+        """
+        The placement to use next and why.
+        """
+        current = self.measured[self.placement]
+        other = 'rtlamr' if self.placement == 'python' else 'python'
+        last = self.measured.get(other)
+        if last is None or now - last['time'] > self.evaluation * self.retry:
+            # Only worth trying if the add-on drops enough lines
+            if other == 'rtlamr' and current['unwatched_rate'] < self.min_unwatched_rate:
+                return self.placement, 'few unwatched meters'
+            return other, 'measuring'
+        if last['cpu'] < current['cpu'] * (1 - self.margin):
+            return other, f'{last["cpu"]:.2f} instead of {current["cpu"]:.2f} CPU seconds per minute'
+        return self.placement, 'cheapest'
+
+    def stats(self):
+        """
+        Return the placement and the measurements.
+        """
+        return {
+            'mode': self.mode,
+            'placement': self.placement,
+            'switches': self.switches,
+            'measured': { placement: { key: value for key, value in result.items() if key != 'time' }
+                          for placement, result in self.measured.items() },
+        }
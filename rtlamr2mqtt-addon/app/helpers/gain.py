@@ -0,0 +1,212 @@
+"""
+Helper class to choose the tuner gain from the decoded messages.
+
+The decoder keeps running while the gain is changed through the rtl_tcp proxy:
+each gain of the tuner (and the automatic gain) is kept for a while, and the
+one hearing the most watched meters, then decoding the most messages, is
+locked in. The calibration runs again after some time or when the decoded
+messages rate drops, and its result is kept between restarts.
+"""
+
+import json
+from time import monotonic, time
+
+
+# Kept between restarts of the add-on
+CACHE_PATH = '/data/gain.json'
+
+
+class GainCalibration:
+    """
+    Calibration state machine: 'waiting' for the number of tuner gains,
+    'calibrating' one gain after the other, then 'locked' on the best one.
+    """
+    def __init__(self, proxy, meter_ids, logger, dwell=60, interval=7 * 86400, drop_ratio=0.5, key='', cache_path=CACHE_PATH, log_level=4):
+        """
+        proxy: The RtlTcpProxy the decoder reads from
+        meter_ids: The watched meters, the set is read at each step
+        dwell: Seconds spent on each gain
+        interval: Seconds before calibrating again, 0 to only calibrate again when the rate drops
+        drop_ratio: Calibrate again when the rate falls below this share of the calibrated rate
+        key: The receiver the result is for, a cached result for another receiver is not used
+        """
+        self.proxy = proxy
+        self.meter_ids = meter_ids
+        self.logger = logger
+        self.log_level = log_level
+        self.dwell = dwell
+        self.interval = interval
+        self.drop_ratio = drop_ratio
+        self.key = key
+        self.cache_path = cache_path
+        self.state = 'waiting'
+        self.steps = []
+        self.step = 0
+        self.results = {}
+        self.gain = None
+        self.locked_rate = None
+        self.locked_at = None
+        self.calibrations = 0
+        # Messages and watched meters heard since the start of the step or window
+        self.window_start = monotonic()
+        self.messages = 0
+        self.heard = set()
+        # Long enough to hear most meters, so a quiet minute is not a drop
+        self.window = max(600, dwell * 5)
+
+    def on_message(self, meter_id):
+        """
+        A message has been decoded.
+        """
+        self.messages += 1
+        if meter_id in self.meter_ids:
+            self.heard.add(meter_id)
+
+    def _reset_window(self, now):
+        self.window_start = now
+        self.messages = 0
+        self.heard = set()
+
+    def _measure(self, now):
+        """
+        Messages per minute and share of the watched meters heard since the start of the window.
+        """
+        minutes = max(now - self.window_start, 1) / 60
+        heard = len(self.heard) / len(self.meter_ids) if self.meter_ids else 0
+        return { 'rate': round(self.messages / minutes, 1), 'heard': round(heard, 3) }
+
+    def start_calibration(self, now=None):
+        """
+        Step through the automatic gain and every tuner gain.
+        """
+        now = monotonic() if now is None else now
+        self.state = 'calibrating'
+        self.steps = [ 'auto' ] + list(range(self.proxy.gain_count or 0))
+        self.step = 0
+        self.results = {}
+        self.calibrations += 1
+        if self.log_level >= 3:
+            self.logger.info('Calibrating the tuner gain: %d settings for %d seconds each...', len(self.steps), self.dwell)
+        self.proxy.set_gain(self.steps[0])
+        self._reset_window(now)
+
+    def lock(self, gain, rate, now=None):
+        """
+        Keep a gain until the next calibration.
+        """
+        now = monotonic() if now is None else now
+        self.state = 'locked'
+        self.gain = gain
+        self.locked_rate = rate
+        self.locked_at = now
+        self.proxy.set_gain(gain)
+        self._reset_window(now)
+
+    def tick(self):
+        """
+        Move the state machine forward, called from the main loop.
+        """
+        now = monotonic()
+        if self.state == 'waiting':
+            # The number of gains is known once the decoder has connected to rtl_tcp
+            if self.proxy.gain_count is None:
+                return
+            cached = self.load()
+            if cached is not None:
+                if self.log_level >= 3:
+                    self.logger.info('Using the calibrated tuner gain: %s', cached['gain'])
+                self.lock(cached['gain'], cached['rate'], now)
+            else:
+                self.start_calibration(now)
+        elif self.state == 'calibrating':
+            if now - self.window_start < self.dwell:
+                return
+            result = self._measure(now)
+            gain = self.steps[self.step]
+            self.results[gain] = result
+            if self.log_level >= 4:
+                self.logger.debug('Tuner gain %s: %.1f messages/min, %.0f%% of the meters heard', gain, result['rate'], result['heard'] * 100)
+            self.step += 1
+            if self.step < len(self.steps):
+                self.proxy.set_gain(self.steps[self.step])
+                self._reset_window(now)
+                return
+            if not any(result['rate'] for result in self.results.values()):
+                # Nothing decoded with any gain, not worth keeping until the next restart
+                if self.log_level >= 2:
+                    self.logger.warning('No message decoded while calibrating the tuner gain, using the automatic gain.')
+                self.lock('auto', 0, now)
+                return
+            best = max(self.results, key=lambda gain: (self.results[gain]['heard'], self.results[gain]['rate']))
+            if self.log_level >= 3:
+                self.logger.info('Tuner gain calibrated: %s (%.1f messages/min, %.0f%% of the meters heard)',
+                    best, self.results[best]['rate'], self.results[best]['heard'] * 100)
+            self.lock(best, self.results[best]['rate'], now)
+            self.save()
+        elif self.state == 'locked':
+            if self.interval > 0 and now - self.locked_at >= self.interval:
+                self.start_calibration(now)
+            elif now - self.window_start >= self.window:
+                result = self._measure(now)
+                if not self.locked_rate and result['rate'] > 0:
+                    # Nothing was decoded while calibrating, now the gains can be compared
+                    if self.log_level >= 3:
+                        self.logger.info('Messages are decoded now, calibrating the tuner gain again.')
+                    self.start_calibration(now)
+                elif self.locked_rate and result['rate'] < self.locked_rate * self.drop_ratio:
+                    if self.log_level >= 2:
+                        self.logger.warning('Decoded messages dropped to %.1f/min from %.1f/min, calibrating the tuner gain again.',
+                            result['rate'], self.locked_rate)
+                    self.start_calibration(now)
+                else:
+                    self._reset_window(now)
+
+    def load(self):
+        """
+        Return the cached { 'gain', 'rate' } for this receiver, None if there is none or it is too old.
+        """
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(cached, dict) or cached.get('key') != self.key or cached.get('gain_count') != self.proxy.gain_count:
+            return None
+        if self.interval > 0 and time() - cached.get('time', 0) > self.interval:
+            return None
+        return { 'gain': cached.get('gain'), 'rate': cached.get('rate') }
+
+    def save(self):
+        """
+        Keep the calibrated gain and the measurements. Returns False if it can not be written.
+        """
+        cached = {
+            'key': self.key,
+            'time': int(time()),
+            'gain_count': self.proxy.gain_count,
+            'gain': self.gain,
+            'rate': self.locked_rate,
+            'results': { str(gain): result for gain, result in self.results.items() },
+        }
+        try:
+            with open(self.cache_path, 'w', encoding='utf-8') as f:
+                json.dump(cached, f, indent=2)
+        except OSError:
+            if self.log_level >= 2:
+                self.logger.warning('Failed to save the tuner gain calibration to %s', self.cache_path)
+            return False
+        return True
+
+    def stats(self):
+        """
+        Return the state of the calibration.
+        """
+        return {
+            'state': self.state,
+            'gain': self.gain if self.state == 'locked' else self.proxy.gain,
+            'gain_count': self.proxy.gain_count,
+            'locked_rate': self.locked_rate,
+            'calibrations': self.calibrations,
+            'step': f'{self.step + 1}/{len(self.steps)}' if self.state == 'calibrating' else None,
+            'results': { str(gain): result for gain, result in self.results.items() },
+        }
@@ -8,6 +8,12 @@ def meter_discover_payload(base_topic, meter_config):
     """
     Returns the discovery payload for Home Assistant.
     """
+    # Work on a copy, the meter configuration is reused on every (re)announce
+    meter_config = dict(meter_config)
+    # The attribute policy is ours, not for Home Assistant
+    for key in [ 'attributes_include', 'attributes_exclude', 'attributes_interval', 'attributes_on_change', 'frequency', 'transmit_interval' ]:
+        meter_config.pop(key, None)
+    meter_availability = meter_config.pop('meter_availability', False)
     meter_id = meter_config.pop('id')
     meter_name = meter_config.pop('name', f"Meter {meter_id}")
 
@@ -47,6 +53,15 @@ def meter_discover_payload(base_topic, meter_config):
         "qos": 1
     }
 
+    if meter_availability:
+        # Unavailable when the add-on is offline or when the meter is not heard anymore
+        del template_payload['availability_topic']
+        template_payload['availability'] = [
+            { 'topic': f'{base_topic}/status' },
+            { 'topic': f'{base_topic}/{meter_id}/availability' },
+        ]
+        template_payload['availability_mode'] = 'all'
+
     template_payload['components'][f'{meter_id}_reading'].update(meter_config)
 
     return template_payload
@@ -0,0 +1,341 @@
+"""
+Helper classes to share one receiver between meters on different frequencies.
+
+rtlamr (or the NumPy decoder) connects to a local proxy instead of rtl_tcp.
+The proxy relays the samples and lets the scheduler retune rtl_tcp, so the
+decoder keeps running while the receiver cycles through the frequency groups.
+The gain calibration changes the tuner gain through the same proxy.
+"""
+
+import socket
+import threading
+from struct import pack, unpack
+from time import monotonic
+import helpers.usb_utils as usbutil
+
+
+SET_FREQUENCY = 0x01
+SET_GAIN_MODE = 0x03
+SET_GAIN = 0x04
+SET_GAIN_BY_INDEX = 0x0d
+# rtl_tcp greets its clients with "RTL0", the tuner type and the number of tuner gains
+HEADER_LENGTH = 12
+# rtlamr default center frequency
+DEFAULT_FREQUENCY = 912600155
+# Meters closer than this to the center of a group are received with it
+USABLE_BANDWIDTH = 2000000
+
+
+def frequency_groups(meters, default_interval=30, bandwidth=USABLE_BANDWIDTH):
+    """
+    Group the meters by the frequency they transmit on.
+    Frequencies that fit in the same band share a group, tuned to their center.
+    Returns { center frequency: { 'meters': [ ids ], 'interval': seconds } }
+    where interval is the shortest transmit interval of the group.
+    """
+    frequencies = sorted(
+        (int(meter.get('frequency', DEFAULT_FREQUENCY)), meter_id, int(meter.get('transmit_interval', default_interval)))
+        for meter_id, meter in meters.items()
+    )
+    clusters = []
+    for frequency, meter_id, interval in frequencies:
+        if clusters and frequency - clusters[-1][0][0] <= bandwidth:
+            clusters[-1].append((frequency, meter_id, interval))
+        else:
+            clusters.append([ (frequency, meter_id, interval) ])
+    return {
+        (cluster[0][0] + cluster[-1][0]) // 2: {
+            'meters': [ meter_id for _, meter_id, _ in cluster ],
+            'interval': min(interval for _, _, interval in cluster),
+        }
+        for cluster in clusters
+    }
+
+def needs_hopping(meters):
+    """
+    The meters are on more than one frequency group.
+    """
+    return len(frequency_groups(meters)) > 1
+
+
+class RtlTcpProxy:
+    """
+    Relay a rtl_tcp server to one client at a time and retune it on demand.
+    The frequency and the gain requested by the client are replaced by the
+    ones set on the proxy, if any.
+    """
+    def __init__(self, upstream, logger, log_level=4):
+        """
+        upstream: The rtl_tcp server, "host:port". It can be changed before a client connects.
+        """
+        self.upstream = upstream
+        self.logger = logger
+        self.log_level = log_level
+        self.frequency = None
+        # None: the client sets the gain, 'auto' or the index of a tuner gain
+        self.gain = None
+        # Number of tuner gains, from the rtl_tcp header
+        self.gain_count = None
+        self.lock = threading.Lock()
+        self.upstream_conn = None
+        self.stopping = threading.Event()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.server.settimeout(1)
+        self.address = f'127.0.0.1:{self.server.getsockname()[1]}'
+        self.thread = None
+
+    def start(self):
+        """
+        Start accepting clients.
+        """
+        self.thread = threading.Thread(target=self._run, name='rtltcp-proxy', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the proxy and close the connections.
+        """
+        self.stopping.set()
+        with self.lock:
+            if self.upstream_conn is not None:
+                self.upstream_conn.close()
+        if self.thread is not None:
+            self.thread.join(2)
+        self.server.close()
+
+    def _run(self):
+        """
+        Serve the clients, one after the other.
+        """
+        while not self.stopping.is_set():
+            try:
+                client, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            self._serve(client)
+
+    def _serve(self, client):
+        """
+        Relay the samples to the client and its commands to rtl_tcp.
+        """
+        host, port = usbutil.split_host_port(self.upstream)
+        try:
+            upstream = socket.create_connection((host, port), timeout=5)
+        except OSError as e:
+            if self.log_level >= 1:
+                self.logger.error('Frequency hopping proxy can not connect to %s: %s', self.upstream, e)
+            client.close()
+            return
+        try:
+            self._relay_header(upstream, client)
+        except OSError:
+            upstream.close()
+            client.close()
+            return
+        upstream.settimeout(None)
+        client.settimeout(None)
+        with self.lock:
+            self.upstream_conn = upstream
+            if self.frequency is not None:
+                upstream.sendall(pack('>BI', SET_FREQUENCY, self.frequency))
+            self._send_gain()
+        pump = threading.Thread(target=self._pump, args=(upstream, client), name='rtltcp-proxy-pump', daemon=True)
+        pump.start()
+        try:
+            while not self.stopping.is_set():
+                command = self._recv_command(client)
+                if command is None:
+                    break
+                with self.lock:
+                    if command[0] == SET_FREQUENCY and self.frequency is not None:
+                        command = pack('>BI', SET_FREQUENCY, self.frequency)
+                    elif command[0] in (SET_GAIN_MODE, SET_GAIN, SET_GAIN_BY_INDEX) and self.gain is not None:
+                        continue
+                    upstream.sendall(command)
+        except OSError:
+            pass
+        with self.lock:
+            self.upstream_conn = None
+        for conn in (upstream, client):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+        pump.join(2)
+
+    def _relay_header(self, upstream, client):
+        """
+        Read the rtl_tcp header to learn the number of tuner gains, and pass it on to the client.
+        """
+        header = b''
+        while len(header) < HEADER_LENGTH:
+            try:
+                data = upstream.recv(HEADER_LENGTH - len(header))
+            except socket.timeout:
+                break
+            if not data:
+                break
+            header += data
+        if len(header) == HEADER_LENGTH and header[:4] == b'RTL0':
+            self.gain_count = unpack('>I', header[8:12])[0]
+        client.sendall(header)
+
+    def _send_gain(self):
+        """
+        Send the gain set on the proxy to rtl_tcp. Called with the lock held.
+        """
+        if self.gain is None or self.upstream_conn is None:
+            return
+        try:
+            if self.gain == 'auto':
+                self.upstream_conn.sendall(pack('>BI', SET_GAIN_MODE, 0))
+            else:
+                self.upstream_conn.sendall(pack('>BI', SET_GAIN_MODE, 1) + pack('>BI', SET_GAIN_BY_INDEX, int(self.gain)))
+        except OSError:
+            pass
+
+    def set_gain(self, gain):
+        """
+        Set the tuner gain, now and for the next clients: 'auto', the index of a
+        tuner gain, or None to let the client choose.
+        """
+        with self.lock:
+            self.gain = gain
+            self._send_gain()
+
+    @staticmethod
+    def _recv_command(client):
+        """
+        Read one 5 bytes rtl_tcp command from the client, None if it is gone.
+        """
+        command = b''
+        while len(command) < 5:
+            data = client.recv(5 - len(command))
+            if not data:
+                return None
+            command += data
+        return command
+
+    @staticmethod
+    def _pump(upstream, client):
+        """
+        Copy the samples from rtl_tcp to the client.
+        """
+        try:
+            while data := upstream.recv(65536):
+                client.sendall(data)
+        except OSError:
+            pass
+        try:
+            client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def set_frequency(self, frequency):
+        """
+        Tune rtl_tcp to a frequency, now and for the next clients. None lets the client choose.
+        """
+        with self.lock:
+            self.frequency = int(frequency) if frequency is not None else None
+            if self.upstream_conn is not None and self.frequency is not None:
+                try:
+                    self.upstream_conn.sendall(pack('>BI', SET_FREQUENCY, self.frequency))
+                except OSError:
+                    pass
+
+
+
+class HoppingScheduler:
+    """
+    Cycle the receiver through the frequency groups in time slots.
+    A slot lasts the shortest transmit interval of its group, longer if
+    meters of the group were missed recently, and ends as soon as every
+    meter of the group has been heard.
+    """
+    def __init__(self, groups, proxy, logger, min_dwell=5, max_dwell=120, log_level=4):
+        """
+        groups: Frequency groups, as returned by frequency_groups()
+        proxy: The RtlTcpProxy used to retune rtl_tcp
+        min_dwell, max_dwell: Limits of a slot, in seconds
+        """
+        self.proxy = proxy
+        self.logger = logger
+        self.log_level = log_level
+        self.min_dwell = min_dwell
+        self.max_dwell = max_dwell
+        self.groups = groups
+        self.frequencies = sorted(groups)
+        self.state = {
+            frequency: { 'miss_rate': 0.0, 'slots': 0, 'heard': set(), 'last_heard': {} }
+            for frequency in self.frequencies
+        }
+        self.meter_frequency = {
+            meter_id: frequency for frequency, group in groups.items() for meter_id in group['meters']
+        }
+        self.current = 0
+        self.slot_start = monotonic()
+        self.proxy.set_frequency(self.frequencies[0])
+
+    def dwell(self, frequency):
+        """
+        Length of the slot of a group, weighted by its transmit interval and missed readings.
+        """
+        dwell = self.groups[frequency]['interval'] * (1 + self.state[frequency]['miss_rate'])
+        return max(self.min_dwell, min(self.max_dwell, dwell))
+
+    def on_reading(self, meter_id):
+        """
+        A meter has been heard.
+        """
+        frequency = self.meter_frequency.get(meter_id)
+        if frequency is None:
+            return
+        self.state[frequency]['last_heard'][meter_id] = monotonic()
+        if frequency == self.frequencies[self.current]:
+            self.state[frequency]['heard'].add(meter_id)
+
+    def tick(self):
+        """
+        Move to the next group when the current slot is over.
+        """
+        now = monotonic()
+        frequency = self.frequencies[self.current]
+        state = self.state[frequency]
+        meters = self.groups[frequency]['meters']
+        all_heard = len(state['heard']) == len(meters)
+        if not all_heard and now - self.slot_start < self.dwell(frequency):
+            return
+        # Smooth the missed readings rate of the group over the last slots
+        missed = 1 - len(state['heard']) / len(meters)
+        state['miss_rate'] = 0.7 * state['miss_rate'] + 0.3 * missed
+        state['slots'] += 1
+        state['heard'] = set()
+        self.current = (self.current + 1) % len(self.frequencies)
+        self.slot_start = now
+        self.proxy.set_frequency(self.frequencies[self.current])
+        if self.log_level >= 4:
+            self.logger.debug('Frequency hopping: %d Hz for up to %.0f seconds', self.frequencies[self.current], self.dwell(self.frequencies[self.current]))
+
+    def stats(self):
+        """
+        Return the state of each frequency group.
+        """
+        now = monotonic()
+        return {
+            frequency: {
+                'active': frequency == self.frequencies[self.current],
+                'meters': self.groups[frequency]['meters'],
+                'dwell': round(self.dwell(frequency), 1),
+                'miss_rate': round(self.state[frequency]['miss_rate'], 3),
+                'slots': self.state[frequency]['slots'],
+                'last_heard': { meter_id: round(now - heard) for meter_id, heard in self.state[frequency]['last_heard'].items() },
+            }
+            for frequency in self.frequencies
+        }
@@ -0,0 +1,156 @@
+"""
+Helper class to notice when a RTL-SDR device is plugged in or removed.
+
+The kernel uevents are received from a netlink socket. They are only a hint:
+on every USB event the sysfs tree is read again and compared with the known
+devices. If netlink is not available (e.g. in a container without the host
+network), the sysfs tree is polled instead.
+"""
+
+import queue
+import select
+import socket
+import threading
+import helpers.usb_utils as usbutil
+
+
+NETLINK_KOBJECT_UEVENT = 15
+# Multicast group of the uevents sent by the kernel
+UEVENT_KERNEL_GROUP = 1
+
+
+class UsbHotplugMonitor:
+    """
+    Watch the RTL-SDR devices and queue ('add' | 'remove', "bus:device") events.
+    """
+    def __init__(self, logger, sysfs_root=usbutil.SYSFS_USB_DEVICES, poll_interval=5, use_netlink=True, log_level=4):
+        """
+        sysfs_root: Directory with the USB devices, a fake tree can be used for testing
+        poll_interval: Seconds between scans if no uevent is received
+        use_netlink: Listen to the kernel uevents, otherwise only poll
+        """
+        self.logger = logger
+        self.log_level = log_level
+        self.sysfs_root = sysfs_root
+        self.poll_interval = poll_interval
+        self.use_netlink = use_netlink
+        self.devices = self._scan()
+        # The configured devices, as first seen, to find them again once plugged back in
+        self.identities = {}
+        self.events = queue.Queue()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.netlink = None
+        self.thread = None
+
+    def start(self):
+        """
+        Start watching the devices in the background.
+        """
+        if self.use_netlink:
+            self.netlink = self._open_netlink()
+        if self.log_level >= 4:
+            self.logger.debug('Watching RTL-SDR devices using %s, found: %s',
+                'netlink uevents' if self.netlink is not None else 'polling', sorted(self.devices))
+        self.thread = threading.Thread(target=self._run, name='usb-hotplug', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop watching the devices.
+        """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(self.poll_interval + 1)
+        if self.netlink is not None:
+            self.netlink.close()
+
+    def _scan(self):
+        """
+        Read the RTL-SDR devices, by "bus:device" id.
+        """
+        return { device['id']: device for device in usbutil.list_rtl_sdr_devices(self.sysfs_root) }
+
+    @staticmethod
+    def _open_netlink():
+        """
+        Open the uevent netlink socket, None if it is not available.
+        """
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            sock.bind((0, UEVENT_KERNEL_GROUP))
+            return sock
+        except (OSError, AttributeError):
+            return None
+
+    @staticmethod
+    def is_usb_device_event(uevent):
+        """
+        Check if a raw uevent is about a USB device (not one of its interfaces).
+        """
+        fields = uevent.split(b'\0')
+        return b'SUBSYSTEM=usb' in fields and b'DEVTYPE=usb_device' in fields
+
+    def _run(self):
+        """
+        Wait for uevents, or for the next poll, and scan the devices.
+        """
+        while not self.stopping.is_set():
+            if self.netlink is None:
+                self.stopping.wait(self.poll_interval)
+            else:
+                try:
+                    ready, _, _ = select.select([ self.netlink ], [], [], self.poll_interval)
+                    if ready and not self.is_usb_device_event(self.netlink.recv(8192)):
+                        continue
+                except OSError:
+                    self.netlink = None
+                    continue
+            if not self.stopping.is_set():
+                self.rescan()
+
+    def rescan(self):
+        """
+        Read the devices again and queue the changes.
+        Returns the (added, removed) devices.
+        """
+        current = self._scan()
+        with self.lock:
+            added = sorted(current.keys() - self.devices.keys())
+            removed = sorted(self.devices.keys() - current.keys())
+            self.devices = current
+        for device in removed:
+            if self.log_level >= 2:
+                self.logger.warning('RTL-SDR device %s has been removed.', device)
+            self.events.put(('remove', device))
+        for device in added:
+            if self.log_level >= 3:
+                self.logger.info('RTL-SDR device %s has been plugged in.', device)
+            self.events.put(('add', device))
+        return added, removed
+
+    def get_events(self):
+        """
+        Return the queued events, oldest first.
+        """
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def resolve(self, device_id='0'):
+        """
+        Current "bus:device" id of the configured device, None if it is not plugged in.
+        See usbutil.match_device for the device_id formats.
+        """
+        with self.lock:
+            return usbutil.match_device(device_id, list(self.devices.values()), self.identities)
+
+    def present(self, device_id='0'):
+        """
+        Check if the device is plugged in. '0' means any device.
+        """
+        return self.resolve(device_id) is not None
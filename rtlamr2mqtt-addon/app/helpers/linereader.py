@@ -0,0 +1,158 @@
+"""
+Helper class to read lines from the rtl_tcp and rtlamr pipes with bounded memory.
+
+The pipe is read with os.readv() into a fixed-size buffer and split into
+lines. A line that is not complete yet is kept until the rest of it is read,
+up to a maximum length: longer lines are cut, the rest of them is dropped
+until the next newline, and they are counted. So a child writing a huge line,
+or output without any newline, can not grow the memory of the add-on.
+
+It replaces the stdout of the Popen object: readline() returns the next
+complete line, or '' if there is none yet, like a non-blocking text pipe.
+"""
+
+import os
+import select
+from collections import deque
+
+
+# Longest line kept, rtlamr messages are under 2 kB
+MAX_LINE = 16384
+# Bytes read from the pipe at once
+CHUNK_SIZE = 65536
+
+
+def new_stats():
+    """
+    The counters of a LineReader.
+    """
+    return { 'lines': 0, 'bytes': 0, 'truncated': 0, 'discarded_bytes': 0, 'unterminated': 0 }
+
+
+class LineReader:
+    """
+    Complete lines from a pipe, as text without the line ending.
+    """
+    def __init__(self, pipe, max_line=MAX_LINE, chunk_size=CHUNK_SIZE, encoding='utf-8', stats=None):
+        """
+        pipe: The stdout of the child, opened in binary mode
+        stats: Counters to update, to keep them from one child to the next
+        """
+        self.pipe = pipe
+        self.fd = pipe.fileno()
+        os.set_blocking(self.fd, False)
+        self.max_line = max_line
+        self.encoding = encoding
+        self.chunk = bytearray(chunk_size)
+        self.view = memoryview(self.chunk)
+        # Start of a line not complete yet, never longer than max_line
+        self.partial = bytearray()
+        # Dropping the end of a line longer than max_line
+        self.discarding = False
+        # Lines read from the last chunk, not returned yet
+        self.ready = deque()
+        self.eof = False
+        self.stats = new_stats() if stats is None else stats
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        self.view.release()
+        self.pipe.close()
+
+    @property
+    def closed(self):
+        return self.pipe.closed
+
+    def _add_line(self, line):
+        self.stats['lines'] += 1
+        self.ready.append(str(line, self.encoding, errors='replace').rstrip('\r'))
+
+    def _split(self, length):
+        """
+        Split the bytes just read into lines, carrying the partial one over.
+        """
+        chunk = self.chunk
+        start = 0
+        while start < length:
+            end = chunk.find(b'\n', start, length)
+            stop = length if end < 0 else end
+            if self.discarding:
+                self.stats['discarded_bytes'] += stop - start
+            else:
+                room = self.max_line - len(self.partial)
+                if stop - start > room:
+                    # Too long: keep the beginning, drop the rest up to the newline
+                    self.partial += self.view[start:start + room]
+                    self.stats['discarded_bytes'] += stop - start - room
+                    self.stats['truncated'] += 1
+                    self.discarding = True
+                    self._add_line(self.partial)
+                    self.partial.clear()
+                elif end >= 0 and not self.partial:
+                    self._add_line(self.view[start:end])
+                else:
+                    self.partial += self.view[start:stop]
+                    if end >= 0:
+                        self._add_line(self.partial)
+                        self.partial.clear()
+            if end < 0:
+                break
+            # The newline ends the dropped line
+            self.discarding = False
+            start = end + 1
+
+    def fill(self, timeout=0):
+        """
+        Read one chunk of what the pipe has, waiting up to timeout seconds for it.
+        Returns the number of bytes read, 0 if there was nothing or the pipe is closed.
+        """
+        if self.eof:
+            return 0
+        if timeout > 0:
+            try:
+                readable, _, _ = select.select([ self.fd ], [], [], timeout)
+            except (OSError, ValueError):
+                readable = [ self.fd ]
+            if not readable:
+                return 0
+        try:
+            length = os.readv(self.fd, [ self.chunk ])
+        except BlockingIOError:
+            return 0
+        except OSError:
+            length = 0
+        if length == 0:
+            self.eof = True
+            if self.partial and not self.discarding:
+                # The child stopped in the middle of a line
+                self.stats['unterminated'] += 1
+                self._add_line(self.partial)
+            self.partial.clear()
+            return 0
+        self.stats['bytes'] += length
+        self._split(length)
+        return length
+
+    def readline(self, timeout=0):
+        """
+        Return the next complete line, '' if there is none within timeout seconds.
+        """
+        while not self.ready and self.fill(timeout):
+            # A line can span several chunks, they are already there
+            timeout = 0
+        return self.ready.popleft() if self.ready else ''
+
+    def drain(self, limit=100):
+        """
+        Return up to limit lines, from what the pipe has now.
+        """
+        lines = []
+        while len(lines) < limit:
+            # A chunk can end in the middle of a line, read until the pipe is empty
+            if not self.ready and not self.fill() and not self.ready:
+                break
+            if self.ready:
+                lines.append(self.ready.popleft())
+        return lines
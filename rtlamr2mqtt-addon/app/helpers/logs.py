@@ -0,0 +1,110 @@
+"""
+Helper functions for logging
+
+Log records are put in a queue and written by a background thread, so the
+formatting and the writes to stdout never slow down the reading loop.
+High volume messages (one per rtlamr line, per reading or per publish) are
+logged with a category and sampled: at most a few per minute per category.
+"""
+
+import sys
+import queue
+import atexit
+import logging
+import logging.handlers
+from time import monotonic
+
+
+FORMAT = '[%(asctime)s] %(levelname)s:%(message)s'
+VERBOSITY = ['none', 'error', 'warning', 'info', 'debug']
+LEVELS = {
+    'none': logging.CRITICAL + 1,
+    'critical': logging.CRITICAL,
+    'error': logging.ERROR,
+    'warning': logging.WARNING,
+    'info': logging.INFO,
+    'debug': logging.DEBUG,
+}
+
+
+def verbosity_level(verbosity):
+    """
+    Convert the verbosity to the LOG_LEVEL number (0: none ... 4: debug).
+    """
+    verbosity = str(verbosity).lower()
+    if verbosity == 'critical':
+        return VERBOSITY.index('error')
+    return VERBOSITY.index(verbosity) if verbosity in VERBOSITY else VERBOSITY.index('info')
+
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Let at most rate_limit records of each category through per interval.
+    Records without a category are never dropped. The number of dropped
+    records is added to the next record of the category that goes through.
+    """
+    def __init__(self, rate_limit=30, interval=60):
+        super().__init__()
+        self.rate_limit = rate_limit
+        self.interval = interval
+        # category: [ window start, records let through, records dropped ]
+        self.windows = {}
+
+    def filter(self, record):
+        category = getattr(record, 'category', None)
+        if category is None or self.rate_limit <= 0:
+            return True
+        now = monotonic()
+        window = self.windows.get(category)
+        if window is None or now - window[0] >= self.interval:
+            dropped = window[2] if window is not None else 0
+            window = self.windows[category] = [ now, 0, 0 ]
+            if dropped and not isinstance(record.args, dict):
+                record.msg = f'{record.msg} [%d {category} messages were not logged]'
+                record.args = tuple(record.args or ()) + (dropped,)
+        if window[1] >= self.rate_limit:
+            window[2] += 1
+            return False
+        window[1] += 1
+        return True
+
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue the records as they are: they are formatted by the listener thread.
+    """
+    def prepare(self, record):
+        return record
+
+
+
+def setup_logging(verbosity='debug', rate_limit=30):
+    """
+    Send all the log records through a queue to a background thread.
+    Returns the sampling filter, to change its rate limit later.
+    """
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(logging.Formatter(FORMAT))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=False)
+    sampling_filter = SamplingFilter(rate_limit=rate_limit)
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(sampling_filter)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    set_level(verbosity)
+    listener.start()
+    # Write what is left in the queue when exiting
+    atexit.register(listener.stop)
+    return sampling_filter
+
+def set_level(verbosity):
+    """
+    Set the level of the root logger from the verbosity.
+    """
+    logging.getLogger().setLevel(LEVELS.get(str(verbosity).lower(), logging.INFO))
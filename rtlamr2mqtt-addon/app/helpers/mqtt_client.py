@@ -3,23 +3,76 @@ Helper functions for MQTT connection
 """
 
 import ssl
+import queue
+import threading
+from time import monotonic
 import paho.mqtt.client as mqtt
 from uuid import uuid4
 
+def dispatch(inbox, logger, timeout=0):
+    """
+    Call the handlers of the messages queued by MQTTClient.on_message, in the calling thread.
+    Waits up to timeout seconds for the first message.
+    Returns the number of messages handled.
+    """
+    handled = 0
+    while True:
+        try:
+            handler, topic, payload = inbox.get(timeout=timeout) if handled == 0 and timeout > 0 else inbox.get_nowait()
+        except queue.Empty:
+            return handled
+        handled += 1
+        try:
+            handler(topic, payload)
+        except Exception as e:
+            logger.error('Failed to handle MQTT message on %s: %s', topic, e)
+
+
 class MQTTClient:
     """
     A class to handle MQTT client operations.
+    Messages are published from an internal bounded queue by a worker thread,
+    so a slow or unavailable broker never blocks the caller.
+    Incoming messages are queued with the handler of their topic, to be
+    handled by dispatch() in the main loop.
     """
-    def __init__(self, logger, broker, port, username=None, password=None, tls_enabled=False, ca_cert=None, client_cert=None, tls_insecure=False, client_key=None, log_level=4):
+    def __init__(self, logger, broker, port, username=None, password=None, tls_enabled=False, ca_cert=None, client_cert=None, tls_insecure=False, client_key=None, log_level=4, name=None, base_topic='rtlamr', qos=1, queue_size=10000, inbox=None):
         """
         Initialize the MQTT client.
+        inbox: Queue of the incoming messages, it can be shared by several clients.
         """
-        self.client = mqtt.Client(client_id=f'rtlamr2mqtt-{uuid4().hex[-8:]}')
+        self.client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2, client_id=f'rtlamr2mqtt-{uuid4().hex[-8:]}')
         self.broker = broker
         self.port = port
+        self.name = name if name is not None else f'{broker}:{port}'
+        self.base_topic = base_topic
+        self.qos = qos
         self.logger = logger
         self.log_level = log_level
-        self.last_message = None
+        self.subscriptions = {}
+        self.handlers = {}
+        self.inbox = inbox if inbox is not None else queue.Queue(maxsize=1000)
+        self.publish_queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self.connected = threading.Event()
+        self.stopping = threading.Event()
+        self.publisher = None
+        self.metrics = {
+            'connected': False,
+            'connects': 0,
+            'disconnects': 0,
+            'queued': 0,
+            'published': 0,
+            'delivered': 0,
+            'dropped': 0,
+            'errors': 0,
+            'received': 0,
+            'last_latency': None,
+        }
+        # Time each message was handed to paho, until it is acknowledged
+        self.inflight = {}
+        # Acknowledgements received before publish() returned
+        self.acked = {}
+        self.inflight_lock = threading.Lock()
 
         # Set username and password if provided
         if username and password:
@@ -36,6 +89,11 @@ class MQTTClient:
             )
             self.client.tls_insecure_set(tls_insecure)
 
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_publish = self.on_publish
+        self.client.on_message = self.on_message
+
     def set_last_will(self, topic, payload, qos=0, retain=False):
         """
         Set the Last Will and Testament (LWT).
@@ -45,44 +103,171 @@ class MQTTClient:
     def connect(self):
         """
         Connect to the MQTT broker.
+        The connection happens in the background, it is retried until it succeeds.
         """
         if self.log_level >= 3:
-            self.logger.info(f"Connecting to MQTT broker at {self.broker}:{self.port}")
-        self.client.connect(self.broker, self.port)
-        self.client.on_message = self.on_message
+            self.logger.info('Connecting to MQTT broker %s at %s:%s', self.name, self.broker, self.port)
+        self.client.connect_async(self.broker, self.port)
 
-    def publish(self, topic, payload, qos=0, retain=False):
+    def on_connect(self, client, userdata, flags, reason_code, properties):
         """
-        Publish a message to a topic.
+        Callback for when the connection to the broker is established.
         """
+        if reason_code.is_failure:
+            if self.log_level >= 1:
+                self.logger.error('MQTT broker %s refused the connection: %s', self.name, reason_code)
+            return
         if self.log_level >= 3:
-            self.logger.info(f"Publishing to {topic}: {payload}")
-        self.client.publish(topic, payload=payload, qos=qos, retain=retain)
+            self.logger.info('Connected to MQTT broker %s', self.name)
+        self.metrics['connects'] += 1
+        self.metrics['connected'] = True
+        # Subscriptions are lost when the connection is lost
+        for topic, qos in self.subscriptions.items():
+            self.client.subscribe(topic, qos=qos)
+        self.connected.set()
+
+    def on_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
+        """
+        Callback for when the connection to the broker is lost.
+        """
+        self.connected.clear()
+        self.metrics['connected'] = False
+        self.metrics['disconnects'] += 1
+        if reason_code.is_failure and self.log_level >= 2:
+            self.logger.warning('Lost connection to MQTT broker %s, reconnecting...', self.name)
+
+    def on_publish(self, client, userdata, mid, reason_code, properties):
+        """
+        Callback for when a message has been delivered to the broker (sent, with QoS 0).
+        It can run before publish() has returned the mid to the publisher thread.
+        """
+        now = monotonic()
+        with self.inflight_lock:
+            self.metrics['delivered'] += 1
+            sent_at = self.inflight.pop(mid, None)
+            if sent_at is None:
+                # Matched by the publisher thread
+                self.acked[mid] = now
+                if len(self.acked) > 1000:
+                    self.acked.pop(next(iter(self.acked)))
+            elif sent_at is not False:
+                self.metrics['last_latency'] = round(now - sent_at, 3)
+
+    def publish(self, topic, payload, qos=None, retain=False):
+        """
+        Queue a message to be published to a topic.
+        If the queue is full, the oldest message is dropped.
+        """
+        if self.log_level >= 4:
+            self.logger.debug('Publishing to %s (%s): %s', topic, self.name, payload, extra={ 'category': 'publish' })
+        message = (topic, payload, self.qos if qos is None else qos, retain)
+        while True:
+            try:
+                self.publish_queue.put_nowait(message)
+                self.metrics['queued'] += 1
+                return
+            except queue.Full:
+                try:
+                    self.publish_queue.get_nowait()
+                    self.metrics['dropped'] += 1
+                except queue.Empty:
+                    pass
+
+    def _publisher(self):
+        """
+        Worker thread: hand the queued messages to paho while connected.
+        """
+        while not self.stopping.is_set():
+            if not self.connected.wait(0.5):
+                continue
+            try:
+                topic, payload, qos, retain = self.publish_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            sent_at = monotonic()
+            # paho calls on_publish while holding its own lock, so this lock is not held while publishing
+            info = self.client.publish(topic, payload=payload, qos=qos, retain=retain)
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                with self.inflight_lock:
+                    self.metrics['published'] += 1
+                    acked_at = self.acked.pop(info.mid, None)
+                    if acked_at is None:
+                        # No latency for QoS 0, they are delivered once written
+                        self.inflight[info.mid] = sent_at if qos > 0 else False
+                        # Do not keep track of messages the broker never acknowledged
+                        if len(self.inflight) > 1000:
+                            self.inflight.pop(next(iter(self.inflight)))
+                    elif qos > 0:
+                        self.metrics['last_latency'] = round(acked_at - sent_at, 3)
+            else:
+                self.metrics['errors'] += 1
+            self.publish_queue.task_done()
+
+    def stats(self):
+        """
+        Return the delivery metrics of this broker.
+        """
+        with self.inflight_lock:
+            return dict(self.metrics, queue_depth=self.publish_queue.qsize(), inflight=len(self.inflight))
 
     def subscribe(self, topic, qos=0):
         """
         Subscribe to a topic.
         """
         if self.log_level >= 3:
-            self.logger.info(f"Subscribing to {topic}")
-        self.client.subscribe(topic, qos=qos)
+            self.logger.info('Subscribing to %s', topic)
+        self.subscriptions[topic] = qos
+        if self.connected.is_set():
+            self.client.subscribe(topic, qos=qos)
+
+    def add_handler(self, topic, handler, qos=0):
+        """
+        Subscribe to a topic filter. Its messages are queued and handled
+        with handler(topic, payload) by dispatch(), in the main loop.
+        """
+        self.handlers[topic] = handler
+        self.subscribe(topic, qos=qos)
 
     def on_message(self, client, userdata, message):
         """
-        Default callback for incoming messages.
+        Default callback for incoming messages: queue them with the handler of their topic.
+        If the inbox is full, the oldest message is dropped.
         """
-        self.last_message = message
+        for topic, handler in list(self.handlers.items()):
+            if mqtt.topic_matches_sub(topic, message.topic):
+                break
+        else:
+            return
+        if self.log_level >= 4:
+            self.logger.debug('Received MQTT message on %s (%s): %s', message.topic, self.name, message.payload)
+        self.metrics['received'] += 1
+        while True:
+            try:
+                self.inbox.put_nowait((handler, message.topic, message.payload))
+                return
+            except queue.Full:
+                try:
+                    self.inbox.get_nowait()
+                except queue.Empty:
+                    pass
 
     def loop_start(self):
         """
         Start the MQTT client loop.
         """
+        self.stopping.clear()
         self.client.loop_start()
+        if self.publisher is None or not self.publisher.is_alive():
+            self.publisher = threading.Thread(target=self._publisher, name=f'mqtt-{self.name}', daemon=True)
+            self.publisher.start()
 
     def loop_stop(self):
         """
         Stop the MQTT client loop.
         """
+        self.stopping.set()
+        if self.publisher is not None:
+            self.publisher.join(1)
         self.client.loop_stop()
 
     def loop(self):
@@ -91,10 +276,16 @@ class MQTTClient:
         """
         self.client.loop()
 
-    def disconnect(self):
+    def disconnect(self, timeout=2):
         """
-        Disconnect from the MQTT broker.
+        Publish what is left in the queue and disconnect from the MQTT broker.
         """
         if self.log_level >= 3:
-            self.logger.info("Disconnecting from MQTT broker")
+            self.logger.info('Disconnecting from MQTT broker %s', self.name)
+        deadline = monotonic() + timeout
+        # Until the publisher has handed the last message to paho, not only taken it from the queue
+        drained = threading.Thread(target=self.publish_queue.join, name=f'mqtt-{self.name}-drain', daemon=True)
+        drained.start()
+        while drained.is_alive() and self.connected.is_set() and monotonic() < deadline:
+            drained.join(min(0.05, max(0, deadline - monotonic())))
         self.client.disconnect()
@@ -0,0 +1,247 @@
+"""
+Helper classes for the readings pipeline.
+
+The rtlamr output goes through a chain of generator stages: each stage takes
+an iterable and yields what the next one needs, so a stage can be inserted
+anywhere without changing the others. The main loop adds its own stages
+(availability, discovery, ...) between the ones defined here:
+
+    identify -> match -> decode -> track -> format -> sinks
+
+A decoded reading is a Reading record with __slots__. The rtlamr message is
+not copied or modified: the meter ID and consumption fields are left out
+when the attributes are serialized. The MQTT payloads are written into a
+reusable buffer instead of building dictionaries for json.dumps.
+"""
+
+from json import loads, dumps
+from json.encoder import encode_basestring_ascii
+import helpers.filtering as flt
+import helpers.read_output as ro
+
+
+ID_KEYS = ( 'EndpointID', 'ID', 'ERTSerialNumber' )
+CONSUMPTION_KEYS = ( 'Consumption', 'LastConsumption', 'LastConsumptionCount' )
+
+
+class Reading:
+    """
+    A meter reading. It can be read like the dictionaries the sinks used to get.
+    """
+    __slots__ = ( 'meter_id', 'protocol', 'consumption', 'reading', 'lastseen', 'time', 'raw', 'skip' )
+    KEYS = ( 'meter_id', 'protocol', 'consumption', 'reading', 'lastseen', 'time', 'message' )
+
+    def __init__(self, meter_id, protocol, consumption, raw, skip=()):
+        """
+        raw: The rtlamr message, shared and never modified
+        skip: The fields of raw that are not attributes (meter ID and consumption)
+        """
+        self.meter_id = meter_id
+        self.protocol = protocol
+        self.consumption = consumption
+        self.reading = consumption
+        self.lastseen = None
+        self.time = None
+        self.raw = raw
+        self.skip = skip
+
+    def items(self):
+        """
+        The attributes of the reading: the message fields and the protocol.
+        """
+        skip = self.skip
+        for key, value in self.raw.items():
+            if key not in skip:
+                yield key, value
+        yield 'protocol', self.protocol
+
+    def message(self):
+        """
+        The attributes as a new dictionary.
+        """
+        return dict(self.items())
+
+    def keys(self):
+        return self.KEYS
+
+    def __getitem__(self, key):
+        if key == 'message':
+            return self.message()
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return f'Reading({self.meter_id}, {self.consumption}, {self.protocol})'
+
+
+class Pipeline:
+    """
+    A chain of named generator stages.
+    """
+    def __init__(self, stages=None):
+        self.stages = list(stages or [])
+
+    def names(self):
+        return [ name for name, _ in self.stages ]
+
+    def insert(self, name, stage, before=None, after=None):
+        """
+        Add a stage, at the end or before/after another one.
+        """
+        names = self.names()
+        if before is not None:
+            index = names.index(before)
+        elif after is not None:
+            index = names.index(after) + 1
+        else:
+            index = len(names)
+        self.stages.insert(index, (name, stage))
+
+    def remove(self, name):
+        self.stages = [ (each, stage) for each, stage in self.stages if each != name ]
+
+    def run(self, items):
+        """
+        Chain the stages over items, returns the iterator of the last one.
+        """
+        for _, stage in self.stages:
+            items = stage(items)
+        return items
+
+
+def identify(lines):
+    """
+    Stage: yield (meter_id, line) for the lines of a meter, the meter ID is found without parsing.
+    """
+    for line in lines:
+        if not line:
+            continue
+        meter_id = flt.line_meter_id(line)
+        if meter_id is not None:
+            yield meter_id, line
+
+def decode(items):
+    """
+    Stage: parse the (meter_id, line) of the watched meters into Readings.
+    """
+    for meter_id, line in items:
+        if isinstance(line, dict):
+            output = line
+        else:
+            try:
+                output = loads(line)
+            except ValueError:
+                continue
+        message = output.get('Message') if isinstance(output, dict) else None
+        if not isinstance(message, dict):
+            continue
+        id_key = consumption_key = None
+        for key in ID_KEYS:
+            if key in message:
+                id_key = key
+                break
+        for key in CONSUMPTION_KEYS:
+            if key in message:
+                consumption_key = key
+                break
+        if id_key is None or consumption_key is None:
+            continue
+        try:
+            consumption = int(message[consumption_key])
+        except (TypeError, ValueError):
+            continue
+        yield Reading(meter_id, output.get('Type'), consumption, message, (id_key, consumption_key))
+
+def formatter(get_meters, timestamp, clock):
+    """
+    Build the format stage: the consumption as configured for the meter, and the time it was read.
+    get_meters: Returns the meters configuration, read for each reading since it can be reloaded
+    timestamp: Returns the lastseen timestamp
+    clock: Returns the time in seconds
+    """
+    def format_readings(readings):
+        for reading in readings:
+            meter = get_meters().get(reading.meter_id, {})
+            if (decimals := meter.get('decimals')):
+                reading.reading = ro.format_number_with_decimals(reading.consumption, decimals)
+            elif (meter_format := meter.get('format')):
+                reading.reading = ro.format_number(reading.consumption, meter_format)
+            reading.lastseen = timestamp()
+            reading.time = clock()
+            yield reading
+    return format_readings
+
+
+class PayloadWriter:
+    """
+    Serialize the MQTT payloads into a buffer that is reused from one payload
+    to the next. Each payload is one bytes copy of the buffer, which paho needs.
+    """
+    def __init__(self, size=1024):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+
+    def _write(self, data):
+        end = self.length + len(data)
+        if end > len(self.buffer):
+            # Grow, the buffer is kept for the next payloads
+            self.view.release()
+            self.buffer.extend(bytes(max(end, 2 * len(self.buffer)) - len(self.buffer)))
+            self.view = memoryview(self.buffer)
+        self.buffer[self.length:end] = data
+        self.length = end
+
+    def _value(self, value, separators=(',', ':')):
+        if isinstance(value, str):
+            self._write(encode_basestring_ascii(value).encode('ascii'))
+        elif value is True:
+            self._write(b'true')
+        elif value is False:
+            self._write(b'false')
+        elif value is None:
+            self._write(b'null')
+        elif isinstance(value, int):
+            self._write(b'%d' % value)
+        else:
+            # Lists, objects and floats, as json.dumps writes them
+            self._write(dumps(value, separators=separators).encode('ascii'))
+
+    def _payload(self):
+        payload = bytes(self.view[:self.length])
+        self.length = 0
+        return payload
+
+    def state(self, reading, lastseen):
+        """
+        The state payload: {"reading": ..., "lastseen": ...}, as json.dumps writes it.
+        """
+        self._write(b'{"reading": ')
+        self._value(reading, (', ', ': '))
+        self._write(b', "lastseen": ')
+        self._value(lastseen, (', ', ': '))
+        self._write(b'}')
+        return self._payload()
+
+    def compact(self, items):
+        """
+        A JSON object of (key, value) pairs without any whitespace.
+        """
+        self._write(b'{')
+        first = True
+        for key, value in items:
+            if not first:
+                self._write(b',')
+            first = False
+            self._value(str(key))
+            self._write(b':')
+            self._value(value)
+        self._write(b'}')
+        return self._payload()
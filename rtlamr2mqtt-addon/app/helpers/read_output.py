@@ -48,8 +48,12 @@ def is_json(test_string):
 
 def read_rtlamr_output(output):
     """
-    Read a line a check if it is valid JSON
+    Read a line a check if it is valid JSON.
+    Messages from the NumPy decoder are already decoded, they are copied
+    because the message is modified by the caller.
     """
+    if isinstance(output, dict):
+        return dict(output, Message=dict(output.get('Message', {})))
     if is_json(output):
         return loads(output)
 
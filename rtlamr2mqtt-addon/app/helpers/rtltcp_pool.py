@@ -0,0 +1,154 @@
+"""
+Helper class for a pool of remote rtl_tcp servers
+"""
+
+import threading
+from time import monotonic
+import helpers.usb_utils as usbutil
+
+
+class RtlTcpPool:
+    """
+    Keep track of the health of a list of rtl_tcp servers and choose the one
+    rtlamr should use. Servers are probed from a background thread, failed
+    servers are probed again with an exponential backoff.
+    """
+    def __init__(self, hosts, logger, probe_interval=30, probe_timeout=2, max_backoff=300, log_level=4):
+        """
+        Initialize the pool. The first host is the active one.
+        """
+        self.hosts = list(hosts)
+        self.logger = logger
+        self.log_level = log_level
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.max_backoff = max_backoff
+        self.active = self.hosts[0]
+        self.health = {
+            host: { 'healthy': None, 'latency': None, 'failures': 0, 'next_probe': 0 }
+            for host in self.hosts
+        }
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Start probing the servers in the background.
+        """
+        self.thread = threading.Thread(target=self._run, name='rtltcp-pool', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop probing the servers.
+        """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(self.probe_timeout + 1)
+
+    def _run(self):
+        """
+        Probe the servers when they are due.
+        """
+        while not self.stopping.is_set():
+            for host in self.hosts:
+                if self.health[host]['next_probe'] <= monotonic():
+                    self.probe(host)
+            self.stopping.wait(1)
+
+    def probe(self, host):
+        """
+        Probe a server and update its health.
+        """
+        latency = usbutil.probe_rtl_tcp(host, timeout=self.probe_timeout)
+        if latency is None:
+            self.mark_failed(host)
+            return False
+        with self.lock:
+            health = self.health[host]
+            if health['healthy'] is False and self.log_level >= 3:
+                self.logger.info('RTL_TCP server %s is back online.', host)
+            health['healthy'] = True
+            health['failures'] = 0
+            # Smooth the latency to avoid flapping between servers
+            if health['latency'] is None:
+                health['latency'] = latency
+            else:
+                health['latency'] = 0.7 * health['latency'] + 0.3 * latency
+            health['next_probe'] = monotonic() + self.probe_interval
+        return True
+
+    def mark_failed(self, host):
+        """
+        Mark a server as failed and schedule the next probe with a backoff.
+        """
+        with self.lock:
+            health = self.health[host]
+            if health['healthy'] is not False and self.log_level >= 2:
+                self.logger.warning('RTL_TCP server %s is not healthy.', host)
+            health['healthy'] = False
+            health['failures'] += 1
+            backoff = min(self.max_backoff, self.probe_interval * (2 ** (health['failures'] - 1)))
+            health['next_probe'] = monotonic() + backoff
+
+    def select(self, exclude=()):
+        """
+        Return the healthy server with the lowest latency, or None.
+        Servers never probed are only used if no server is known to be healthy.
+        exclude: Servers not to return, e.g. already tried
+        """
+        with self.lock:
+            hosts = [ h for h in self.hosts if h not in exclude ]
+            healthy = [ h for h in hosts if self.health[h]['healthy'] ]
+            if healthy:
+                return min(healthy, key=lambda h: self.health[h]['latency'])
+            unknown = [ h for h in hosts if self.health[h]['healthy'] is None ]
+            return unknown[0] if unknown else None
+
+    def candidate(self, tried=()):
+        """
+        Return the next server to try: the active one unless it failed, then the best other
+        server. Servers are only marked as failed by a failed probe or mark_failed().
+        Returns None if every server not tried yet has failed.
+        """
+        if self.active not in tried and self.health[self.active]['healthy'] is not False:
+            return self.active
+        host = self.select(exclude=tried)
+        if host is None:
+            # Every other server failed, probe them again now
+            for each in self.hosts:
+                if each not in tried:
+                    self.probe(each)
+            host = self.select(exclude=tried)
+        return host
+
+    def activate(self, host):
+        """
+        rtlamr is running on this server.
+        """
+        if host != self.active and self.log_level >= 2:
+            self.logger.warning('Failing over from RTL_TCP server %s to %s.', self.active, host)
+        self.active = host
+
+    def active_is_healthy(self):
+        """
+        Check if the last probe of the active server was successful.
+        """
+        return self.health[self.active]['healthy'] is not False
+
+    def stats(self):
+        """
+        Return the health of each server.
+        """
+        with self.lock:
+            return {
+                host: {
+                    'active': host == self.active,
+                    'healthy': health['healthy'],
+                    'latency': None if health['latency'] is None else round(health['latency'], 4),
+                    'failures': health['failures'],
+                }
+                for host, health in self.health.items()
+            }
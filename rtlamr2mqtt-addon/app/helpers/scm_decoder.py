@@ -0,0 +1,427 @@
+"""
+Native SCM and SCM+ decoder, reading IQ samples directly from rtl_tcp.
+
+It replaces the rtlamr process for setups with only SCM/SCM+ meters:
+magnitude, matched filter, preamble search and CRC check are done with
+vectorized NumPy operations on blocks of samples. The decoder runs in a
+thread but looks like a subprocess.Popen to the rest of the code.
+
+NumPy is only needed if this decoder is used.
+
+Benchmark against rtlamr on a recorded IQ file (raw 8 bits IQ, as written
+by rtl_sdr at 32768 * symbol_length samples per second):
+    python -m helpers.scm_decoder recording.iq [symbol_length]
+"""
+
+import os
+import sys
+import queue
+import socket
+import subprocess
+import threading
+from datetime import datetime, timezone
+from shutil import which
+from struct import pack, unpack
+from time import process_time, sleep
+import helpers.usb_utils as usbutil
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# rtl_tcp commands
+SET_FREQUENCY = 0x01
+SET_SAMPLERATE = 0x02
+SET_GAIN_MODE = 0x03
+
+# Chips per second, each bit is Manchester encoded in two chips
+DATA_RATE = 32768
+CENTER_FREQUENCY = 912600155
+
+PROTOCOLS = {
+    'scm': { 'preamble': '111110010101001100000', 'bits': 96 },
+    'scm+': { 'preamble': '0001011010100011', 'bits': 128 },
+}
+
+
+def meter_protocols(meters):
+    """
+    Protocols to decode for the configured meters. Meters without a protocol can be either.
+    """
+    protocols = { str(meter.get('protocol', '')).lower() for meter in meters.values() }
+    return sorted(PROTOCOLS) if not protocols or not protocols <= set(PROTOCOLS) else sorted(protocols)
+
+def is_available():
+    """
+    Check if NumPy is installed.
+    """
+    return np is not None
+
+
+
+def crc16(data, poly, init=0):
+    """
+    Compute a CRC-16 (MSB first, no reflection) over data.
+    """
+    crc = init
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) & 0xFFFF if crc & 0x8000 else (crc << 1) & 0xFFFF
+    return crc
+
+def parse_scm(packet):
+    """
+    Parse a 12 bytes SCM packet. Returns None if the checksum is wrong.
+    """
+    # BCH checksum, computed from the end of the preamble
+    if crc16(packet[2:], 0x6F63) != 0:
+        return None
+    bits = int.from_bytes(packet, 'big')
+    field = lambda start, end: (bits >> (96 - end)) & ((1 << (end - start)) - 1)
+    return {
+        'Type': 'SCM',
+        'Message': {
+            'ID': (field(21, 23) << 24) | field(56, 80),
+            'Type': field(26, 30),
+            'TamperPhy': field(24, 26),
+            'TamperEnc': field(30, 32),
+            'Consumption': field(32, 56),
+            'ChecksumVal': field(80, 96),
+        }
+    }
+
+def parse_scmplus(packet):
+    """
+    Parse a 16 bytes SCM+ packet. Returns None if the CRC is wrong.
+    """
+    # CRC-16/CCITT, the residue of a valid packet is 0x1D0F
+    if crc16(packet[2:], 0x1021, 0xFFFF) != 0x1D0F:
+        return None
+    frame_sync, protocol_id, endpoint_type, endpoint_id, consumption, tamper, packet_crc = unpack('>HBBIIHH', packet)
+    return {
+        'Type': 'SCM+',
+        'Message': {
+            'FrameSync': frame_sync,
+            'ProtocolID': protocol_id,
+            'EndpointType': endpoint_type,
+            'EndpointID': endpoint_id,
+            'Consumption': consumption,
+            'Tamper': tamper,
+            'PacketCRC': packet_crc,
+        }
+    }
+
+PARSERS = { 'scm': parse_scm, 'scm+': parse_scmplus }
+
+
+
+class BlockDecoder:
+    """
+    Decode SCM/SCM+ packets from blocks of raw rtl_tcp samples (8 bits I/Q pairs).
+    The tail of each block is kept, so packets across two blocks are not lost.
+    """
+    def __init__(self, protocols, symbol_length=72):
+        """
+        protocols: List of protocols to decode (scm, scm+)
+        symbol_length: Samples per chip, the sample rate is DATA_RATE * symbol_length
+        """
+        self.chip_length = int(symbol_length)
+        self.bit_length = 2 * self.chip_length
+        self.sample_rate = DATA_RATE * self.chip_length
+        self.protocols = [ p for p in PROTOCOLS if p in protocols ]
+        self.preambles = { p: np.array([ b == '1' for b in PROTOCOLS[p]['preamble'] ]) for p in self.protocols }
+        # Samples needed after the start of the longest packet
+        max_bits = max(PROTOCOLS[p]['bits'] for p in self.protocols)
+        self.packet_span = (max_bits - 1) * self.bit_length + 2 * self.chip_length
+        # Magnitude of every possible (I, Q) pair, indexed by I | Q << 8
+        iq = np.arange(65536, dtype=np.uint16)
+        i = (iq & 0xFF).astype(np.float32) - 127.4
+        q = (iq >> 8).astype(np.float32) - 127.4
+        self.magnitude_lut = np.sqrt(i * i + q * q)
+        self.tail = np.zeros(0, dtype=np.float32)
+        self.stats = { 'samples': 0, 'candidates': 0, 'crc_errors': 0, 'decoded': 0, 'dropped': 0 }
+
+    def decode(self, raw):
+        """
+        Decode a block of raw samples. Returns the list of decoded messages.
+        """
+        samples = np.frombuffer(raw, dtype='<u2', count=len(raw) // 2)
+        self.stats['samples'] += len(samples)
+        magnitude = np.concatenate((self.tail, self.magnitude_lut[samples]))
+        # Number of packet start positions that fit in this block
+        starts = len(magnitude) - self.packet_span + 1
+        if starts <= 0:
+            self.tail = magnitude
+            return []
+        self.tail = magnitude[starts:]
+
+        # Matched filter: sum of the first chip minus sum of the second chip
+        csum = np.empty(len(magnitude) + 1, dtype=np.float64)
+        csum[0] = 0
+        np.cumsum(magnitude, out=csum[1:])
+        c = self.chip_length
+        filtered = 2 * csum[c:-c] - csum[:-2 * c] - csum[2 * c:]
+        bits = filtered > 0
+
+        messages = []
+        for protocol in self.protocols:
+            messages += self._search(bits, starts, protocol)
+        return messages
+
+    def _search(self, bits, starts, protocol):
+        """
+        Search the preamble of a protocol at every start position, then check
+        the CRC of each distinct candidate packet.
+        """
+        preamble = self.preambles[protocol]
+        packet_bits = PROTOCOLS[protocol]['bits']
+        step = self.bit_length
+        match = bits[:starts] == preamble[0]
+        for k in range(1, len(preamble)):
+            match &= bits[k * step:k * step + starts] == preamble[k]
+            if not match.any():
+                return []
+        candidates = np.flatnonzero(match)
+        self.stats['candidates'] += len(candidates)
+        positions = candidates[:, None] + np.arange(packet_bits) * step
+        packets = np.packbits(bits[positions], axis=1)
+        # The same packet is found at several neighbouring sample offsets,
+        # candidates less than one bit apart belong to the same transmission
+        groups = np.concatenate(([0], np.cumsum(np.diff(candidates) > step)))
+        messages = []
+        parsed = {}
+        for group, packet in sorted({ (g, row.tobytes()) for g, row in zip(groups.tolist(), packets) }):
+            if packet not in parsed:
+                parsed[packet] = PARSERS[protocol](packet)
+                if parsed[packet] is None:
+                    self.stats['crc_errors'] += 1
+            elif parsed[packet] is not None:
+                # Every message is a new dictionary, it is modified downstream
+                parsed[packet] = PARSERS[protocol](packet)
+            if parsed[packet] is not None:
+                self.stats['decoded'] += 1
+                messages.append(parsed[packet])
+        return messages
+
+
+
+class _MessageReader:
+    """
+    stdout of the decoder: readline() returns the next message or '',
+    drain() the messages decoded so far, as LineReader.drain() does for rtlamr.
+    """
+    def __init__(self, messages):
+        self.messages = messages
+
+    def readline(self):
+        """
+        Return the next decoded message without blocking, or ''.
+        """
+        try:
+            return self.messages.get_nowait()
+        except queue.Empty:
+            return ''
+
+    def drain(self, limit=100):
+        """
+        Return up to limit messages, from what the decoder has now.
+        """
+        messages = []
+        while len(messages) < limit:
+            try:
+                messages.append(self.messages.get_nowait())
+            except queue.Empty:
+                break
+        return messages
+
+    def close(self):
+        """
+        Nothing to close.
+        """
+
+class NumpyDecoder:
+    """
+    Decode SCM/SCM+ from a rtl_tcp server in a thread.
+    Implements the parts of subprocess.Popen used to manage rtlamr.
+    """
+    def __init__(self, rtltcp_host, protocols, symbol_length=72, block_samples=131072, logger=None, log_level=4):
+        self.rtltcp_host = rtltcp_host
+        self.decoder = BlockDecoder(protocols, symbol_length)
+        self.block_bytes = 2 * int(block_samples)
+        self.logger = logger
+        self.log_level = log_level
+        self.messages = queue.Queue(maxsize=1000)
+        self.stdout = _MessageReader(self.messages)
+        self.returncode = None
+        self.ready = threading.Event()
+        self.stopping = threading.Event()
+        self.conn = None
+        self.thread = threading.Thread(target=self._run, name='numpy-decoder', daemon=True)
+
+    def start(self, timeout=10):
+        """
+        Connect to rtl_tcp and start decoding. Returns False if it failed.
+        """
+        self.thread.start()
+        while not self.ready.wait(0.1):
+            if self.returncode is not None or not self.thread.is_alive():
+                return False
+            timeout -= 0.1
+            if timeout <= 0:
+                self.terminate()
+                return False
+        return True
+
+    def _connect(self):
+        """
+        Connect to rtl_tcp and set the tuner up.
+        """
+        host, port = usbutil.split_host_port(self.rtltcp_host)
+        self.conn = socket.create_connection((host, port), timeout=5)
+        header = self._recv_exactly(12)
+        if header is None or not header.startswith(b'RTL0'):
+            raise ConnectionError('Not a rtl_tcp server')
+        if self.log_level >= 4:
+            self.logger.debug('rtl_tcp tuner type %d, gain count %d', *unpack('>II', header[4:]))
+        for command, parameter in [
+            (SET_SAMPLERATE, self.decoder.sample_rate),
+            (SET_FREQUENCY, CENTER_FREQUENCY),
+            (SET_GAIN_MODE, 0),
+        ]:
+            self.conn.sendall(pack('>BI', command, parameter))
+
+    def _recv_exactly(self, size, buffer=None):
+        """
+        Receive exactly size bytes, None if the connection is closed.
+        """
+        buffer = buffer if buffer is not None else bytearray(size)
+        view = memoryview(buffer)
+        received = 0
+        while received < size:
+            if self.stopping.is_set():
+                return None
+            try:
+                n = self.conn.recv_into(view[received:], size - received)
+            except socket.timeout:
+                continue
+            if n == 0:
+                return None
+            received += n
+        return buffer
+
+    def _run(self):
+        """
+        Decoder thread.
+        """
+        try:
+            self._connect()
+            self.ready.set()
+            buffer = bytearray(self.block_bytes)
+            while not self.stopping.is_set():
+                if self._recv_exactly(self.block_bytes, buffer) is None:
+                    break
+                for message in self.decoder.decode(buffer):
+                    message['Time'] = datetime.now(timezone.utc).isoformat()
+                    try:
+                        self.messages.put_nowait(message)
+                    except queue.Full:
+                        self.decoder.stats['dropped'] += 1
+        except (OSError, ConnectionError) as e:
+            if not self.stopping.is_set() and self.log_level >= 1:
+                self.logger.error('NumPy decoder: %s', e)
+        finally:
+            if self.conn is not None:
+                self.conn.close()
+            self.returncode = -15 if self.stopping.is_set() else 1
+
+    def poll(self):
+        """
+        Return the return code, None while running.
+        """
+        return self.returncode
+
+    def terminate(self):
+        """
+        Ask the decoder thread to stop.
+        """
+        self.stopping.set()
+
+    kill = terminate
+
+    def communicate(self, timeout=None):
+        """
+        Wait for the decoder thread to stop.
+        """
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            raise subprocess.TimeoutExpired('numpy-decoder', timeout)
+        return None, None
+
+
+
+def replay_iq_file(path, port_holder, chunk=262144):
+    """
+    Serve an IQ file to one client, as rtl_tcp would. Used for benchmarks.
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    port_holder.append(server.getsockname()[1])
+    conn, _ = server.accept()
+    conn.sendall(b'RTL0' + pack('>II', 5, 29))
+    with open(path, 'rb') as file:
+        while data := file.read(chunk):
+            conn.sendall(data)
+    conn.close()
+    server.close()
+
+def benchmark(path, symbol_length=72):
+    """
+    Compare the CPU time and decode rate of this decoder and rtlamr on an IQ file.
+    """
+    protocols = list(PROTOCOLS)
+    duration = os.path.getsize(path) / 2 / (DATA_RATE * symbol_length)
+    print(f'IQ file: {path}, {duration:.1f} seconds of samples')
+
+    # NumPy decoder, reading the file directly
+    decoder = BlockDecoder(protocols, symbol_length)
+    start = process_time()
+    decoded = 0
+    with open(path, 'rb') as file:
+        while block := file.read(262144):
+            decoded += len(decoder.decode(block))
+    cpu = process_time() - start
+    print(f'numpy:  {decoded} messages, {cpu:.2f}s CPU, {duration / max(cpu, 1e-9):.1f}x real time')
+
+    # rtlamr, reading the file from a fake rtl_tcp server
+    if which('rtlamr') is None:
+        print('rtlamr: not installed')
+        return
+    port = []
+    server = threading.Thread(target=replay_iq_file, args=(path, port), daemon=True)
+    server.start()
+    while not port:
+        sleep(0.01)
+    before = os.times()
+    rtlamr = subprocess.run(
+        [ which('rtlamr'), f'-server=127.0.0.1:{port[0]}', f'-msgtype={",".join(protocols)}',
+          f'-symbollength={symbol_length}', '-format=json', '-unique=false' ],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=duration * 10 + 30, check=False
+    )
+    after = os.times()
+    cpu = (after.children_user + after.children_system) - (before.children_user + before.children_system)
+    decoded = sum(1 for line in rtlamr.stdout.splitlines() if line.startswith('{'))
+    print(f'rtlamr: {decoded} messages, {cpu:.2f}s CPU, {duration / max(cpu, 1e-9):.1f}x real time')
+
+
+
+if __name__ == '__main__':
+    if np is None:
+        sys.exit('NumPy is not installed.')
+    if len(sys.argv) < 2:
+        sys.exit(f'Usage: {sys.argv[0]} <iq_file> [symbol_length]')
+    benchmark(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 72)
@@ -0,0 +1,348 @@
+"""
+Helper classes for sending readings to the configured outputs (sinks)
+"""
+
+import os
+import csv
+import queue
+import threading
+from io import StringIO
+from json import dumps
+from time import monotonic
+import requests
+import helpers.attributes as attrs
+import helpers.pipeline as pl
+
+
+class Sink:
+    """
+    Base class for an output sink.
+    Readings are queued and written in batches by a worker thread, so a slow
+    or unavailable sink never blocks the main loop. When the queue is full,
+    the oldest reading is dropped.
+    """
+    def __init__(self, name, logger, batch_size=100, flush_interval=5, max_queue=10000, retries=3, retry_backoff=1, log_level=4):
+        """
+        Initialize the sink.
+        """
+        self.name = name
+        self.logger = logger
+        self.log_level = log_level
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = max(0, float(flush_interval))
+        self.retries = max(0, int(retries))
+        self.retry_backoff = max(0, float(retry_backoff))
+        self.queue = queue.Queue(maxsize=max(1, int(max_queue)))
+        self.stats = { 'queued': 0, 'written': 0, 'dropped': 0, 'failed': 0 }
+        self._flush = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'sink-{name}', daemon=True)
+
+    def start(self):
+        """
+        Start the worker thread.
+        """
+        self._thread.start()
+        return self
+
+    def put(self, reading):
+        """
+        Queue a reading without blocking. Drops the oldest reading if the queue is full.
+        """
+        while True:
+            try:
+                self.queue.put_nowait(reading)
+                self.stats['queued'] += 1
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.stats['dropped'] += 1
+                except queue.Empty:
+                    pass
+
+    def flush(self):
+        """
+        Ask the worker to write the current batch now.
+        """
+        self._flush.set()
+
+    def stop(self, timeout=5):
+        """
+        Write what is left in the queue and stop the worker thread.
+        """
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        self.close()
+
+    def _next_batch(self):
+        """
+        Wait for the first reading, then collect more until the batch is
+        full or the flush interval has passed.
+        """
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=0.5))
+        except queue.Empty:
+            return batch
+        deadline = monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and not self._stop.is_set():
+            if self._flush.is_set():
+                self._flush.clear()
+                break
+            timeout = deadline - monotonic()
+            try:
+                if timeout <= 0:
+                    batch.append(self.queue.get_nowait())
+                else:
+                    batch.append(self.queue.get(timeout=min(timeout, 0.5)))
+            except queue.Empty:
+                if timeout <= 0:
+                    break
+        return batch
+
+    def _run(self):
+        """
+        Worker thread main loop.
+        """
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if batch:
+                self._write_with_retry(batch)
+        # Drain the queue before leaving
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= self.batch_size:
+                self._write_with_retry(batch)
+                batch = []
+        if batch:
+            self._write_with_retry(batch)
+
+    def _write_with_retry(self, batch):
+        """
+        Write a batch, retrying with an exponential backoff.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                self.write(batch)
+                self.stats['written'] += len(batch)
+                return
+            except Exception as e:
+                if self.log_level >= 2:
+                    self.logger.warning('Sink %s failed to write %d reading(s) (attempt %d): %s',
+                        self.name, len(batch), attempt + 1, e)
+                # Do not keep retrying when shutting down
+                if attempt < self.retries and self._stop.wait(self.retry_backoff * (2 ** attempt)):
+                    break
+        self.stats['failed'] += len(batch)
+
+    def write(self, batch):
+        """
+        Write a batch of readings. Must be implemented by each sink.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Release any resource held by the sink.
+        """
+
+    def update_config(self, config):
+        """
+        Apply a reloaded configuration.
+        """
+
+
+
+class MQTTSink(Sink):
+    """
+    Publish readings to the MQTT broker, as expected by Home Assistant.
+    The attributes follow the attribute policy of each meter.
+    """
+    def __init__(self, mqtt_client, meters, **kwargs):
+        kwargs.setdefault('batch_size', 50)
+        kwargs.setdefault('flush_interval', 0)
+        super().__init__(name=f'mqtt-{mqtt_client.name}', **kwargs)
+        self.mqtt_client = mqtt_client
+        self.base_topic = mqtt_client.base_topic
+        self.attribute_policies = attrs.build_policies(meters)
+        # Last attributes payload published for each meter: (payload, time)
+        self.attributes_sent = {}
+        # State and attributes topics of each meter
+        self.topics = {}
+        self.writer = pl.PayloadWriter()
+
+    def update_config(self, config):
+        self.attribute_policies = attrs.build_policies(config['meters'])
+
+    def write(self, batch):
+        # First, make sure the status is set to online
+        self.mqtt_client.publish(
+            topic=f'{self.base_topic}/status',
+            payload='online',
+            retain=False
+        )
+        for topic, payload in self.serialize(batch):
+            self.mqtt_client.publish(topic=topic, payload=payload, retain=False)
+
+    def serialize(self, batch):
+        """
+        Yield the (topic, payload) of each reading: its state, then its attributes if the policy allows it.
+        """
+        for reading in batch:
+            meter_id = reading['meter_id']
+            topics = self.topics.get(meter_id)
+            if topics is None:
+                topics = self.topics[meter_id] = (f'{self.base_topic}/{meter_id}/state', f'{self.base_topic}/{meter_id}/attributes')
+            yield topics[0], self.writer.state(reading['reading'], reading['lastseen'])
+            # Readings shared by the other nodes of a cluster are dictionaries
+            items = reading.items() if isinstance(reading, pl.Reading) else reading['message'].items()
+            policy = self.attribute_policies.get(meter_id, attrs.DEFAULT_POLICY)
+            attributes = self.writer.compact(policy.select(items))
+            if policy.should_publish(attributes, self.attributes_sent.get(meter_id), reading['time']):
+                self.attributes_sent[meter_id] = (attributes, reading['time'])
+                yield topics[1], attributes
+
+
+
+def escape_line_protocol(value):
+    """
+    Escape a tag key/value for the InfluxDB line protocol.
+    """
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+def to_line_protocol(measurement, reading):
+    """
+    Convert a reading to a line of the InfluxDB line protocol.
+    """
+    tags = f'meter_id={escape_line_protocol(reading["meter_id"])}'
+    if reading.get('protocol'):
+        tags += f',protocol={escape_line_protocol(reading["protocol"])}'
+    fields = f'consumption={int(reading["consumption"])}i'
+    try:
+        fields += f',reading={float(reading["reading"])}'
+    except (TypeError, ValueError):
+        pass
+    return f'{escape_line_protocol(measurement)},{tags} {fields} {int(reading["time"] * 1e9)}'
+
+class InfluxDBSink(Sink):
+    """
+    Write readings to InfluxDB using the line protocol over HTTP.
+    Uses the v2 API if a bucket is configured, the v1 API otherwise.
+    """
+    def __init__(self, url, measurement='rtlamr', database=None, bucket=None, org=None, token=None, username=None, password=None, timeout=10, name='influxdb', **kwargs):
+        super().__init__(name=name, **kwargs)
+        self.measurement = measurement
+        self.timeout = timeout
+        self.session = requests.Session()
+        if bucket is not None:
+            self.url = f'{url.rstrip("/")}/api/v2/write'
+            self.params = { 'bucket': bucket, 'org': org or '', 'precision': 'ns' }
+            if token is not None:
+                self.session.headers['Authorization'] = f'Token {token}'
+        else:
+            self.url = f'{url.rstrip("/")}/write'
+            self.params = { 'db': database or 'rtlamr', 'precision': 'ns' }
+            if username is not None:
+                self.session.auth = (username, password or '')
+
+    def write(self, batch):
+        body = '\n'.join(to_line_protocol(self.measurement, reading) for reading in batch)
+        resp = self.session.post(self.url, params=self.params, data=body.encode('utf-8'), timeout=self.timeout)
+        resp.raise_for_status()
+
+    def close(self):
+        self.session.close()
+
+
+
+class FileSink(Sink):
+    """
+    Append readings to a CSV or NDJSON file, rotated by size.
+    """
+    csv_fields = [ 'lastseen', 'meter_id', 'protocol', 'consumption', 'reading' ]
+
+    def __init__(self, path, file_format='ndjson', max_bytes=10485760, backup_count=5, name='file', **kwargs):
+        super().__init__(name=name, **kwargs)
+        self.path = path
+        self.file_format = file_format
+        self.max_bytes = int(max_bytes)
+        self.backup_count = int(backup_count)
+
+    def _rotate(self):
+        """
+        Rotate the file: path -> path.1 -> path.2 ...
+        """
+        for n in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{n}'):
+                os.replace(f'{self.path}.{n}', f'{self.path}.{n + 1}')
+        if self.backup_count > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+
+    def _format(self, batch, header):
+        """
+        Format a batch of readings as CSV or NDJSON.
+        """
+        if self.file_format == 'csv':
+            out = StringIO()
+            writer = csv.DictWriter(out, fieldnames=self.csv_fields, extrasaction='ignore')
+            if header:
+                writer.writeheader()
+            writer.writerows(batch)
+            return out.getvalue()
+        return ''.join(dumps(dict(reading)) + '\n' for reading in batch)
+
+    def write(self, batch):
+        if self.max_bytes > 0 and os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            self._rotate()
+        header = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'a', encoding='utf-8', newline='') as file:
+            file.write(self._format(batch, header))
+
+
+
+class WebhookSink(Sink):
+    """
+    POST readings as a JSON list to a HTTP endpoint.
+    """
+    def __init__(self, url, headers=None, timeout=10, name='webhook', **kwargs):
+        super().__init__(name=name, **kwargs)
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+
+    def write(self, batch):
+        resp = self.session.post(self.url, json=[ dict(reading) for reading in batch ], timeout=self.timeout)
+        resp.raise_for_status()
+
+    def close(self):
+        self.session.close()
+
+
+
+def build_sinks(config, mqtt_clients, logger, log_level=4):
+    """
+    Create and start the sinks from the configuration.
+    There is always one MQTT sink per broker.
+    """
+    sinks = [
+        MQTTSink(mqtt_client, config['meters'], logger=logger, log_level=log_level).start()
+        for mqtt_client in mqtt_clients
+    ]
+    sink_classes = {
+        'influxdb': InfluxDBSink,
+        'file': FileSink,
+        'webhook': WebhookSink,
+    }
+    for sink_config in config['sinks']:
+        kwargs = { key: value for key, value in sink_config.items() if key != 'type' }
+        sinks.append(sink_classes[sink_config['type']](logger=logger, log_level=log_level, **kwargs).start())
+    return sinks
@@ -0,0 +1,190 @@
+"""
+Helper class to notice when meters stop being heard.
+
+The next expected transmission of each meter is kept in a heap. A reading
+pushes a new deadline and makes the older ones of the meter obsolete: they
+are skipped when they reach the top of the heap, so a reading costs
+O(log n) whatever the number of meters. Each deadline that passes is a
+missed reading, and a meter missing too many in a row is unavailable.
+
+rtlamr -unique only prints a meter when its message changes, so the
+expected interval of each meter is learned from the time between its
+readings, and never shorter than its transmit_interval. With -unique, a
+meter reading the same value is silent: it is given unique_interval.
+"""
+
+import heapq
+from time import monotonic
+
+
+class StalenessTracker:
+    """
+    Track the availability and the missed readings of the watched meters.
+    """
+    def __init__(self, meters, missed_limit=3, default_interval=30, unique=False, unique_interval=3600, now=None):
+        """
+        meters: { meter_id: meter configuration }, transmit_interval is used if set
+        missed_limit: Missed readings in a row before a meter is unavailable
+        default_interval: Seconds between two transmissions if the meter does not set it
+        unique: The decoder only prints a meter when its message changes (rtlamr -unique)
+        unique_interval: Shortest interval of the meters when unique is set
+        """
+        self.missed_limit = missed_limit
+        self.default_interval = default_interval
+        self.unique = unique
+        self.unique_interval = unique_interval
+        self.heap = []
+        self.meters = {}
+        # Number of unavailable meters, checked every second by the watchdog
+        self.unavailable = 0
+        self.paused_at = None
+        self.update_meters(meters, now)
+
+    def update_meters(self, meters, now=None):
+        """
+        Watch a new set of meters, keeping the state of the ones already watched.
+        """
+        now = monotonic() if now is None else now
+        for meter_id in list(self.meters):
+            if meter_id not in meters:
+                # Its heap entries become obsolete
+                if not self.meters.pop(meter_id)['available']:
+                    self.unavailable -= 1
+        for meter_id, meter in meters.items():
+            base = int(meter.get('transmit_interval', self.default_interval))
+            if self.unique:
+                # Its transmissions with the same value are not printed
+                base = max(base, self.unique_interval)
+            if meter_id in self.meters:
+                self.meters[meter_id]['base'] = base
+                continue
+            # Watched from now on, as if it had just been heard
+            self.meters[meter_id] = {
+                'base': base,
+                'learned': None,
+                'last_seen': now,
+                'heard': False,
+                'missed': 0,
+                'missed_total': 0,
+                'available': True,
+                'generation': 0,
+            }
+            self._schedule(meter_id, now)
+
+    def interval(self, meter_id):
+        """
+        Expected seconds between two readings of a meter.
+        """
+        state = self.meters[meter_id]
+        return max(state['base'], state['learned'] or 0)
+
+    def _schedule(self, meter_id, now):
+        """
+        Push the next deadline of a meter, the previous one becomes obsolete.
+        """
+        state = self.meters[meter_id]
+        state['generation'] += 1
+        heapq.heappush(self.heap, (now + self.interval(meter_id), meter_id, state['generation']))
+        # Readings leave obsolete entries behind, drop them once they outnumber the meters
+        if len(self.heap) > 4 * len(self.meters) + 64:
+            self.heap = [ entry for entry in self.heap if entry[1] in self.meters and entry[2] == self.meters[entry[1]]['generation'] ]
+            heapq.heapify(self.heap)
+
+    def on_reading(self, meter_id, now=None):
+        """
+        A watched meter has been heard.
+        Returns True if it was unavailable and is available again.
+        """
+        state = self.meters.get(meter_id)
+        if state is None:
+            return False
+        now = monotonic() if now is None else now
+        if state['heard']:
+            # Smooth the time between readings
+            gap = now - state['last_seen']
+            state['learned'] = gap if state['learned'] is None else 0.7 * state['learned'] + 0.3 * gap
+        state['heard'] = True
+        state['last_seen'] = now
+        state['missed'] = 0
+        recovered = not state['available']
+        if recovered:
+            self.unavailable -= 1
+        state['available'] = True
+        self._schedule(meter_id, now)
+        return recovered
+
+    def expire(self, now=None):
+        """
+        Count the readings missed up to now.
+        Returns the meters that have just become unavailable.
+        """
+        now = monotonic() if now is None else now
+        if self.paused_at is not None:
+            return []
+        unavailable = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, meter_id, generation = heapq.heappop(self.heap)
+            state = self.meters.get(meter_id)
+            if state is None or generation != state['generation']:
+                continue
+            state['missed'] += 1
+            state['missed_total'] += 1
+            if state['available'] and self.missed_limit > 0 and state['missed'] >= self.missed_limit:
+                state['available'] = False
+                self.unavailable += 1
+                unavailable.append(meter_id)
+            # The next transmission was expected one interval after the missed one
+            self._schedule(meter_id, deadline)
+        return unavailable
+
+    def pause(self, now=None):
+        """
+        Stop counting missed readings, while the receiver is stopped on purpose.
+        """
+        if self.paused_at is None:
+            self.paused_at = monotonic() if now is None else now
+
+    def resume(self, now=None):
+        """
+        Count missed readings again, the deadlines are moved by the time spent paused.
+        """
+        if self.paused_at is None:
+            return
+        now = monotonic() if now is None else now
+        paused = now - self.paused_at
+        self.paused_at = None
+        self.heap = [
+            (deadline + paused, meter_id, generation) for deadline, meter_id, generation in self.heap
+            if meter_id in self.meters and generation == self.meters[meter_id]['generation']
+        ]
+        heapq.heapify(self.heap)
+        for state in self.meters.values():
+            state['last_seen'] += paused
+
+    def all_unavailable(self):
+        """
+        Check if no watched meter is available.
+        """
+        return bool(self.meters) and self.unavailable == len(self.meters)
+
+    def longest_interval(self):
+        """
+        The longest expected interval of the watched meters, in seconds.
+        """
+        return max((self.interval(meter_id) for meter_id in self.meters), default=self.default_interval)
+
+    def stats(self, now=None):
+        """
+        Return the state of each watched meter.
+        """
+        now = monotonic() if now is None else now
+        return {
+            meter_id: {
+                'available': state['available'],
+                'missed': state['missed'],
+                'missed_total': state['missed_total'],
+                'interval': round(self.interval(meter_id)),
+                'last_seen': round(now - state['last_seen']) if state['heard'] else None,
+            }
+            for meter_id, state in self.meters.items()
+        }
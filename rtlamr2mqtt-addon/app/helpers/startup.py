@@ -0,0 +1,90 @@
+"""
+Helper class to run the startup phases in parallel and time them.
+
+The receiver does not need the broker: rtl_tcp and the decoder are started
+in the background while the broker is looked up from the Supervisor and
+connected. The readings wait in the MQTT queues until the broker is ready.
+"""
+
+import threading
+from time import monotonic
+
+
+class Startup:
+    """
+    Background startup phases and the time taken by each phase.
+    """
+    def __init__(self, logger, log_level=4):
+        self.logger = logger
+        self.log_level = log_level
+        self.started = monotonic()
+        # Seconds taken by each phase
+        self.timings = {}
+        # Seconds from the start until the phase was done
+        self.done_at = {}
+        self.threads = {}
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def mark(self, phase, since):
+        """
+        Record a phase started at since (monotonic) and done now.
+        """
+        now = monotonic()
+        with self.lock:
+            self.timings[phase] = round(now - since, 3)
+            self.done_at[phase] = round(now - self.started, 3)
+
+    def once(self, phase):
+        """
+        Record the first time something happens, e.g. the first reading.
+        Returns True the first time.
+        """
+        with self.lock:
+            if phase in self.done_at:
+                return False
+            self.done_at[phase] = round(monotonic() - self.started, 3)
+        return True
+
+    def run(self, phase, target, *args, default=None, **kwargs):
+        """
+        Run a phase in a thread, its result is read with result().
+        default is the result if it raises an exception.
+        """
+        def runner():
+            start = monotonic()
+            try:
+                self.results[phase] = target(*args, **kwargs)
+            except Exception as e:
+                if self.log_level >= 1:
+                    self.logger.error('Startup phase %s failed: %s', phase, e)
+                self.results[phase] = default
+            self.mark(phase, start)
+        thread = threading.Thread(target=runner, name=f'startup-{phase}', daemon=True)
+        self.threads[phase] = thread
+        thread.start()
+
+    def running(self, phase):
+        """
+        Check if a phase is still running.
+        """
+        thread = self.threads.get(phase)
+        return thread is not None and thread.is_alive()
+
+    def result(self, phase, timeout=None):
+        """
+        Wait for a phase and return its result, None if it is still running after timeout.
+        """
+        thread = self.threads.get(phase)
+        if thread is not None:
+            thread.join(timeout)
+            if thread.is_alive():
+                return None
+        return self.results.get(phase)
+
+    def stats(self):
+        """
+        Return the time taken by each phase and when it was done, in seconds.
+        """
+        with self.lock:
+            return { 'phases': dict(self.timings), 'done_at': dict(self.done_at) }
@@ -6,7 +6,7 @@ from fcntl import ioctl
 from stat import S_ISCHR
 from random import randrange
 from struct import pack
-from time import sleep
+from time import sleep, monotonic
 import os
 import re
 import usb.core
@@ -24,21 +24,127 @@ def load_id_file(sdl_ids_file):
                 device_ids.append(line.rstrip().lstrip().lower())
     return device_ids
 
-def find_rtl_sdr_devices():
+SYSFS_USB_DEVICES = '/sys/bus/usb/devices'
+KNOWN_DEVICE_IDS = None
+
+def known_device_ids():
+    """
+    Load the supported (vendor id, product id) pairs, only once
     """
-    Find a valid RTL device
+    global KNOWN_DEVICE_IDS
+    if KNOWN_DEVICE_IDS is None:
+        sdl_file_path = os.path.join(os.path.dirname(__file__), 'sdl_ids.txt')
+        KNOWN_DEVICE_IDS = {
+            tuple(int(part, 16) for part in device_id.split(':'))
+            for device_id in load_id_file(sdl_file_path)
+        }
+    return KNOWN_DEVICE_IDS
+
+def read_sysfs_attribute(path, name):
     """
-    # Load the list of all supported device ids
-    sdl_file_path = os.path.join(os.path.dirname(__file__), 'sdl_ids.txt')
-    DEVICE_IDS = load_id_file(sdl_file_path)
+    Read an attribute file of a sysfs device
+    """
+    with open(os.path.join(path, name), 'r', encoding='utf-8') as f:
+        return f.read().strip()
+
+def list_rtl_sdr_devices(sysfs_root=SYSFS_USB_DEVICES):
+    """
+    Find the valid RTL devices, sorted by "bus:device" id.
+    Each device is a dictionary with its id, its vendor:product (usb_id), the
+    port it is plugged in (e.g. 1-1.2) and its serial number, None if unknown.
+    The devices are read from sysfs, pyusb is only used if sysfs is not available.
+    """
+    known_ids = known_device_ids()
+    if not os.path.isdir(sysfs_root):
+        return sorted((
+            {
+                'id': f'{dev.bus:03d}:{dev.address:03d}',
+                'usb_id': f'{dev.idVendor:04x}:{dev.idProduct:04x}',
+                'port': f'{dev.bus}-' + '.'.join(str(port) for port in dev.port_numbers or []),
+                'serial': None,
+            }
+            for dev in usb.core.find(find_all = True)
+            if (dev.idVendor, dev.idProduct) in known_ids
+        ), key=lambda device: device['id'])
     devices_found = []
-    for dev in usb.core.find(find_all = True):
-        for known_dev in DEVICE_IDS:
-            usb_id, usb_vendor = known_dev.split(':')
-            if dev.idVendor == int(usb_id, 16) and dev.idProduct == int(usb_vendor, 16):
-                devices_found.append(f'{dev.bus:03d}:{dev.address:03d}')
-                break
-    return devices_found
+    for entry in os.listdir(sysfs_root):
+        # Skip the interfaces (1-1:1.0), only devices have the ids
+        if ':' in entry:
+            continue
+        path = os.path.join(sysfs_root, entry)
+        try:
+            vendor_id = int(read_sysfs_attribute(path, 'idVendor'), 16)
+            product_id = int(read_sysfs_attribute(path, 'idProduct'), 16)
+            if (vendor_id, product_id) not in known_ids:
+                continue
+            busnum = int(read_sysfs_attribute(path, 'busnum'))
+            devnum = int(read_sysfs_attribute(path, 'devnum'))
+        except (OSError, ValueError):
+            # Not a device, or it is being removed
+            continue
+        try:
+            serial = read_sysfs_attribute(path, 'serial') or None
+        except OSError:
+            serial = None
+        devices_found.append({
+            'id': f'{busnum:03d}:{devnum:03d}',
+            'usb_id': f'{vendor_id:04x}:{product_id:04x}',
+            'port': entry,
+            'serial': serial,
+        })
+    return sorted(devices_found, key=lambda device: device['id'])
+
+def find_rtl_sdr_devices(sysfs_root=SYSFS_USB_DEVICES):
+    """
+    Find the valid RTL devices, as a sorted list of "bus:device" ids.
+    """
+    return [ device['id'] for device in list_rtl_sdr_devices(sysfs_root) ]
+
+def same_device(device, known, devices):
+    """
+    Check if device is the known device, maybe plugged in again with a new "bus:device" id:
+    same serial number if no other device has it, otherwise same vendor:product on the same port.
+    """
+    if device['usb_id'] != known['usb_id']:
+        return False
+    serial = known['serial']
+    if serial and sum(1 for other in devices if other['serial'] == serial) == 1:
+        return device['serial'] == serial
+    return device['port'] == known['port']
+
+def shared_serials(devices):
+    """
+    Serial numbers of more than one device, many dongles have 00000001.
+    """
+    serials = [ device['serial'] for device in devices ]
+    return { serial for serial in serials if serials.count(serial) > 1 }
+
+def match_device(device_id, devices, identities):
+    """
+    Find the configured device among the devices plugged in (see list_rtl_sdr_devices).
+    Returns its current "bus:device" id, None if it is not plugged in.
+    device_id is '0' for the first device, "serial:<serial number>" or a "bus:device" id.
+    The device first seen with a "bus:device" id is remembered in identities, to find it
+    again once plugged back in.
+    """
+    if not devices:
+        return None
+    if device_id == '0':
+        return devices[0]['id']
+    if device_id.startswith('serial:'):
+        serial = device_id[len('serial:'):]
+        return next((device['id'] for device in devices if device['serial'] == serial), None)
+    if device_id not in identities:
+        # A serial number shared with another device does not identify it
+        shared = shared_serials(devices)
+        identities.update({
+            device['id']: dict(device, serial=None if device['serial'] in shared else device['serial'])
+            for device in devices if device['id'] == device_id
+        })
+    known = identities.get(device_id)
+    if known is None:
+        return None
+    return next((device['id'] for device in devices if same_device(device, known, devices)), None)
 
 def reset_usb_device(usbdev):
     """
@@ -56,6 +162,15 @@ def reset_usb_device(usbdev):
             return result
     return False
 
+def split_host_port(remote_server):
+    """
+    Extract host and port from a "host:port" string
+    """
+    parts = remote_server.split(':', 1)
+    remote_host = parts[0]
+    remote_port = int(parts[1]) if parts[1:] else 1234
+    return remote_host, remote_port
+
 def tickle_rtl_tcp(remote_server):
     """
     Connect to rtl_tcp and change some tuner settings. This has proven to
@@ -65,9 +180,7 @@ def tickle_rtl_tcp(remote_server):
     SET_SAMPLERATE = 0x02
 
     # extract host and port from remote_server string
-    parts = remote_server.split(':', 1)
-    remote_host = parts[0]
-    remote_port = int(parts[1]) if parts[1:] else 1234
+    remote_host, remote_port = split_host_port(remote_server)
     conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     conn.settimeout(5) # 5 seconds
     send_cmd = lambda c, command, parameter: c.send(pack(">BI", int(command), int(parameter)))
@@ -78,4 +191,31 @@ def tickle_rtl_tcp(remote_server):
         send_cmd(conn, SET_SAMPLERATE, 2048000)
     except socket.error as err:
         pass
-    conn.close()
\ No newline at end of file
+    conn.close()
+
+def probe_rtl_tcp(remote_server, timeout=2):
+    """
+    Check if a rtl_tcp server is alive.
+    Returns the connection latency in seconds, or None if the server is not healthy.
+    rtl_tcp serves one client at a time, so a server busy with another client
+    accepts the TCP connection but does not send its "RTL0" header.
+    """
+    remote_host, remote_port = split_host_port(remote_server)
+    conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    try:
+        start = monotonic()
+        conn.connect((remote_host, remote_port))
+        latency = monotonic() - start
+        conn.settimeout(min(timeout, 0.5))
+        try:
+            header = conn.recv(12)
+            if not header.startswith(b'RTL0'):
+                # Connection closed or something else is listening on this port
+                latency = None
+        except socket.timeout:
+            pass
+    except (socket.error, OSError):
+        latency = None
+    conn.close()
+    return latency
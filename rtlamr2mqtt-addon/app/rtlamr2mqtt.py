@@ -14,9 +14,12 @@ import sys
 import logging
 import subprocess
 import signal
+import queue
+import threading
 from datetime import datetime
-from json import dumps
-from time import sleep
+from json import dumps, loads
+from functools import partial
+from time import sleep, time, monotonic
 from shutil import which
 import helpers.config as cnf
 import helpers.buildcmd as cmd
@@ -25,17 +28,52 @@ import helpers.ha_messages as ha_msgs
 import helpers.read_output as ro
 import helpers.usb_utils as usbutil
 import helpers.info as i
-
-
-# Set up logging
+import helpers.sinks as snk
+import helpers.rtltcp_pool as pool
+import helpers.cluster as clst
+import helpers.scm_decoder as scm
+import helpers.hopping as hop
+import helpers.hotplug as hotplug
+import helpers.logs as logs
+import helpers.autotune as tune
+import helpers.gain as gn
+import helpers.staleness as stale
+import helpers.filtering as flt
+import helpers.startup as su
+import helpers.pipeline as pl
+import helpers.linereader as lr
+
+
+# Set up logging, records are written from a background thread
 logger = logging.getLogger(__name__)
-logging.basicConfig(format='[%(asctime)s] %(levelname)s:%(message)s', level=logging.DEBUG)
+LOG_SAMPLING = logs.setup_logging(verbosity='debug')
 LOG_LEVEL = 0
+RELOAD_REQUESTED = False
+# Set on shutdown, rtl_tcp and rtlamr stop waiting to be ready
+STOPPING = threading.Event()
+# Seconds to wait for rtl_tcp and rtlamr to be ready, and for the warm-up to give up on shutdown
+RTLTCP_START_TIMEOUT = 30
+RTLAMR_START_TIMEOUT = 30
+WARM_UP_STOP_TIMEOUT = 5
+# Lines read from the children, kept when they are restarted
+PIPE_STATS = { 'rtl_tcp': lr.new_stats(), 'rtlamr': lr.new_stats() }
 logger.info('Starting rtlamr2mqtt %s', i.version())
 
 
 
-def shutdown(rtlamr=None, rtltcp=None, mqtt_client=None, base_topic='rtlamr', offline=False):
+def stop_process(process):
+    """ Terminate a child process, kill it if it does not exit """
+    process.stdout.close()
+    process.terminate()
+    try:
+        process.communicate(timeout=1)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+
+
+
+def shutdown(rtlamr=None, rtltcp=None, mqtt_clients=None, offline=False, sinks=None):
     """ Shutdown function to terminate processes and clean up """
     if LOG_LEVEL >= 3:
         logger.info('Shutting down...')
@@ -43,37 +81,29 @@ def shutdown(rtlamr=None, rtltcp=None, mqtt_client=None, base_topic='rtlamr', of
     if rtlamr is not None:
         if LOG_LEVEL >= 3:
             logger.info('Terminating RTLAMR...')
-        rtlamr.stdout.close()
-        rtlamr.terminate()
-        try:
-            rtlamr.communicate(timeout=1)
-        except subprocess.TimeoutExpired:
-            rtlamr.kill()
-            rtlamr.communicate()
+        stop_process(rtlamr)
         if LOG_LEVEL >= 3:
             logger.info('RTLAMR Terminated.')
     # Terminate RTL_TCP
     if rtltcp not in [None, 'remote']:
         if LOG_LEVEL >= 3:
             logger.info('Terminating RTL_TCP...')
-        rtltcp.stdout.close()
-        rtltcp.terminate()
-        try:
-            rtltcp.communicate(timeout=1)
-        except subprocess.TimeoutExpired:
-            rtltcp.kill()
-            rtltcp.communicate()
+        stop_process(rtltcp)
         if LOG_LEVEL >= 3:
             logger.info('RTL_TCP Terminated.')
-    if mqtt_client is not None and offline:
-        mqtt_client.publish(
-            topic=f'{base_topic}/status',
-            payload='offline',
-            qos=1,
-            retain=False
-        )
-        mqtt_client.loop_stop()
-        mqtt_client.disconnect()
+    # Write pending readings before going offline
+    if sinks is not None:
+        for sink in sinks:
+            sink.stop()
+    if mqtt_clients is not None and offline:
+        for mqtt_client in mqtt_clients:
+            mqtt_client.publish(
+                topic=f'{mqtt_client.base_topic}/status',
+                payload='offline',
+                retain=False
+            )
+            mqtt_client.disconnect()
+            mqtt_client.loop_stop()
     if LOG_LEVEL >= 3:
         logger.info('All done. Bye!')
 
@@ -85,6 +115,13 @@ def signal_handler(signum, frame):
 
 
 
+def reload_handler(signum, frame):
+    """ Signal handler for SIGHUP, the reload happens in the main loop """
+    global RELOAD_REQUESTED
+    RELOAD_REQUESTED = True
+
+
+
 def get_iso8601_timestamp():
     """
     Get the current timestamp in ISO 8601 format
@@ -93,10 +130,186 @@ def get_iso8601_timestamp():
 
 
 
-def start_rtltcp(config):
-    """ Start RTL_TCP process """
+def is_remote_rtltcp(config):
+    """ Check if rtl_tcp is configured to run on a remote host """
+    return config["general"]["rtltcp_host"].split(':')[0] not in [ '127.0.0.1', 'localhost' ]
+
+
+
+def publish_discovery(mqtt_client, broker, meters, meter_ids):
+    """ Publish the Home Assistant discovery message for each meter id """
+    for meter in meter_ids:
+        discovery_payload = ha_msgs.meter_discover_payload(broker["base_topic"], meters[meter])
+        mqtt_client.publish(
+            topic=f'{broker["ha_autodiscovery_topic"]}/device/{meter}/config',
+            payload=dumps(discovery_payload),
+            retain=False
+        )
+
+
+
+def publish_broker_stats(mqtt_clients):
+    """ Publish the delivery metrics of all brokers to each broker """
+    stats = { mqtt_client.name: mqtt_client.stats() for mqtt_client in mqtt_clients }
+    if LOG_LEVEL >= 4:
+        logger.debug('MQTT brokers: %s', stats)
+    for mqtt_client in mqtt_clients:
+        mqtt_client.publish(
+            topic=f'{mqtt_client.base_topic}/brokers',
+            payload=dumps(stats),
+            qos=0,
+            retain=False
+        )
+
+
+
+def parse_command(payload):
+    """
+    Parse a message of the command topic, either text: "read 12345678"
+    or JSON: {"command": "read", "meter_id": "12345678"}.
+    Returns (command, [ arguments ]), command is None if the message is empty or invalid.
+    """
+    text = payload.decode(errors='replace').strip() if isinstance(payload, bytes) else str(payload).strip()
+    if text.startswith('{'):
+        try:
+            message = loads(text)
+        except ValueError:
+            return None, []
+        meter_ids = message.get('meter_id', message.get('meter_ids'))
+        if meter_ids is None:
+            meter_ids = []
+        elif not isinstance(meter_ids, list):
+            meter_ids = [ meter_ids ]
+        return str(message.get('command') or '').lower() or None, [ str(meter_id) for meter_id in meter_ids ]
+    words = text.split()
+    if not words:
+        return None, []
+    return words[0].lower(), words[1:]
+
+
+
+def create_mqtt_client(broker, inbox=None):
+    """
+    Create the MQTT client for a broker and start connecting to it.
+    The connection happens in the background, messages are queued meanwhile.
+    Incoming messages are queued to inbox.
+    """
+    mqtt_client = m.MQTTClient(
+        broker=broker['host'],
+        port=broker['port'],
+        username=broker['user'],
+        password=broker['password'],
+        tls_enabled=broker['tls_enabled'],
+        tls_insecure=broker['tls_insecure'],
+        ca_cert=broker['tls_ca'],
+        client_cert=broker['tls_cert'],
+        client_key=broker['tls_keyfile'],
+        log_level=LOG_LEVEL,
+        logger=logger,
+        name=broker['name'],
+        base_topic=broker['base_topic'],
+        qos=broker['qos'],
+        inbox=inbox,
+    )
+
+    # Set Last Will and Testament
+    mqtt_client.set_last_will(
+        topic=f'{broker["base_topic"]}/status',
+        payload="offline",
+        qos=broker['qos'],
+        retain=False
+    )
+
+    mqtt_client.connect()
+    # Start the MQTT client loop
+    mqtt_client.loop_start()
+    return mqtt_client
+
+
+
+def reload_config(config_path, config, mqtt_clients, meter_ids_list, rtlamr, rtltcp, sinks):
+    """
+    Reload the configuration file and apply only what has changed.
+    Formatting and discovery changes are applied in place, rtlamr is restarted
+    only if its command line changes and rtl_tcp only if the device settings change.
+    Returns the (config, rtlamr, rtltcp, sinks) to keep using.
+    """
+    global LOG_LEVEL
+    # The Supervisor is not asked again, the main loop would wait for it
+    err, msg, new_config = cnf.load_config(config_path, supervisor=False)
+    if err != 'success':
+        logger.error('Failed to reload configuration, keeping the current one: %s', msg)
+        return config, rtlamr, rtltcp, sinks
+    cnf.reuse_supervisor_broker(new_config, config)
+
+    # Keep using the same rtl_tcp server if the list has not changed
+    if new_config['general']['rtltcp_hosts'] == config['general']['rtltcp_hosts']:
+        new_config['general']['rtltcp_host'] = config['general']['rtltcp_host']
+    # Keep the rtlamr setting chosen for the CPU budget, unless what it was chosen for has changed
+    if autotune_key(new_config) == autotune_key(config):
+        new_config['general']['autotune'] = config['general']['autotune']
+    # rtlamr keeps filtering on the same meters, main applies the new ones
+    new_config['general']['filter_ids'] = config['general']['filter_ids']
+    changes = cnf.diff_config(config, new_config)
+    LOG_LEVEL = logs.verbosity_level(new_config['general']['verbosity'])
+    logs.set_level(new_config['general']['verbosity'])
+    LOG_SAMPLING.rate_limit = new_config['general']['log_rate_limit']
+    if LOG_LEVEL >= 3:
+        logger.info('Configuration reloaded: %s', changes)
+
+    if changes['mqtt']:
+        # The broker connection is kept, so keep publishing with the running settings
+        logger.warning('MQTT settings have changed. Restart the add-on to apply them.')
+        new_config['mqtt'] = config['mqtt']
+        new_config['brokers'] = config['brokers']
+
+    if changes['cluster']:
+        # The cluster node is attached to the running broker connection
+        logger.warning('Cluster settings have changed. Restart the add-on to apply them.')
+        new_config['cluster'] = config['cluster']
+
+    if changes['sinks']:
+        # Replace the sinks, pending readings are written by the old ones first
+        for sink in sinks:
+            sink.stop()
+        sinks = snk.build_sinks(new_config, mqtt_clients, logger, log_level=LOG_LEVEL)
+    else:
+        for sink in sinks:
+            sink.update_config(new_config)
+
+    meter_ids_list.difference_update(changes['meters_removed'])
+    meter_ids_list.update(changes['meters_added'])
+    for broker, mqtt_client in zip(new_config['brokers'], mqtt_clients):
+        # Remove the meters that are gone from Home Assistant
+        for meter in changes['meters_removed']:
+            mqtt_client.publish(
+                topic=f'{broker["ha_autodiscovery_topic"]}/device/{meter}/config',
+                payload='',
+                retain=False
+            )
+        # Announce new and changed meters
+        publish_discovery(mqtt_client, broker, new_config['meters'], changes['meters_added'] + changes['meters_changed'])
+
+    # Restart only the processes affected by the changes
+    if changes['rtltcp']:
+        if LOG_LEVEL >= 3:
+            logger.info('RTL_TCP settings have changed, restarting RTL_TCP and RTLAMR...')
+        shutdown(rtlamr=rtlamr, rtltcp=rtltcp, mqtt_clients=None)
+        rtlamr, rtltcp = None, None
+    elif changes['rtlamr']:
+        if LOG_LEVEL >= 3:
+            logger.info('RTLAMR settings have changed, restarting RTLAMR...')
+        shutdown(rtlamr=rtlamr, rtltcp=None, mqtt_clients=None)
+        rtlamr = None
+
+    return new_config, rtlamr, rtltcp, sinks
+
+
+
+def start_rtltcp(config, usb_monitor=None):
+    """ Start RTL_TCP process, on the configured device found by usb_monitor """
     # Check if we are using a remote RTL_TCP server
-    is_remote = config["general"]["rtltcp_host"].split(':')[0] not in [ '127.0.0.1', 'localhost' ]
+    is_remote = is_remote_rtltcp(config)
 
     if is_remote:
         return 'remote'
@@ -108,7 +321,10 @@ def start_rtltcp(config):
         usb_id_list = usbutil.find_rtl_sdr_devices()
 
     usb_id = config['general']['device_id']
-    if config['general']['device_id'] == '0':
+    if usb_monitor is not None:
+        # The "bus:device" id changes when the device is plugged in again
+        usb_id = usb_monitor.resolve(usb_id) or usb_id
+    if usb_id == '0':
         if len(usb_id_list) > 0:
             usb_id = usb_id_list[0]
         else:
@@ -121,7 +337,7 @@ def start_rtltcp(config):
             logger.debug('Reseting USB device: %s', usb_id)
         usbutil.reset_usb_device(usb_id)
 
-    rtltcp_args = cmd.build_rtltcp_args(config)
+    rtltcp_args = cmd.build_rtltcp_args(dict(config, general=dict(config['general'], device_id=usb_id)))
     rtltcp_full_command = [which("rtl_tcp")] + rtltcp_args
 
     if LOG_LEVEL >= 3:
@@ -131,13 +347,13 @@ def start_rtltcp(config):
         # rtltcp = subprocess.Popen(["strace", "--output=out.trace", "rtl_tcp"] + rtltcp_args,
         rtltcp = subprocess.Popen(["/usr/bin/unbuffer"] + rtltcp_full_command,
             start_new_session=True,
-            text=True,
             close_fds=False,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            bufsize=1)
+            bufsize=0)
 
-        os.set_blocking(rtltcp.stdout.fileno(), False)
+        # Whole lines, with bounded buffers
+        rtltcp.stdout = lr.LineReader(rtltcp.stdout, stats=PIPE_STATS['rtl_tcp'])
 
     except Exception as e:
         logger.critical('Failed to start RTL_TCP. %s', e)
@@ -145,10 +361,15 @@ def start_rtltcp(config):
 
     rtltcp_is_ready = False
     # Wait for rtl_tcp to be ready
-
+    deadline = monotonic() + RTLTCP_START_TIMEOUT
     while not rtltcp_is_ready:
+        if STOPPING.is_set() or monotonic() >= deadline:
+            if not STOPPING.is_set():
+                logger.critical('RTL_TCP is not ready after %d seconds.', RTLTCP_START_TIMEOUT)
+            stop_process(rtltcp)
+            return None
         try:
-            rtltcp_output = rtltcp.stdout.readline().strip()
+            rtltcp_output = rtltcp.stdout.readline(timeout=0.1).strip()
         except Exception as e:
             logger.critical(e)
             return None
@@ -169,6 +390,231 @@ def start_rtltcp(config):
 
 
 
+def keep_rtltcp_running(config, rtltcp, rtlamr, usb_monitor):
+    """
+    Start RTL_TCP, or start it again if it has died.
+    Returns (rtltcp, rtlamr, state), state is 'running', 'unplugged' until the device
+    is plugged in, or 'failed'.
+    """
+    device_id = config['general']['device_id']
+    if rtltcp is None and usb_monitor is not None and not usb_monitor.present(device_id):
+        return None, rtlamr, 'unplugged'
+    if rtltcp is None:
+        rtltcp = start_rtltcp(config, usb_monitor)
+    if rtltcp is not None:
+        rtltcp.poll()
+    if rtltcp is not None and rtltcp.returncode is not None:
+        # It dies as soon as the device is unplugged, before the monitor notices it
+        if usb_monitor is not None:
+            usb_monitor.rescan()
+            if not usb_monitor.present(device_id):
+                if LOG_LEVEL >= 2:
+                    logger.warning('RTL_TCP has died, the device has been unplugged. Waiting for it to be plugged in...')
+                shutdown(rtlamr=rtlamr, rtltcp=rtltcp, mqtt_clients=None)
+                return None, None, 'unplugged'
+        if LOG_LEVEL >= 3:
+            logger.critical('RTL_TCP has died, trying to restart...')
+        rtltcp = start_rtltcp(config, usb_monitor)
+        if rtltcp is not None:
+            rtltcp.poll()
+    return rtltcp, rtlamr, 'running' if rtltcp is not None else 'failed'
+
+
+
+def create_rtltcp_pool(config):
+    """ Create the pool of remote RTL_TCP servers and start probing them """
+    return pool.RtlTcpPool(
+        hosts=config['general']['rtltcp_hosts'],
+        logger=logger,
+        probe_interval=config['general']['rtltcp_probe_interval'],
+        probe_timeout=config['general']['rtltcp_probe_timeout'],
+        log_level=LOG_LEVEL
+    ).start()
+
+
+
+def create_usb_monitor(config):
+    """ Watch the local RTL-SDR devices, None if RTL_TCP is remote or mocked """
+    if is_remote_rtltcp(config) or 'RTLAMR2MQTT_USE_MOCK' in dict(os.environ):
+        return None
+    usb_monitor = hotplug.UsbHotplugMonitor(logger=logger, log_level=LOG_LEVEL).start()
+    if not usb_monitor.present(config['general']['device_id']) and LOG_LEVEL >= 2:
+        logger.warning('No RTL-SDR device found, waiting for one to be plugged in...')
+    return usb_monitor
+
+
+
+def needs_proxy(config):
+    """ Frequency hopping and the gain calibration change the tuner settings through a proxy """
+    return hop.needs_hopping(config['meters']) or config['general']['gain_calibration']
+
+
+
+def unique_output(config):
+    """ rtlamr -unique only prints a meter when its message changes, not the gain calibration, the frequency hopping nor NumPy """
+    return config['general']['decoder'] == 'rtlamr' and not config['general']['gain_calibration'] and not hop.needs_hopping(config['meters'])
+
+
+
+def drop_repeated(config):
+    """ Without -unique, the add-on drops the repeated messages rtlamr would not have printed """
+    return config['general']['gain_calibration'] or config['general']['decoder'] == 'rtlamr' and hop.needs_hopping(config['meters'])
+
+
+
+def create_proxy(config):
+    """
+    Create the RTL_TCP proxy the decoder connects to, only if it is needed.
+    """
+    if not needs_proxy(config):
+        return None
+    return hop.RtlTcpProxy(upstream=config['general']['rtltcp_host'], logger=logger, log_level=LOG_LEVEL).start()
+
+
+
+def create_hopping(config, proxy):
+    """
+    Create the frequency hopping scheduler, only if the meters are on more than one frequency.
+    """
+    groups = hop.frequency_groups(config['meters'])
+    if len(groups) < 2 or proxy is None:
+        return None
+    if LOG_LEVEL >= 3:
+        logger.info('Meters are on %d frequencies, enabling frequency hopping: %s', len(groups), groups)
+    return hop.HoppingScheduler(
+        groups=groups,
+        proxy=proxy,
+        logger=logger,
+        min_dwell=config['general']['hop_min_dwell'],
+        max_dwell=config['general']['hop_max_dwell'],
+        log_level=LOG_LEVEL
+    )
+
+
+
+def create_gain_calibration(config, proxy):
+    """
+    Create the tuner gain calibration, only if it is enabled.
+    """
+    if not config['general']['gain_calibration'] or proxy is None:
+        return None
+    return gn.GainCalibration(
+        proxy=proxy,
+        meter_ids=set(config['meters']),
+        logger=logger,
+        dwell=config['general']['gain_dwell'],
+        interval=config['general']['gain_recalibrate'] * 3600,
+        key=f'{config["general"]["rtltcp_hosts"]}|{config["general"]["device_id"]}',
+        log_level=LOG_LEVEL
+    )
+
+
+
+def start_rtlamr_remote(config, rtltcp_pool, proxy=None):
+    """
+    Start RTLAMR on the active remote RTL_TCP server, or the best healthy one.
+    Each server is tried at most once, so this takes a bounded time.
+    """
+    tried = []
+    for _ in rtltcp_pool.hosts:
+        host = None if STOPPING.is_set() else rtltcp_pool.candidate(tried)
+        if host is None:
+            return None
+        tried.append(host)
+        config['general']['rtltcp_host'] = host
+        if LOG_LEVEL >= 3:
+            logger.info('Using remote RTL_TCP server at %s', host)
+        rtlamr = start_decoder(config, proxy)
+        if rtlamr is not None:
+            rtltcp_pool.activate(host)
+            return rtlamr
+        rtltcp_pool.mark_failed(host)
+    return None
+
+
+
+def autotune_key(config):
+    """ What the rtlamr CPU budget setting depends on, None if there is no budget """
+    if config['general']['decoder'] != 'rtlamr' or config['general']['cpu_budget'] <= 0:
+        return None
+    return tune.cache_key(config['meters'], config['general']['cpu_budget'], config['custom_parameters']['rtlamr'])
+
+
+
+def autotune_rtlamr(config):
+    """
+    Measure the CPU usage and the decoded messages of RTLAMR with each candidate
+    symbol length and decimation, and keep the best one within the CPU budget.
+    Returns the chosen setting, {} to keep the defaults if no candidate could be measured.
+    """
+    budget = config['general']['cpu_budget']
+    seconds = config['general']['autotune_seconds']
+    settings = tune.candidates()
+    if LOG_LEVEL >= 3:
+        logger.info('Calibrating RTLAMR for a CPU budget of %d%%, this takes about %d seconds...', budget, len(settings) * seconds)
+    results = {}
+    for symbol_length, decimation in settings:
+        candidate = dict(config, general=dict(config['general'], autotune={
+            'symbol_length': symbol_length,
+            'decimation': decimation,
+            'sample_rate': tune.sample_rate(symbol_length),
+        }))
+        # Count every message, not only the changed readings
+        rtlamr_args = [ arg for arg in cmd.build_rtlamr_args(candidate) if not arg.startswith('-unique') ]
+        usbutil.tickle_rtl_tcp(config['general']['rtltcp_host'])
+        result = tune.measure([ which('rtlamr') ] + rtlamr_args + [ '-unique=false' ], seconds)
+        results[(symbol_length, decimation)] = result
+        if result is None:
+            if LOG_LEVEL >= 2:
+                logger.warning('RTLAMR stopped during calibration with -symbollength=%d -decimation=%d', symbol_length, decimation)
+        elif LOG_LEVEL >= 3:
+            logger.info('RTLAMR -symbollength=%d -decimation=%d: %.1f%% CPU, %.1f messages/min',
+                symbol_length, decimation, result['cpu'], result['rate'])
+    setting = tune.choose(results, budget)
+    if setting is None:
+        if LOG_LEVEL >= 1:
+            logger.error('RTLAMR calibration failed, using the default settings.')
+        return {}
+    if LOG_LEVEL >= 3:
+        logger.info('Using RTLAMR -symbollength=%d -decimation=%d for the CPU budget', setting['symbol_length'], setting['decimation'])
+    if not tune.save_cached(autotune_key(config), setting, results) and LOG_LEVEL >= 2:
+        logger.warning('Failed to save the RTLAMR calibration to %s, it will run again on the next start.', tune.CACHE_PATH)
+    return setting
+
+
+
+def start_decoder(config, proxy=None):
+    """ Start the configured decoder: RTLAMR or the NumPy SCM/SCM+ decoder """
+    if autotune_key(config) is not None and config['general']['autotune'] is None:
+        config['general']['autotune'] = autotune_rtlamr(config)
+    if proxy is not None:
+        # The decoder reads from the proxy, for frequency hopping and the gain calibration
+        proxy.upstream = config['general']['rtltcp_host']
+        config = dict(config, general=dict(config['general'], rtltcp_host=proxy.address))
+    if config['general']['decoder'] != 'numpy':
+        return start_rtlamr(config)
+    if not scm.is_available():
+        logger.critical('The numpy decoder needs NumPy, it is not installed (see requirements-numpy.txt).')
+        return None
+    protocols = scm.meter_protocols(config['meters'])
+    if LOG_LEVEL >= 3:
+        logger.info('Starting the NumPy decoder for %s on %s', ', '.join(protocols), config['general']['rtltcp_host'])
+    decoder = scm.NumpyDecoder(
+        rtltcp_host=config['general']['rtltcp_host'],
+        protocols=protocols,
+        symbol_length=config['general']['decoder_symbol_length'],
+        logger=logger,
+        log_level=LOG_LEVEL
+    )
+    if not decoder.start():
+        logger.critical('The NumPy decoder failed to start.')
+        return None
+    if LOG_LEVEL >= 3:
+        logger.info('NumPy decoder has started!')
+    return decoder
+
+
+
 def start_rtlamr(config):
     """ Start RTLAMR process """
     rtlamr_args = cmd.build_rtlamr_args(config)
@@ -182,21 +628,27 @@ def start_rtlamr(config):
     try:
         rtlamr = subprocess.Popen(["/usr/bin/unbuffer"] + rtlamr_full_command,
             close_fds=True,
-            text=True,
             start_new_session=True,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            bufsize=1)
-        os.set_blocking(rtlamr.stdout.fileno(), False)
+            bufsize=0)
+        # Whole lines, with bounded buffers
+        rtlamr.stdout = lr.LineReader(rtlamr.stdout, stats=PIPE_STATS['rtlamr'])
 
     except Exception:
         logger.critical('Failed to start RTLAMR. Exiting...')
         return None
 
     rtlamr_is_ready = False
+    deadline = monotonic() + RTLAMR_START_TIMEOUT
     while not rtlamr_is_ready:
+        if STOPPING.is_set() or monotonic() >= deadline:
+            if not STOPPING.is_set():
+                logger.critical('RTLAMR is not ready after %d seconds.', RTLAMR_START_TIMEOUT)
+            stop_process(rtlamr)
+            return None
         try:
-            rtlamr_output = rtlamr.stdout.readline().strip()
+            rtlamr_output = rtlamr.stdout.readline(timeout=0.1).strip()
         except Exception as e:
             logger.critical(e)
             rtlamr_is_ready = False
@@ -218,6 +670,44 @@ def start_rtlamr(config):
 
 
 
+def warm_up(config, rtltcp_pool, proxy, usb_monitor, startup):
+    """
+    Start rtl_tcp and the decoder, in the background while MQTT starts.
+    Returns (rtltcp, rtlamr), None for what the main loop has to start itself.
+    """
+    if rtltcp_pool is not None:
+        start = monotonic()
+        rtlamr = start_rtlamr_remote(config, rtltcp_pool, proxy)
+        startup.mark('decoder', start)
+        return None, rtlamr
+    if usb_monitor is not None and not usb_monitor.present(config['general']['device_id']):
+        # Started by the main loop once the device is plugged in
+        return None, None
+    start = monotonic()
+    rtltcp = start_rtltcp(config, usb_monitor)
+    startup.mark('rtltcp', start)
+    if rtltcp is None:
+        return None, None
+    start = monotonic()
+    rtlamr = start_decoder(config, proxy)
+    startup.mark('decoder', start)
+    return rtltcp, rtlamr
+
+
+
+def stop_warm_up(startup):
+    """
+    Stop the warm-up on shutdown, without waiting for a receiver that does not start.
+    Returns (rtltcp, rtlamr) to shut down.
+    """
+    STOPPING.set()
+    result = startup.result('receiver', timeout=WARM_UP_STOP_TIMEOUT)
+    if result is None and startup.running('receiver') and LOG_LEVEL >= 2:
+        logger.warning('The receiver is still starting, not waiting for it.')
+    return result or (None, None)
+
+
+
 def main():
     """
     Main function
@@ -225,13 +715,18 @@ def main():
     # Signal handlers/call back
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGHUP, reload_handler)
 
     # Load the configuration file
     if len(sys.argv) == 2:
         config_path = os.path.join(os.path.dirname(__file__), sys.argv[1])
     else:
         config_path = None
-    err, msg, config = cnf.load_config(config_path)
+    startup = su.Startup(logger)
+    start = monotonic()
+    # The MQTT broker is looked up from the Supervisor while the receiver starts
+    err, msg, config = cnf.load_config(config_path, supervisor=False)
+    startup.mark('config', start)
 
     if err != 'success':
         # Error loading configuration file
@@ -241,9 +736,15 @@ def main():
     # Use LOG_LEVEL as a global variable
     global LOG_LEVEL
     # Convert verbosity to a number and store as LOG_LEVEL
-    LOG_LEVEL = ['none', 'error', 'warning', 'info', 'debug'].index(config['general']['verbosity'])
+    LOG_LEVEL = logs.verbosity_level(config['general']['verbosity'])
+    logs.set_level(config['general']['verbosity'])
+    LOG_SAMPLING.rate_limit = config['general']['log_rate_limit']
+    startup.log_level = LOG_LEVEL
     if LOG_LEVEL >= 3:
         logger.info(msg)
+    # Start RTL_TCP with the rtlamr setting of the last calibration, if any
+    if autotune_key(config) is not None:
+        config['general']['autotune'] = tune.load_cached(autotune_key(config))
     ##################################################################
 
     # ToDo:
@@ -253,285 +754,620 @@ def main():
 
     # Get a list of meters ids to watch
     meter_ids_list = set(config['meters'].keys())
-
-    # Create MQTT Client and connect to the broker
-    mqtt_client = m.MQTTClient(
-        broker=config['mqtt']['host'],
-        port=config['mqtt']['port'],
-        username=config['mqtt']['user'],
-        password=config['mqtt']['password'],
-        tls_enabled=config['mqtt']['tls_enabled'],
-        tls_insecure=config['mqtt']['tls_insecure'],
-        ca_cert=config['mqtt']['tls_ca'],
-        client_cert=config['mqtt']['tls_cert'],
-        client_key=config['mqtt']['tls_keyfile'],
-        log_level=LOG_LEVEL,
-        logger=logger,
-    )
-
-    # Set Last Will and Testament
-    mqtt_client.set_last_will(
-        topic=f'{config["mqtt"]["base_topic"]}/status',
-        payload="offline",
-        qos=1,
-        retain=False
+    # Drop the unwatched meters in rtlamr or in the add-on, whichever is cheaper
+    filtering = flt.FilterController(
+        logger,
+        mode=config['general']['filtering'],
+        discovery=config['general']['discovery'],
+        can_filter=config['general']['decoder'] == 'rtlamr',
+        evaluation=config['general']['filter_evaluation'],
+        log_level=LOG_LEVEL
     )
+    config['general']['filter_ids'] = filtering.filter_ids(meter_ids_list)
 
+    # Is rtl_tcp configured to run on a remote host?
+    is_rtltcp_remote = is_remote_rtltcp(config)
+    rtltcp_pool = create_rtltcp_pool(config) if is_rtltcp_remote else None
+    proxy = create_proxy(config)
+    hopping = create_hopping(config, proxy)
+    gain = create_gain_calibration(config, proxy)
+    usb_monitor = create_usb_monitor(config)
+    # Start the receiver in the background, the readings wait in the MQTT queues until the broker is ready
+    startup.run('receiver', warm_up, config, rtltcp_pool, proxy, usb_monitor, startup, default=(None, None))
+    warming_up = True
+    # Until the main loop runs, a signal stops the warm-up and the clients started so far
+    rtltcp, rtlamr = None, None
+    mqtt_clients, sinks = [], []
     try:
-        mqtt_client.connect()
-    except Exception as e:
-        logger.critical('Failed to connect to MQTT broker: %s', e)
-        sys.exit(1)
-
-    # Set on_message callback
-    # mqtt_client.set_on_message_callback(on_message)
-
-    # Subscribe to Home Assistant status topic
-    mqtt_client.subscribe(config['mqtt']['ha_status_topic'], qos=1)
-
-    # Start the MQTT client loop
-    mqtt_client.loop_start()
 
+        start = monotonic()
+        err, msg = cnf.resolve_brokers(config)
+        startup.mark('supervisor', start)
+        if err != 'success':
+            logger.critical(msg)
+            rtltcp, rtlamr = stop_warm_up(startup)
+            shutdown(rtlamr=rtlamr, rtltcp=rtltcp, mqtt_clients=None)
+            sys.exit(1)
+
+        # Create one MQTT Client per broker, each one connects in the background
+        # Their incoming messages are handled in this loop, from a single queue
+        inbox = queue.Queue(maxsize=1000)
+        try:
+            mqtt_clients = [ create_mqtt_client(broker, inbox=inbox) for broker in config['brokers'] ]
+        except Exception as e:
+            logger.critical('Failed to connect to MQTT broker: %s', e)
+            rtltcp, rtlamr = stop_warm_up(startup)
+            shutdown(rtlamr=rtlamr, rtltcp=rtltcp, mqtt_clients=None)
+            sys.exit(1)
+
+        # Create the outputs for the readings
+        sinks = snk.build_sinks(config, mqtt_clients, logger, log_level=LOG_LEVEL)
+
+        def put_reading(reading_record):
+            for sink in sinks:
+                sink.put(reading_record)
+
+        # In cluster mode, the nodes coordinate through the main broker
+        cluster = None
+        if config['cluster']['enabled']:
+            cluster = clst.Cluster(
+                node_id=config['cluster']['node_id'],
+                topic=config['cluster']['topic'],
+                logger=logger,
+                owner_timeout=config['cluster']['owner_timeout'],
+                heartbeat_interval=config['cluster']['heartbeat_interval'],
+                confirm_timeout=config['cluster']['confirm_timeout'],
+                dedup_window=config['cluster']['dedup_window'],
+                log_level=LOG_LEVEL
+            )
+            cluster.attach(mqtt_clients[0], on_reading=put_reading)
+            if LOG_LEVEL >= 3:
+                logger.info('Cluster mode enabled, this node is %s', config['cluster']['node_id'])
+
+
+        def publish_discovery_if_new(meter_id):
+            if meter_id not in meter_ids_list:
+                if LOG_LEVEL >= 4:
+                    logger.debug("Discovered new meter: %s", meter_id)
+                meter_ids_list.add(meter_id)
+
+                meter_config = {
+                    "name": f"Meter {meter_id}",
+                    "id": meter_id,
+                    "state_class": "total_increasing",
+                    # Optional: add 'device_class', 'unit_of_measurement', etc.
+                }
+
+                for broker, mqtt_client in zip(config['brokers'], mqtt_clients):
+                    publish_discovery(mqtt_client, broker, { meter_id: meter_config }, [ meter_id ])
+                sleep(1) # sleep to allow discovery to process
+
+        def on_ha_status(broker, mqtt_client, topic, payload):
+            # Home Assistant has restarted, announce the meters again
+            if payload.decode(errors='replace').strip().lower() == 'online':
+                publish_discovery(mqtt_client, broker, config['meters'], config['meters'])
+
+        def collect_stats():
+            return {
+                'uptime': int(monotonic() - started),
+                'decoder': config['general']['decoder'],
+                'running': rtlamr is not None and rtlamr.returncode is None,
+                'meters': sorted(meter_ids_list),
+                'read': sorted(read_counter),
+                'availability': tracker.stats(),
+                'brokers': { mqtt_client.name: mqtt_client.stats() for mqtt_client in mqtt_clients },
+                'sinks': { sink.name: dict(sink.stats, queue_depth=sink.queue.qsize()) for sink in sinks },
+                'rtltcp': rtltcp_pool.stats() if rtltcp_pool is not None else None,
+                'hopping': hopping.stats() if hopping is not None else None,
+                'gain': gain.stats() if gain is not None else None,
+                'filtering': filtering.stats(),
+                'cluster': cluster.stats() if cluster is not None else None,
+                'autotune': config['general']['autotune'],
+                'startup': startup.stats(),
+                'pipes': PIPE_STATS,
+            }
 
-    def publish_discovery_if_new(meter_id):
-        if meter_id not in meter_ids_list:
-            logger.debug("Discovered new meter: %s", meter_id)
-            meter_ids_list.add(meter_id)
+        def on_command(broker, mqtt_client, topic, payload):
+            global RELOAD_REQUESTED
+            nonlocal read_request
+            command, args = parse_command(payload)
+            if LOG_LEVEL >= 3:
+                logger.info('Received command: %s %s', command, ' '.join(args))
+            if command == 'reload':
+                RELOAD_REQUESTED = True
+            elif command == 'read':
+                unknown = [ meter_id for meter_id in args if meter_id not in meter_ids_list ]
+                if unknown and LOG_LEVEL >= 2:
+                    logger.warning('Reading requested for unknown meter(s): %s', ', '.join(unknown))
+                if config['general']['sleep_for'] > 0:
+                    # Wake up from sleep_for, until these meters (or all of them) are read
+                    read_request = set(args) - set(unknown)
+                elif LOG_LEVEL >= 3:
+                    logger.info('Readings are published as they are received, sleep_for is 0.')
+            elif command == 'announce':
+                for each_broker, each_client in zip(config['brokers'], mqtt_clients):
+                    publish_discovery(each_client, each_broker, config['meters'], config['meters'])
+            elif command == 'watch':
+                # Without restarting rtlamr, unless it filters the meters itself
+                for meter_id in args:
+                    publish_discovery_if_new(meter_id)
+                apply_filter()
+            elif command == 'unwatch':
+                for meter_id in args:
+                    if meter_id in config['meters']:
+                        if LOG_LEVEL >= 2:
+                            logger.warning('Meter %s is in the configuration, remove it there.', meter_id)
+                        continue
+                    meter_ids_list.discard(meter_id)
+                    read_counter.discard(meter_id)
+                    for each_broker, each_client in zip(config['brokers'], mqtt_clients):
+                        each_client.publish(
+                            topic=f'{each_broker["ha_autodiscovery_topic"]}/device/{meter_id}/config',
+                            payload='',
+                            retain=False
+                        )
+                apply_filter()
+            elif command == 'flush':
+                for sink in sinks:
+                    sink.flush()
+            elif command == 'stats':
+                mqtt_client.publish(
+                    topic=f'{broker["base_topic"]}/stats',
+                    payload=dumps(collect_stats()),
+                    qos=0,
+                    retain=False
+                )
+            elif LOG_LEVEL >= 2:
+                logger.warning('Unknown command on %s: %s', topic, payload)
+
+        def sleep_for(seconds):
+            # Handle the MQTT messages while sleeping, wake up early if a reading or a reload is requested
+            nonlocal read_request
+            # The meters are not expected to be heard while sleeping
+            tracker.pause()
+            deadline = monotonic() + seconds
+            while read_request is None and not RELOAD_REQUESTED and (remaining := deadline - monotonic()) > 0:
+                m.dispatch(inbox, logger, timeout=min(remaining, 1))
+            tracker.resume()
+            requested, read_request = read_request, None
+            if requested is not None and LOG_LEVEL >= 3:
+                logger.info('Reading requested, waking up...')
+            elif RELOAD_REQUESTED and LOG_LEVEL >= 3:
+                logger.info('Reload requested, waking up...')
+            return requested
+
+        def apply_filter():
+            # rtlamr is restarted when the meters it filters on change
+            nonlocal rtlamr
+            filter_ids = filtering.filter_ids(meter_ids_list)
+            if filter_ids == config['general']['filter_ids']:
+                return
+            config['general']['filter_ids'] = filter_ids
+            if rtlamr is not None and config['general']['decoder'] == 'rtlamr':
+                if LOG_LEVEL >= 3:
+                    logger.info('The filtered meters have changed, restarting RTLAMR...')
+                shutdown(rtlamr=rtlamr, rtltcp=None, mqtt_clients=None)
+                rtlamr = None
 
-            meter_config = {
-                "name": f"Meter {meter_id}",
-                "id": meter_id,
-                "state_class": "total_increasing",
-                # Optional: add 'device_class', 'unit_of_measurement', etc.
-            }
+        def publish_availability(meter_id, available):
+            # Retained, Home Assistant gets it when it restarts
+            for mqtt_client in mqtt_clients:
+                mqtt_client.publish(
+                    topic=f'{mqtt_client.base_topic}/{meter_id}/availability',
+                    payload='online' if available else 'offline',
+                    retain=True
+                )
 
-            discovery_payload = ha_msgs.meter_discover_payload(config["mqtt"]["base_topic"], meter_config)
+        started = monotonic()
+        # Expected next reading of each meter, to notice the ones not heard anymore
+        tracker = stale.StalenessTracker(config['meters'], missed_limit=config['general']['missed_readings'], unique=unique_output(config))
+        # Meters requested with the read command, empty for all of them
+        read_request = None
+        # Meters to read before going back to sleep, None for all of them
+        read_wanted = None
+        for broker, mqtt_client in zip(config['brokers'], mqtt_clients):
+            mqtt_client.add_handler(broker['ha_status_topic'], partial(on_ha_status, broker, mqtt_client), qos=1)
+            mqtt_client.add_handler(f'{broker["base_topic"]}/command', partial(on_command, broker, mqtt_client), qos=1)
+
+        # Publish the discovery messages for all meters
+        for broker, mqtt_client in zip(config['brokers'], mqtt_clients):
+            publish_discovery(mqtt_client, broker, config['meters'], config['meters'])
+
+        for meter_id in config['meters']:
+            publish_availability(meter_id, True)
+
+        # Publish the initial status
+        for mqtt_client in mqtt_clients:
             mqtt_client.publish(
-                topic=f'{config["mqtt"]["ha_autodiscovery_topic"]}/device/{meter_id}/config',
-                payload=dumps(discovery_payload),
-                qos=1,
+                topic=f'{mqtt_client.base_topic}/status',
+                payload='online',
                 retain=False
             )
-            sleep(1) # sleep to allow discovery to process
-
-    # Publish the discovery messages for all meters
-    for meter in config['meters']:
-        discovery_payload = ha_msgs.meter_discover_payload(config["mqtt"]["base_topic"], config['meters'][meter])
-        mqtt_client.publish(
-            topic=f'{config["mqtt"]["ha_autodiscovery_topic"]}/device/{meter}/config',
-            payload=dumps(discovery_payload),
-            qos=1,
-            retain=False
-        )
 
-    # Give some time for the MQTT client to connect and publish
-    sleep(1)
-    # Publish the initial status
-    mqtt_client.publish(
-        topic=f'{config["mqtt"]["base_topic"]}/status',
-        payload='online',
-        qos=1,
-        retain=False
-    )
+        ##################################################################
+        rtltcp = None
+        rtlamr = None
+        keep_reading = True
+        read_counter = set()
+        # Last message of each meter, to drop the repeated ones
+        last_messages = {}
+        last_broker_stats = monotonic()
+        # Restart the receiver when no meter is heard and the decoder prints nothing at all,
+        # backing off if it does not help. Meters reading the same value are silent with -unique.
+        def watchdog_delay():
+            return max(300, tracker.longest_interval() * config['general']['missed_readings'])
+        watchdog_backoff = watchdog_delay()
+        watchdog_decoder = None
+        last_output = monotonic()
+
+        def match(items):
+            # Stage: count the messages of each meter, announce the new ones, keep the watched ones
+            for meter_id, line in items:
+                watched = meter_id in meter_ids_list
+                filtering.on_line(watched)
+                if gain is not None:
+                    gain.on_message(meter_id)
+                # The unwatched meters are only parsed to be discovered
+                if not watched and config['general']['discovery']:
+                    reading = ro.get_message(line)
+                    if reading:
+                        if LOG_LEVEL >= 4:
+                            logger.debug('Received reading: %s', reading, extra={ 'category': 'reading' })
+                        publish_discovery_if_new(reading['meter_id'])
+                        watched = meter_id in meter_ids_list
+                if watched:
+                    yield meter_id, line
+
+        def track(readings):
+            # Stage: availability, repeated messages and the meters read
+            nonlocal watchdog_backoff
+            for reading in readings:
+                if tracker.on_reading(reading.meter_id):
+                    if LOG_LEVEL >= 3:
+                        logger.info('Meter %s is heard again.', reading.meter_id)
+                    publish_availability(reading.meter_id, True)
+                    watchdog_backoff = watchdog_delay()
+                # The hopping counts every message, a meter reading the same value is still heard
+                if hopping is not None:
+                    hopping.on_reading(reading.meter_id)
+                if drop_repeated(config):
+                    # rtlamr prints every message for the gain calibration and the hopping, drop the repeated ones as -unique would
+                    if last_messages.get(reading.meter_id) == reading.raw:
+                        continue
+                    last_messages[reading.meter_id] = reading.raw
+                # Add the meter_id to the read_counter
+                read_counter.add(reading.meter_id)
+                startup.once('first_reading')
+                yield reading
+
+        # From the rtlamr output to the sinks, more stages can be inserted with readings_pipeline.insert()
+        readings_pipeline = pl.Pipeline([
+            ('identify', pl.identify),
+            ('match', match),
+            ('decode', pl.decode),
+            ('track', track),
+            ('format', pl.formatter(lambda: config['meters'], get_iso8601_timestamp, time)),
+        ])
+        global RELOAD_REQUESTED
+        while keep_reading:
+            try:
+                # Home Assistant status and commands
+                m.dispatch(inbox, logger)
+
+                # Startup phases running in parallel: the brokers connecting and the receiver starting
+                if 'mqtt' not in startup.done_at and all(mqtt_client.connected.is_set() for mqtt_client in mqtt_clients):
+                    startup.once('mqtt')
+                if warming_up:
+                    if startup.running('receiver'):
+                        # Handle the commands until rtl_tcp and the decoder are started
+                        m.dispatch(inbox, logger, timeout=0.5)
+                        continue
+                    warming_up = False
+                    rtltcp, rtlamr = startup.result('receiver')
+                if 'mqtt' in startup.done_at and startup.once('ready'):
+                    if LOG_LEVEL >= 3:
+                        logger.info('Started in %.1f seconds: %s', startup.done_at['ready'], startup.stats()['phases'])
+                    for mqtt_client in mqtt_clients:
+                        mqtt_client.publish(
+                            topic=f'{mqtt_client.base_topic}/startup',
+                            payload=dumps(startup.stats()),
+                            qos=0,
+                            retain=False
+                        )
 
-    ##################################################################
-    # Is rtl_tcp configured to run on a remote host?
-    is_rtltcp_remote = config["general"]["rtltcp_host"].split(':')[0] not in [ '127.0.0.1', 'localhost' ]
-    #
-    rtltcp = None
-    rtlamr = None
-    keep_reading = True
-    read_counter = []
-    while keep_reading:
-        try:
-            if mqtt_client.last_message is not None:
-                if LOG_LEVEL >= 3:
-                    logger.debug('Received MQTT message: %s on topic %s',
-                        mqtt_client.last_message.payload.decode(),
-                        mqtt_client.last_message.topic
-                    )
-                    for meter in config['meters']:
-                        discovery_payload = ha_msgs.meter_discover_payload(config["mqtt"]["base_topic"], config['meters'][meter])
+                if cluster is not None:
+                    cluster.heartbeat()
+                    # Publish the readings the owner failed to publish
+                    for reading_record in cluster.expire():
+                        put_reading(reading_record)
+
+                if hopping is not None:
+                    hopping.tick()
+                if gain is not None:
+                    gain.tick()
+                if filtering.tick(rtlamr.pid if isinstance(rtlamr, subprocess.Popen) else None):
+                    apply_filter()
+
+                # Meters that are not heard anymore
+                for meter_id in tracker.expire():
+                    if LOG_LEVEL >= 2:
+                        logger.warning('Meter %s missed %d readings, it is now unavailable.', meter_id, config['general']['missed_readings'])
+                    publish_availability(meter_id, False)
+                if rtlamr is not watchdog_decoder:
+                    # A new decoder, it has not printed anything yet
+                    watchdog_decoder, last_output = rtlamr, monotonic()
+                if rtlamr is not None and tracker.all_unavailable() and monotonic() - last_output >= watchdog_backoff:
+                    if LOG_LEVEL >= 2:
+                        logger.warning('The decoder has printed nothing for %d seconds, restarting the receiver...', monotonic() - last_output)
+                    shutdown(rtlamr=rtlamr, rtltcp=rtltcp, mqtt_clients=None)
+                    rtlamr, rtltcp = None, None
+                    watchdog_backoff = min(watchdog_backoff * 2, max(3600, watchdog_delay()))
+
+                # Expose the delivery metrics of each broker
+                if monotonic() - last_broker_stats >= 60:
+                    last_broker_stats = monotonic()
+                    publish_broker_stats(mqtt_clients)
+                    for mqtt_client in mqtt_clients:
                         mqtt_client.publish(
-                            topic=f'{config["mqtt"]["ha_autodiscovery_topic"]}/device/{meter}/config',
-                            payload=dumps(discovery_payload),
-                            qos=1,
+                            topic=f'{mqtt_client.base_topic}/meters',
+                            payload=dumps(tracker.stats()),
+                            qos=0,
                             retain=False
                         )
-                mqtt_client.last_message = None
-
-            # Start RTL_TCP if not remote
-            if not is_rtltcp_remote:
-                if rtltcp is None:
-                    rtltcp = start_rtltcp(config)
-                if rtltcp is not None:
-                    rtltcp.poll()
-                if rtltcp.returncode is not None:
+                    if cluster is not None:
+                        mqtt_clients[0].publish(
+                            topic=f'{config["cluster"]["topic"]}/stats/{config["cluster"]["node_id"]}',
+                            payload=dumps(cluster.stats()),
+                            qos=0,
+                            retain=False
+                        )
+                    if rtltcp_pool is not None:
+                        for mqtt_client in mqtt_clients:
+                            mqtt_client.publish(
+                                topic=f'{mqtt_client.base_topic}/rtltcp',
+                                payload=dumps(rtltcp_pool.stats()),
+                                qos=0,
+                                retain=False
+                            )
+                    if hopping is not None:
+                        for mqtt_client in mqtt_clients:
+                            mqtt_client.publish(
+                                topic=f'{mqtt_client.base_topic}/hopping',
+                                payload=dumps(hopping.stats()),
+                                qos=0,
+                                retain=False
+                            )
+
+                if RELOAD_REQUESTED:
+                    RELOAD_REQUESTED = False
+                    config, rtlamr, rtltcp, sinks = reload_config(
+                        config_path=config_path,
+                        config=config,
+                        mqtt_clients=mqtt_clients,
+                        meter_ids_list=meter_ids_list,
+                        rtlamr=rtlamr,
+                        rtltcp=rtltcp,
+                        sinks=sinks
+                    )
+                    is_rtltcp_remote = is_remote_rtltcp(config)
+                    if rtltcp_pool is not None and rtltcp_pool.hosts != config['general']['rtltcp_hosts']:
+                        rtltcp_pool.stop()
+                        rtltcp_pool = None
+                    if rtltcp_pool is None and is_rtltcp_remote:
+                        rtltcp_pool = create_rtltcp_pool(config)
+                    # If the frequencies or the gain calibration have changed, rtlamr has been stopped by the reload
+                    if (proxy is not None) != needs_proxy(config):
+                        if proxy is not None:
+                            proxy.stop()
+                        proxy, hopping, gain = create_proxy(config), None, None
+                    groups = hop.frequency_groups(config['meters'])
+                    if (hopping.groups if hopping is not None else None) != (groups if len(groups) > 1 else None):
+                        hopping = create_hopping(config, proxy)
+                        if hopping is None and proxy is not None:
+                            # Let the decoder tune rtl_tcp again
+                            proxy.set_frequency(None)
+                    if (gain is not None) != config['general']['gain_calibration']:
+                        if gain is not None:
+                            proxy.set_gain(None)
+                        gain = create_gain_calibration(config, proxy)
+                    elif gain is not None:
+                        gain.meter_ids = set(config['meters'])
+                    if usb_monitor is not None and is_rtltcp_remote:
+                        usb_monitor.stop()
+                        usb_monitor = None
+                    elif usb_monitor is None:
+                        usb_monitor = create_usb_monitor(config)
+                    read_counter &= meter_ids_list
+                    filtering.evaluation = config['general']['filter_evaluation']
+                    filtering.configure(config['general']['filtering'], config['general']['discovery'], config['general']['decoder'] == 'rtlamr')
+                    apply_filter()
+                    tracker.missed_limit = config['general']['missed_readings']
+                    tracker.unique = unique_output(config)
+                    tracker.update_meters(config['meters'])
+
+                # Stop right away when the device is removed, instead of waiting for RTL_TCP to fail
+                if usb_monitor is not None:
+                    for action, device in usb_monitor.get_events():
+                        # With device_id 0, we do not know which device RTL_TCP is using
+                        if action == 'remove' and rtltcp is not None and (config['general']['device_id'] == '0'
+                                or not usb_monitor.present(config['general']['device_id'])):
+                            if LOG_LEVEL >= 2:
+                                logger.warning('Stopping RTL_TCP and RTLAMR, waiting for the device to be plugged in...')
+                            shutdown(rtlamr=rtlamr, rtltcp=rtltcp, mqtt_clients=None)
+                            rtlamr, rtltcp = None, None
+
+                # Start RTL_TCP if not remote
+                if not is_rtltcp_remote:
+                    rtltcp, rtlamr, rtltcp_state = keep_rtltcp_running(config, rtltcp, rtlamr, usb_monitor)
+                    if rtltcp_state == 'unplugged':
+                        # Start as soon as the device is plugged in
+                        sleep(1)
+                        continue
+                    if rtltcp is None:
+                        logger.critical('Failed to start RTL_TCP. Exiting...')
+                        shutdown(
+                                    rtlamr=None,
+                                    rtltcp=rtltcp,
+                                    mqtt_clients=mqtt_clients,
+                                    offline=True,
+                                    sinks=sinks
+                                )
+                        sys.exit(1)
+                else:
+                    # If we are using a remote RTL_TCP server, we can skip the rest of the setup
+                    # and just read from the remote server
+                    rtltcp = None
+                    if rtlamr is not None and rtlamr.returncode is None and not rtltcp_pool.active_is_healthy():
+                        # rtlamr does not always notice when the server is gone
+                        if LOG_LEVEL >= 2:
+                            logger.warning('RTL_TCP server %s is not healthy, restarting RTLAMR...', config['general']['rtltcp_host'])
+                        shutdown(rtlamr=rtlamr, rtltcp=None, mqtt_clients=None)
+                        rtlamr = start_rtlamr_remote(config, rtltcp_pool, proxy)
+                        if rtlamr is None:
+                            sleep(1)
+                            continue
+
+                ##################################################################
+
+                # Read the output from RTLAMR
+                # Start RTLAMR if it is not already running
+                if rtlamr is None:
+                    rtlamr = start_decoder(config, proxy)
+                else:
+                    rtlamr.poll()
+                    if rtlamr.returncode is not None:
+                        if LOG_LEVEL >= 3:
+                            logger.critical('RTLAMR has died, trying to restart...')
+                        if int(config['general']['sleep_for']) > 0:
+                            if LOG_LEVEL >= 2:
+                                logger.info('Sleep for is set to %d seconds...', int(config['general']['sleep_for']))
+                            read_wanted = sleep_for(int(config['general']['sleep_for'])) or None
+                        if is_rtltcp_remote and not rtltcp_pool.probe(rtltcp_pool.active):
+                            rtlamr = None
+                        else:
+                            rtlamr = start_decoder(config, proxy)
+                        if rtlamr is not None:
+                            rtlamr.poll()
+
+                if rtlamr is None and is_rtltcp_remote:
+                    # Fail over to the other servers before giving up
+                    rtlamr = start_rtlamr_remote(config, rtltcp_pool, proxy)
+                    if rtlamr is None:
+                        if LOG_LEVEL >= 1:
+                            logger.error('No healthy RTL_TCP server available, retrying...')
+                        sleep(1)
+                        continue
+
+                if rtlamr is None:
                     if LOG_LEVEL >= 3:
-                        logger.critical('RTL_TCP has died, trying to restart...')
-                    rtltcp = start_rtltcp(config)
-                    if rtltcp is not None:
-                        rtltcp.poll()
-                if rtltcp is None:
-                    logger.critical('Failed to start RTL_TCP. Exiting...')
+                        logger.critical('Failed to start RTLAMR. Exiting...')
                     shutdown(
-                                rtlamr=None,
+                                rtlamr=rtlamr,
                                 rtltcp=rtltcp,
-                                mqtt_client=mqtt_client,
-                                base_topic=config['mqtt']['base_topic'],
-                                offline=True
+                                mqtt_clients=mqtt_clients,
+                                offline=True,
+                                sinks=sinks
                             )
                     sys.exit(1)
-            else:
-                logger.info('Using remote RTL_TCP server at %s', config['general']['rtltcp_host'])
-                # If we are using a remote RTL_TCP server, we can skip the rest of the setup
-                # and just read from the remote server
-                rtltcp = None
-
-            ##################################################################
-
-            # Read the output from RTLAMR
-            # Start RTLAMR if it is not already running
-            if rtlamr is None:
-                rtlamr = start_rtlamr(config)
-            else:
-                rtlamr.poll()
-                if rtlamr.returncode is not None:
-                    if LOG_LEVEL >= 3:
-                        logger.critical('RTLAMR has died, trying to restart...')
-                    if int(config['general']['sleep_for']) > 0:
-                        if LOG_LEVEL >= 2:
-                            logger.info('Sleep for is set to %d seconds...', int(config['general']['sleep_for']))
-                        sleep(int(config['general']['sleep_for']))
-                    rtlamr = start_rtlamr(config)
-                    if rtlamr is not None:
-                        rtlamr.poll()
-
-            if rtlamr is None:
-                if LOG_LEVEL >= 3:
-                    logger.critical('Failed to start RTLAMR. Exiting...')
-                shutdown(
-                            rtlamr=rtlamr,
-                            rtltcp=rtltcp,
-                            mqtt_client=mqtt_client,
-                            base_topic=config['mqtt']['base_topic'],
-                            offline=True
-                        )
-                sys.exit(1)
-
-            try:
-                rtlamr_output = rtlamr.stdout.readline().strip()
-                # rtlamr_output = rtlamr.stdout.read1().strip()
-            except KeyboardInterrupt:
-                logger.critical('Interrupted by user.')
-                keep_reading = False
-                break
-            except Exception as e:
-                logger.critical(e)
-                keep_reading = False
-                break
-
-            if rtlamr_output:
-                logger.debug('Received rtlamr message: %s', rtlamr_output)
-                reading = ro.get_message(rtlamr_output)
 
-                if reading:
-                    logger.debug('Received reading: %s', reading)
-                    publish_discovery_if_new(reading['meter_id'])
-
-            # Search for ID in the output
-            reading = ro.get_message_for_ids(
-                rtlamr_output = rtlamr_output,
-                meter_ids_list = meter_ids_list
-            )
-
-            if reading is not None:
-                # Add the meter_id to the read_counter
-                if reading['meter_id'] not in read_counter:
-                    read_counter.append(reading['meter_id'])
-
-                consumption = reading['consumption']
-                if (decimals := config.get('meters', {}).get(reading.get('meter_id'), {}).get('decimals')):
-                    consumption = ro.format_number_with_decimals(consumption, decimals)
-                elif (meter_format := config.get('meters', {}).get(reading.get('meter_id'), {}).get('format')):
-                    consumption = ro.format_number(consumption, meter_format)
-
-                # Publish the reading to MQTT
-                # First, make sure the status is set to online
-                mqtt_client.publish(
-                    topic=f'{config["mqtt"]["base_topic"]}/status',
-                    payload='online',
-                    qos=1,
-                    retain=False
-                )
-                # Then, send the reading
-                payload = { 'reading': consumption, 'lastseen': get_iso8601_timestamp() }
-                mqtt_client.publish(
-                    topic=f'{config["mqtt"]["base_topic"]}/{reading["meter_id"]}/state',
-                    payload=dumps(payload),
-                    qos=1,
-                    retain=False
-                )
-
-                # Publish the meter attributes to MQTT
-                # # Add the meter protocol to the list of attributes
-                # reading['message']['protocol'] = config['meters'][reading['meter_id']]['protocol']
-                mqtt_client.publish(
-                    topic=f'{config["mqtt"]["base_topic"]}/{reading["meter_id"]}/attributes',
-                    payload=dumps(reading['message']),
-                    qos=1,
-                    retain=False
-                )
-
-            if config['general']['sleep_for'] > 0 and len(read_counter) == len(meter_ids_list):
-                # We have our readings, so we can sleep
-                if LOG_LEVEL >= 2:
-                    logger.info('All readings received.')
-                    logger.info('Sleeping for %d seconds...', config["general"]["sleep_for"])
-                # Shutdown everything, but mqtt_client
-                shutdown(rtlamr=rtlamr, rtltcp=rtltcp, mqtt_client=None)
-                read_counter = []
                 try:
-                    sleep(int(config['general']['sleep_for']))
+                    # The lines rtlamr has written since the last loop, or the messages of the NumPy decoder
+                    rtlamr_lines = rtlamr.stdout.drain()
+                    # rtl_tcp writes a few lines when rtlamr connects, its pipe must not fill up
+                    if rtltcp not in [None, 'remote']:
+                        for rtltcp_output in rtltcp.stdout.drain():
+                            if LOG_LEVEL >= 4:
+                                logger.debug(rtltcp_output)
                 except KeyboardInterrupt:
                     logger.critical('Interrupted by user.')
                     keep_reading = False
-                    shutdown(
-                        rtlamr=rtlamr,
-                        rtltcp=rtltcp,
-                        mqtt_client=mqtt_client,
-                        base_topic=config['mqtt']['base_topic'],
-                        offline=True
-                    )
                     break
-                except Exception:
-                    logger.critical('Term siganal received. Exiting...')
+                except Exception as e:
+                    logger.critical(e)
                     keep_reading = False
-                    shutdown(
-                        rtlamr=rtlamr,
-                        rtltcp=rtltcp,
-                        mqtt_client=mqtt_client,
-                        base_topic=config['mqtt']['base_topic'],
-                        offline=True
-                    )
                     break
-                if LOG_LEVEL >= 3:
-                    logger.info('Time to wake up!')
 
-            sleep(1)  # Sleep for a short time to avoid busy waiting
-        except RuntimeError as e:
-            # Handle the signal received
-            logger.critical('Runtime error: %s', e)
-            keep_reading = False
+                # Any message, of any meter, shows the receiver is working
+                if any(rtlamr_lines):
+                    last_output = monotonic()
+
+                # One message per line: sampled, and only formatted if it is logged
+                if LOG_LEVEL >= 4:
+                    for rtlamr_output in rtlamr_lines:
+                        if rtlamr_output:
+                            logger.debug('Received rtlamr message: %s', rtlamr_output, extra={ 'category': 'rtlamr' })
+
+                # Send the readings to all the sinks
+                # They write them from their own threads, so this never blocks.
+                # In cluster mode, only the owner of the meter does it.
+                for reading in readings_pipeline.run(rtlamr_lines):
+                    if cluster is None or cluster.handle_local(reading):
+                        put_reading(reading)
+
+                # After a read command, only the requested meters are waited for
+                wanted = read_wanted if read_wanted is not None else meter_ids_list
+                if config['general']['sleep_for'] > 0 and read_counter >= wanted:
+                    # We have our readings, so we can sleep
+                    if LOG_LEVEL >= 2:
+                        logger.info('All readings received.')
+                        logger.info('Sleeping for %d seconds...', config["general"]["sleep_for"])
+                    # Shutdown everything, but mqtt_client
+                    shutdown(rtlamr=rtlamr, rtltcp=rtltcp, mqtt_clients=None)
+                    rtlamr = None
+                    rtltcp = None
+                    read_counter.clear()
+                    # The readings just received answer the pending requests
+                    read_request = None
+                    try:
+                        read_wanted = sleep_for(int(config['general']['sleep_for'])) or None
+                    except KeyboardInterrupt:
+                        logger.critical('Interrupted by user.')
+                        keep_reading = False
+                        shutdown(
+                            rtlamr=rtlamr,
+                            rtltcp=rtltcp,
+                            mqtt_clients=mqtt_clients,
+                            offline=True,
+                            sinks=sinks
+                        )
+                        break
+                    except Exception:
+                        logger.critical('Term siganal received. Exiting...')
+                        keep_reading = False
+                        shutdown(
+                            rtlamr=rtlamr,
+                            rtltcp=rtltcp,
+                            mqtt_clients=mqtt_clients,
+                            offline=True,
+                            sinks=sinks
+                        )
+                        break
+                    if LOG_LEVEL >= 3:
+                        logger.info('Time to wake up!')
+
+                sleep(1)  # Sleep for a short time to avoid busy waiting
+            except RuntimeError as e:
+                # Handle the signal received
+                logger.critical('Runtime error: %s', e)
+                keep_reading = False
+    except RuntimeError as e:
+        # Handle the signal received during the startup
+        logger.critical('Runtime error: %s', e)
 
     # Shutdown
+    if warming_up:
+        rtltcp, rtlamr = stop_warm_up(startup)
     shutdown(
         rtlamr = rtlamr,
         rtltcp = rtltcp,
-        mqtt_client = mqtt_client,
-        base_topic=config['mqtt']['base_topic'],
-        offline=True
+        mqtt_clients=mqtt_clients,
+        offline=True,
+        sinks=sinks
     )
+    if proxy is not None:
+        proxy.stop()
+    if usb_monitor is not None:
+        usb_monitor.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measure the cost of each reading, from the rtlamr line to the MQTT payloads:
+the readings pipeline against the dictionaries and json.dumps path it
+replaced, on the same lines.
+
+For each path, it reports the time per reading and, with tracemalloc, the
+most memory allocated at once while processing a line (most of it is freed
+right away) and the bytes still held per line once it is processed.
+    python mock/pipeline_bench.py --readings 20000
+"""
+
+import os
+import sys
+import argparse
+import tracemalloc
+from json import dumps
+from time import perf_counter
+
+MOCK_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.environ.get('RTLAMR2MQTT_APP', os.path.join(os.path.dirname(MOCK_DIR), 'app'))
+if not os.path.isdir(APP_DIR):
+    # Inside the mock image
+    APP_DIR = '/opt/venv/app'
+sys.path.insert(0, APP_DIR)
+
+import helpers.pipeline as pl
+import helpers.read_output as ro
+import helpers.attributes as attrs
+
+LINES = [
+    '{"Time":"2025-05-05T21:25:04.891578823Z","Offset":0,"Length":0,"Type":"IDM","Message":{"Preamble":1431639715,"PacketTypeID":28,"PacketLength":92,"HammingCode":198,"ApplicationVersion":4,"ERTType":7,"ERTSerialNumber":33333333,"ConsumptionIntervalCount":76,"ModuleProgrammingState":188,"TamperCounters":"AwIAcw4A","AsynchronousCounters":0,"PowerOutageFlags":"AAAAAAAA","LastConsumptionCount":1978208,"DifferentialConsumptionIntervals":[26,26,27,26,26,24,24,24,24,24,26,26,26,27,26,26,26,26,24,23,48,23,24,25,25,24,25,24,25,25,23,23,22,23,23,23,24,25,25,25,25,25,26,23,23,22,23],"TransmitTimeOffset":3911,"SerialNumberCRC":43319,"PacketCRC":49515}}',
+    '{"Time":"2025-05-05T21:25:06.548266268Z","Offset":0,"Length":0,"Type":"SCM","Message":{"ID":60706301,"Type":7,"TamperPhy":1,"TamperEnc":2,"Consumption":7621974,"ChecksumVal":48922}}',
+    '{"Time":"2025-05-05T21:25:10.905527969Z","Offset":0,"Length":0,"Type":"R900","Message":{"ID":1111111111,"Unkn1":163,"NoUse":0,"BackFlow":0,"Consumption":4555831,"Unkn3":0,"Leak":2,"LeakNow":0}}',
+    '{"Time":"2025-05-05T21:25:11.001486809Z","Offset":0,"Length":0,"Type":"SCM","Message":{"ID":22222222,"Type":7,"TamperPhy":0,"TamperEnc":1,"Consumption":9480653,"ChecksumVal":8042}}',
+]
+METERS = {
+    '33333333': { 'format': '######.###' },
+    '22222222': {},
+    '60706301': { 'decimals': 2 },
+}
+LASTSEEN = '2025-05-05T21:25:11+00:00'
+
+
+def dict_path(line, meter_ids):
+    """
+    The readings as they were processed before the pipeline.
+    """
+    reading = ro.get_message(line)
+    reading = ro.get_message_for_ids(rtlamr_output=line, meter_ids_list=meter_ids)
+    if reading is None:
+        return []
+    # Repeated messages check of the gain calibration
+    message_key = (reading['consumption'], dumps(reading['message'], sort_keys=True))
+    consumption = reading['consumption']
+    meter = METERS.get(reading['meter_id'], {})
+    if (decimals := meter.get('decimals')):
+        consumption = ro.format_number_with_decimals(consumption, decimals)
+    elif (meter_format := meter.get('format')):
+        consumption = ro.format_number(consumption, meter_format)
+    record = {
+        'meter_id': reading['meter_id'],
+        'protocol': reading['message'].get('protocol'),
+        'consumption': reading['consumption'],
+        'reading': consumption,
+        'lastseen': LASTSEEN,
+        'time': 0.0,
+        'message': reading['message'],
+    }
+    state = dumps({ 'reading': record['reading'], 'lastseen': record['lastseen'] })
+    attributes = dumps(record['message'], separators=(',', ':'))
+    return [ (message_key, state.encode(), attributes.encode()) ]
+
+def build_pipeline(meter_ids):
+    """
+    The readings pipeline, with the MQTT serialization as its last stage.
+    """
+    writer = pl.PayloadWriter()
+    last_messages = {}
+    def match(items):
+        for meter_id, line in items:
+            if meter_id in meter_ids:
+                yield meter_id, line
+    def track(readings):
+        for reading in readings:
+            last_messages[reading.meter_id] = reading.raw
+            yield reading
+    def serialize(readings):
+        for reading in readings:
+            yield writer.state(reading.reading, reading.lastseen), writer.compact(attrs.DEFAULT_POLICY.select(reading.items()))
+    return pl.Pipeline([
+        ('identify', pl.identify),
+        ('match', match),
+        ('decode', pl.decode),
+        ('track', track),
+        ('format', pl.formatter(lambda: METERS, lambda: LASTSEEN, lambda: 0.0)),
+        ('serialize', serialize),
+    ])
+
+def measure(name, process, lines):
+    """
+    Process the lines one at a time, as the main loop does.
+    """
+    # Warm up the caches
+    for line in lines[:100]:
+        process(line)
+    start = perf_counter()
+    readings = 0
+    for line in lines:
+        readings += len(process(line))
+    elapsed = perf_counter() - start
+
+    kept = []
+    transient = 0
+    tracemalloc.start()
+    for line in lines:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        kept.append(process(line))
+        # The most memory used while processing this reading, freed or not
+        transient += tracemalloc.get_traced_memory()[1] - before
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {
+        'path': name,
+        'readings': readings,
+        'us_per_reading': round(elapsed / max(readings, 1) * 1e6, 1),
+        'peak_bytes': transient // len(lines),
+        'held_bytes': held // len(lines),
+    }
+
+def main():
+    """
+    Run the benchmark.
+    """
+    parser = argparse.ArgumentParser(description='Cost per reading of the readings pipeline.')
+    parser.add_argument('--readings', type=int, default=20000, help='rtlamr lines to process (default: 20000)')
+    args = parser.parse_args()
+
+    lines = [ LINES[n % len(LINES)] for n in range(args.readings) ]
+    meter_ids = set(METERS)
+    pipeline = build_pipeline(meter_ids)
+    results = [
+        measure('dicts', lambda line: dict_path(line, meter_ids), lines),
+        measure('pipeline', lambda line: list(pipeline.run((line,))), lines),
+    ]
+    print(f'{"path":<10} {"readings":>9} {"us/reading":>11} {"peak bytes/line":>16} {"held bytes/line":>16}')
+    for r in results:
+        print(f'{r["path"]:<10} {r["readings"]:>9} {r["us_per_reading"]:>11} {r["peak_bytes"]:>16} {r["held_bytes"]:>16}')
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Soak test for rtlamr2mqtt: run the real main() loop with the mock rtl_tcp
+and rtlamr for hours and check that memory, file descriptors and threads
+do not grow over time.
+
+While it runs, rtlamr and rtl_tcp are killed and the broker connections are
+dropped at regular intervals, to exercise the restart and reconnect paths.
+Resources are sampled every --interval seconds. After --warmup seconds, each
+series must not have an upward trend: the fitted slope must be positive and
+the growth between the first and the last third of the samples must be over
+the tolerance. Exits with 1 if a leak is found.
+
+It needs a MQTT broker, set in the configuration file:
+    python mock/soak.py --config soak.yaml --duration 14400
+"""
+
+import os
+import sys
+import signal
+import socket
+import argparse
+import threading
+import tracemalloc
+from time import monotonic
+from tempfile import NamedTemporaryFile
+from yaml import safe_load, safe_dump
+
+MOCK_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.environ.get('RTLAMR2MQTT_APP', os.path.join(os.path.dirname(MOCK_DIR), 'app'))
+if not os.path.isdir(APP_DIR):
+    # Inside the mock image, the mocks are in /usr/bin
+    APP_DIR = '/opt/venv/app'
+
+# Allowed growth over the run, per series
+TOLERANCES = {
+    'heap_kb': 512,
+    'rss_kb': 4096,
+    'fds': 2,
+    'threads': 2,
+    'children': 1,
+}
+
+
+def sample():
+    """
+    Sample the resources used by this process.
+    """
+    with open('/proc/self/statm', 'r', encoding='utf-8') as f:
+        rss_pages = int(f.read().split()[1])
+    children = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/stat', 'r', encoding='utf-8') as f:
+                # The process name can contain spaces, the ppid follows the closing parenthesis
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == os.getpid():
+            children += 1
+    return {
+        'time': monotonic(),
+        'heap_kb': tracemalloc.get_traced_memory()[0] // 1024,
+        'rss_kb': rss_pages * os.sysconf('SC_PAGE_SIZE') // 1024,
+        'fds': len(os.listdir('/proc/self/fd')),
+        'threads': threading.active_count(),
+        'children': children,
+    }
+
+def slope(times, values):
+    """
+    Least squares slope of values over times, per hour.
+    """
+    n = len(values)
+    mean_t, mean_v = sum(times) / n, sum(values) / n
+    var_t = sum((t - mean_t) ** 2 for t in times)
+    if var_t == 0:
+        return 0.0
+    return sum((t - mean_t) * (v - mean_v) for t, v in zip(times, values)) / var_t * 3600
+
+def median(values):
+    """
+    Median of a list of numbers.
+    """
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+def find_trends(samples, tolerances):
+    """
+    Check each series for an upward trend.
+    Returns { series: (slope per hour, growth, leaking) }.
+    """
+    results = {}
+    third = max(1, len(samples) // 3)
+    times = [ s['time'] for s in samples ]
+    for series, tolerance in tolerances.items():
+        values = [ s[series] for s in samples ]
+        growth = median(values[-third:]) - median(values[:third])
+        per_hour = slope(times, values)
+        results[series] = (per_hour, growth, per_hour > 0 and growth > tolerance)
+    return results
+
+def child_pids(name):
+    """
+    PIDs of the processes started by this process (or by unbuffer) whose command line contains name.
+    """
+    parents = { os.getpid() }
+    found = []
+    # Two passes to also find the grandchildren started by unbuffer
+    for _ in range(2):
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                with open(f'/proc/{pid}/stat', 'r', encoding='utf-8') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+                with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                    cmdline = f.read().replace(b'\0', b' ').decode(errors='replace')
+            except (OSError, IndexError, ValueError):
+                continue
+            if ppid in parents:
+                parents.add(int(pid))
+                if name in cmdline and int(pid) not in found:
+                    found.append(int(pid))
+    return found
+
+
+
+class FaultInjector(threading.Thread):
+    """
+    Kill rtlamr/rtl_tcp and drop the broker connections at regular intervals.
+    """
+    def __init__(self, mqtt_clients, restart_every, disconnect_every, stopping):
+        super().__init__(name='soak-faults', daemon=True)
+        self.mqtt_clients = mqtt_clients
+        self.restart_every = restart_every
+        self.disconnect_every = disconnect_every
+        self.stopping = stopping
+        self.counts = { 'rtlamr_kills': 0, 'rtltcp_kills': 0, 'disconnects': 0 }
+
+    def run(self):
+        start = monotonic()
+        next_restart = start + self.restart_every if self.restart_every > 0 else None
+        next_disconnect = start + self.disconnect_every if self.disconnect_every > 0 else None
+        while not self.stopping.wait(0.5):
+            now = monotonic()
+            if next_restart is not None and now >= next_restart:
+                next_restart = now + self.restart_every
+                # Mostly rtlamr, rtl_tcp every third time
+                kills = self.counts['rtlamr_kills'] + self.counts['rtltcp_kills']
+                name = 'rtl_tcp' if kills % 3 == 2 else 'rtlamr'
+                for pid in child_pids(name):
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                self.counts['rtltcp_kills' if name == 'rtl_tcp' else 'rtlamr_kills'] += 1
+            if next_disconnect is not None and now >= next_disconnect:
+                next_disconnect = now + self.disconnect_every
+                for mqtt_client in list(self.mqtt_clients):
+                    sock = mqtt_client.client.socket()
+                    if sock is not None:
+                        try:
+                            sock.shutdown(socket.SHUT_RDWR)
+                        except OSError:
+                            pass
+                self.counts['disconnects'] += 1
+
+
+
+def write_config(config_path, sleep_for):
+    """
+    Copy the configuration, with sleep_for changed if requested.
+    """
+    with open(config_path, 'r', encoding='utf-8') as f:
+        config = safe_load(f)
+    if sleep_for is not None:
+        config.setdefault('general', {})['sleep_for'] = sleep_for
+    with NamedTemporaryFile('w', suffix='.yaml', delete=False, encoding='utf-8') as f:
+        safe_dump(config, f)
+        return f.name
+
+def main():
+    """
+    Run the soak test.
+    """
+    parser = argparse.ArgumentParser(description='Soak test for rtlamr2mqtt, using the mock rtl_tcp and rtlamr.')
+    parser.add_argument('--config', required=True, help='Configuration file, with a reachable MQTT broker')
+    parser.add_argument('--duration', type=int, default=4 * 3600, help='Seconds to run (default: 4 hours)')
+    parser.add_argument('--warmup', type=int, default=300, help='Seconds ignored at the start (default: 300)')
+    parser.add_argument('--interval', type=int, default=30, help='Seconds between samples (default: 30)')
+    parser.add_argument('--restart-every', type=int, default=120, help='Seconds between rtlamr/rtl_tcp kills, 0 to disable')
+    parser.add_argument('--disconnect-every', type=int, default=300, help='Seconds between broker disconnects, 0 to disable')
+    parser.add_argument('--sleep-for', type=int, default=None, help='Override general.sleep_for, to soak the sleep mode')
+    parser.add_argument('--line-delay', default='0.01', help='Seconds between two mock rtlamr lines (default: 0.01)')
+    parser.add_argument('--csv', default=None, help='Write the samples to this CSV file')
+    args = parser.parse_args()
+
+    # Drive the mocks at a high rate
+    os.environ['RTLAMR2MQTT_USE_MOCK'] = '1'
+    os.environ['RTLAMR_MOCK_LINE_DELAY'] = args.line_delay
+    os.environ['RTLAMR_MOCK_MAX_PAUSE'] = '0'
+    os.environ['PATH'] = f'{MOCK_DIR}{os.pathsep}{os.environ["PATH"]}'
+
+    tracemalloc.start(10)
+    sys.path.insert(0, APP_DIR)
+    import rtlamr2mqtt as app
+
+    # Keep a reference to the MQTT clients to drop their connections
+    mqtt_clients = []
+    create_mqtt_client = app.create_mqtt_client
+    def create_and_keep_mqtt_client(broker, **kwargs):
+        mqtt_client = create_mqtt_client(broker, **kwargs)
+        mqtt_clients.append(mqtt_client)
+        return mqtt_client
+    app.create_mqtt_client = create_and_keep_mqtt_client
+
+    samples = []
+    snapshots = []
+    stopping = threading.Event()
+    faults = FaultInjector(mqtt_clients, args.restart_every, args.disconnect_every, stopping)
+
+    def sampler():
+        start = monotonic()
+        while not stopping.wait(args.interval):
+            elapsed = monotonic() - start
+            if elapsed >= args.warmup:
+                samples.append(sample())
+                if not snapshots:
+                    snapshots.append(tracemalloc.take_snapshot())
+            if elapsed >= args.duration:
+                snapshots.append(tracemalloc.take_snapshot())
+                stopping.set()
+                # main() stops on SIGTERM, like in the add-on
+                os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Thread(target=sampler, name='soak-sampler', daemon=True).start()
+    faults.start()
+
+    config_path = write_config(os.path.abspath(args.config), args.sleep_for)
+    sys.argv = [ sys.argv[0], config_path ]
+    try:
+        app.main()
+    except SystemExit as e:
+        print(f'main() exited with {e.code}')
+    finally:
+        stopping.set()
+        os.unlink(config_path)
+
+    if args.csv is not None and samples:
+        with open(args.csv, 'w', encoding='utf-8') as f:
+            f.write(','.join(samples[0].keys()) + '\n')
+            for s in samples:
+                f.write(','.join(str(value) for value in s.values()) + '\n')
+
+    print(f'Faults injected: {faults.counts}')
+    if len(samples) < 6:
+        print(f'Not enough samples to find a trend ({len(samples)}), run longer or sample more often.')
+        return 2
+    if len(snapshots) == 2:
+        print('Top heap growth:')
+        # Leave out the allocations of this script and of tracemalloc
+        ignore = [ tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, tracemalloc.__file__) ]
+        for stat in snapshots[1].filter_traces(ignore).compare_to(snapshots[0].filter_traces(ignore), 'lineno')[:10]:
+            print(f'  {stat}')
+    leaking = False
+    print(f'{"series":<10} {"first":>10} {"last":>10} {"growth":>10} {"per hour":>10}')
+    for series, (per_hour, growth, leak) in find_trends(samples, TOLERANCES).items():
+        leaking = leaking or leak
+        print(f'{series:<10} {samples[0][series]:>10} {samples[-1][series]:>10} {growth:>10} {per_hour:>10.1f}{"  LEAK" if leak else ""}')
+    print('FAILED: resource usage is growing.' if leaking else 'OK: no upward trend.')
+    return 1 if leaking else 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A cluster node for the cluster tests, run as its own process:
+    python cluster_node.py <broker port> <node id> <readings> <duration>
+
+readings is a JSON list of [ seconds since the start, meter_id, consumption ]:
+the readings this node hears. It prints a JSON line for each reading it
+publishes, then its stats.
+"""
+
+import os
+import sys
+import json
+import queue
+import logging
+from time import monotonic, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+import helpers.mqtt_client as m
+import helpers.cluster as clst
+
+
+def main():
+    port, node_id, readings, duration = int(sys.argv[1]), sys.argv[2], json.loads(sys.argv[3]), float(sys.argv[4])
+    logger = logging.getLogger(node_id)
+    start = monotonic()
+
+    def output(reading, how):
+        print(json.dumps({ 'node': node_id, 'meter_id': reading['meter_id'], 'consumption': reading['consumption'],
+                           'how': how, 'at': round(monotonic() - start, 2) }), flush=True)
+
+    inbox = queue.Queue(maxsize=1000)
+    mqtt_client = m.MQTTClient(logger, '127.0.0.1', port, log_level=0, inbox=inbox)
+    cluster = clst.Cluster(node_id, 'test/cluster', logger, heartbeat_interval=0.5, confirm_timeout=1,
+                           owner_timeout=30, dedup_window=30, log_level=0)
+    cluster.attach(mqtt_client, on_reading=lambda reading: output(reading, 'remote'))
+    mqtt_client.connect()
+    mqtt_client.loop_start()
+    mqtt_client.connected.wait(5)
+    print(json.dumps({ 'node': node_id, 'ready': True }), flush=True)
+
+    readings = sorted(readings)
+    while monotonic() - start < duration:
+        m.dispatch(inbox, logger, timeout=0.05)
+        now = monotonic() - start
+        while readings and readings[0][0] <= now:
+            _, meter_id, consumption = readings.pop(0)
+            reading = { 'meter_id': meter_id, 'consumption': consumption, 'reading': consumption,
+                        'lastseen': None, 'time': now, 'protocol': 'SCM', 'message': {} }
+            if cluster.handle_local(reading):
+                output(reading, 'local')
+        cluster.heartbeat()
+        for reading in cluster.expire():
+            output(reading, 'takeover')
+    print(json.dumps({ 'node': node_id, 'stats': cluster.stats() }), flush=True)
+    mqtt_client.disconnect()
+    sleep(0.2)
+    mqtt_client.loop_stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
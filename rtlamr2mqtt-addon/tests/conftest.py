@@ -0,0 +1,100 @@
+"""
+Shared fixtures. The helpers are imported from app/, as the add-on does.
+"""
+
+import os
+import sys
+import json
+import shutil
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app')
+sys.path.insert(0, APP_DIR)
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger('rtlamr2mqtt-tests')
+
+
+class StandInServer:
+    """
+    A local HTTP server standing in for InfluxDB or a webhook endpoint.
+    It answers with the statuses in responses, then with 204.
+    """
+    def __init__(self):
+        self.requests = []
+        self.responses = []
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                url = urlsplit(self.path)
+                with server.lock:
+                    server.requests.append({
+                        'path': url.path,
+                        'params': { key: value[0] for key, value in parse_qs(url.query).items() },
+                        'headers': dict(self.headers),
+                        'body': body,
+                    })
+                    status = server.responses.pop(0) if server.responses else 204
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def json(self, n):
+        return json.loads(self.requests[n]['body'])
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def stand_in():
+    server = StandInServer()
+    yield server
+    server.stop()
+
+
+class FakeSysfs:
+    """
+    A /sys/bus/usb/devices tree, with the attributes the add-on reads.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def plug(self, port, devnum, usb_id='0bda:2838', serial='00000001', busnum=1):
+        path = self.root / port
+        path.mkdir()
+        vendor_id, product_id = usb_id.split(':')
+        attributes = { 'idVendor': vendor_id, 'idProduct': product_id, 'busnum': str(busnum), 'devnum': str(devnum) }
+        if serial is not None:
+            attributes['serial'] = serial
+        for name, value in attributes.items():
+            (path / name).write_text(f'{value}\n')
+        # Its interface, without the ids
+        (self.root / f'{port}:1.0').mkdir()
+
+    def unplug(self, port):
+        shutil.rmtree(self.root / port)
+        shutil.rmtree(self.root / f'{port}:1.0')
+
+
+@pytest.fixture
+def sysfs(tmp_path):
+    return FakeSysfs(tmp_path)
@@ -0,0 +1,118 @@
+"""
+Attribute policies of the meters, alone and in the MQTT sink.
+"""
+
+import helpers.attributes as attrs
+import helpers.sinks as snk
+
+
+MESSAGE = [ ('Type', 7), ('TamperPhy', 0), ('TamperEnc', 1), ('ChecksumVal', 25453), ('protocol', 'SCM') ]
+
+
+class Client:
+    name = 'test'
+    base_topic = 'rtlamr'
+
+
+def reading(meter_id, consumption, time, **message):
+    return {
+        'meter_id': meter_id,
+        'reading': consumption,
+        'lastseen': 'now',
+        'time': time,
+        'message': dict(MESSAGE, **message),
+    }
+
+def attributes_published(sink, readings):
+    return [ payload for topic, payload in sink.serialize(readings) if topic.endswith('/attributes') ]
+
+
+def test_select_everything():
+    assert list(attrs.DEFAULT_POLICY.select(MESSAGE)) == MESSAGE
+
+def test_select_include():
+    policy = attrs.AttributePolicy(include=[ 'protocol', 'TamperPhy', 'Missing' ])
+    # In the order of the message
+    assert list(policy.select(MESSAGE)) == [ ('TamperPhy', 0), ('protocol', 'SCM') ]
+
+def test_select_exclude():
+    policy = attrs.AttributePolicy(exclude=[ 'ChecksumVal', 'Type' ])
+    assert list(policy.select(MESSAGE)) == [ ('TamperPhy', 0), ('TamperEnc', 1), ('protocol', 'SCM') ]
+
+def test_select_include_and_exclude():
+    policy = attrs.AttributePolicy(include=[ 'Type', 'ChecksumVal' ], exclude=[ 'ChecksumVal' ])
+    assert list(policy.select(MESSAGE)) == [ ('Type', 7) ]
+
+def test_should_publish_always():
+    assert attrs.DEFAULT_POLICY.should_publish(b'a', None, 0)
+    assert attrs.DEFAULT_POLICY.should_publish(b'a', (b'a', 0), 0)
+
+def test_should_publish_on_change():
+    policy = attrs.AttributePolicy(on_change=True)
+    assert policy.should_publish(b'a', None, 0)
+    assert not policy.should_publish(b'a', (b'a', 0), 10000)
+    assert policy.should_publish(b'b', (b'a', 0), 1)
+
+def test_should_publish_interval():
+    policy = attrs.AttributePolicy(interval=60)
+    assert policy.should_publish(b'a', None, 0)
+    assert not policy.should_publish(b'b', (b'a', 100), 159)
+    assert policy.should_publish(b'a', (b'a', 100), 160)
+
+def test_should_publish_on_change_and_interval():
+    policy = attrs.AttributePolicy(interval=60, on_change=True)
+    # Changed, but too soon
+    assert not policy.should_publish(b'b', (b'a', 100), 130)
+    assert policy.should_publish(b'b', (b'a', 100), 160)
+    # Late enough, but the same
+    assert not policy.should_publish(b'a', (b'a', 100), 1000)
+
+def test_build_policies():
+    policies = attrs.build_policies({
+        '1': { 'attributes_include': [ 'Type' ], 'attributes_interval': '300', 'attributes_on_change': True },
+        '2': { 'attributes_exclude': [ 'ChecksumVal' ] },
+        '3': {},
+    })
+    assert (policies['1'].include, policies['1'].exclude, policies['1'].interval, policies['1'].on_change) == ({ 'Type' }, set(), 300, True)
+    assert (policies['2'].include, policies['2'].exclude, policies['2'].interval, policies['2'].on_change) == (None, { 'ChecksumVal' }, 0, False)
+    assert list(policies['3'].select(MESSAGE)) == MESSAGE
+
+def test_sink_include_exclude():
+    sink = snk.MQTTSink(Client(), {
+        '1': { 'attributes_include': [ 'TamperPhy', 'protocol' ] },
+        '2': { 'attributes_exclude': [ 'ChecksumVal', 'Type', 'TamperEnc' ] },
+    }, logger=None)
+    assert attributes_published(sink, [ reading('1', 5, 0), reading('2', 5, 0), reading('3', 5, 0) ]) == [
+        b'{"TamperPhy":0,"protocol":"SCM"}',
+        b'{"TamperPhy":0,"protocol":"SCM"}',
+        # Not configured, everything
+        b'{"Type":7,"TamperPhy":0,"TamperEnc":1,"ChecksumVal":25453,"protocol":"SCM"}',
+    ]
+
+def test_sink_change_only():
+    sink = snk.MQTTSink(Client(), { '1': { 'attributes_on_change': True, 'attributes_exclude': [ 'ChecksumVal' ] } }, logger=None)
+    published = attributes_published(sink, [
+        reading('1', 5, 0),
+        # Only an excluded field has changed
+        reading('1', 6, 30, ChecksumVal=1),
+        reading('1', 7, 60, TamperPhy=1),
+        reading('1', 8, 90, TamperPhy=1),
+    ])
+    assert published == [
+        b'{"Type":7,"TamperPhy":0,"TamperEnc":1,"protocol":"SCM"}',
+        b'{"Type":7,"TamperPhy":1,"TamperEnc":1,"protocol":"SCM"}',
+    ]
+    # The state is published for every reading
+    assert len(list(sink.serialize([ reading('1', 9, 120, TamperPhy=1) ]))) == 1
+
+def test_sink_interval():
+    sink = snk.MQTTSink(Client(), { '1': { 'attributes_interval': 60 } }, logger=None)
+    published = attributes_published(sink, [ reading('1', 5, time) for time in [ 0, 30, 59, 60, 100, 121 ] ])
+    # At 0, 60 and 121
+    assert len(published) == 3
+
+def test_sink_policies_reloaded():
+    sink = snk.MQTTSink(Client(), { '1': {} }, logger=None)
+    assert len(attributes_published(sink, [ reading('1', 5, 0), reading('1', 5, 1) ])) == 2
+    sink.update_config({ 'meters': { '1': { 'attributes_on_change': True } } })
+    assert attributes_published(sink, [ reading('1', 5, 2) ]) == []
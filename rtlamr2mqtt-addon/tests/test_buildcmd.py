@@ -0,0 +1,35 @@
+"""
+Command line arguments of rtlamr.
+"""
+
+import helpers.buildcmd as cmd
+
+
+def config(rtlamr='', **general):
+    return {
+        'general': dict({ 'rtltcp_host': '127.0.0.1:1234' }, **general),
+        'custom_parameters': { 'rtlamr': rtlamr, 'rtltcp': '' },
+        'meters': { '1234': { 'protocol': 'scm' } },
+    }
+
+
+def test_partial_match_remove_consecutive():
+    args = [ '-server=a', '-server=b', '-unique=true', '-server=c' ]
+    assert cmd.partial_match_remove('-server', args) == [ '-unique=true' ]
+
+def test_custom_server_replaced():
+    args = cmd.build_rtlamr_args(config('-server=10.0.0.1:1234 -server=10.0.0.2:1234 -single=true'))
+    assert sorted(args) == [ '-format=json', '-server=127.0.0.1:1234', '-single=true', '-unique=true' ]
+
+def test_repeated_parameters_overridden():
+    autotune = { 'symbol_length': 8, 'decimation': 2 }
+    args = cmd.build_rtlamr_args(config('-symbollength=32 -symbollength=72 -decimation=1 -filterid=1 -filterid=2',
+                                        autotune=autotune, filter_ids=[ '1234' ], gain_calibration=True))
+    assert sorted(args) == [ '-decimation=2', '-filterid=1234', '-format=json', '-server=127.0.0.1:1234',
+                             '-symbollength=8', '-unique=false' ]
+
+def test_every_message_while_hopping():
+    options = config('-unique=true')
+    options['meters'] = { '1234': { 'protocol': 'scm' }, '5678': { 'protocol': 'r900', 'frequency': 920000000 } }
+    args = cmd.build_rtlamr_args(options)
+    assert '-unique=false' in args and '-unique=true' not in args
@@ -0,0 +1,162 @@
+"""
+Cluster mode: several node processes against a local broker, and the
+bookkeeping of a single node.
+"""
+
+import os
+import sys
+import json
+import queue
+import shutil
+import socket
+import subprocess
+from time import monotonic, sleep
+import pytest
+import paho.mqtt.client as mqtt
+import helpers.cluster as clst
+import helpers.mqtt_client as m
+
+NODE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cluster_node.py')
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+@pytest.fixture
+def broker(tmp_path):
+    """
+    A local MQTT broker, mosquitto or amqtt, whichever is installed.
+    """
+    port = free_port()
+    if shutil.which('mosquitto'):
+        conf = tmp_path / 'mosquitto.conf'
+        conf.write_text(f'listener {port} 127.0.0.1\nallow_anonymous true\n')
+        command = [ 'mosquitto', '-c', str(conf) ]
+    elif shutil.which('amqtt'):
+        conf = tmp_path / 'amqtt.yaml'
+        conf.write_text(f'listeners:\n  default:\n    type: tcp\n    bind: 127.0.0.1:{port}\n'
+                        'plugins:\n  amqtt.plugins.authentication.AnonymousAuthPlugin:\n    allow_anonymous: true\n')
+        command = [ 'amqtt', '-c', str(conf) ]
+    else:
+        pytest.skip('No MQTT broker (mosquitto or amqtt) installed')
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = monotonic() + 10
+    while monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            break
+        except OSError:
+            sleep(0.1)
+    else:
+        process.kill()
+        pytest.fail('The MQTT broker did not start')
+    yield port
+    process.terminate()
+    process.wait(5)
+
+def start_node(port, node_id, readings, duration):
+    return subprocess.Popen([ sys.executable, NODE, str(port), node_id, json.dumps(readings), str(duration) ],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+def wait_ready(nodes):
+    for node in nodes:
+        line = node.stdout.readline()
+        assert json.loads(line).get('ready'), node.stderr.read()
+
+def published(outputs):
+    return [ json.loads(line) for out in outputs for line in out.splitlines() if '"how"' in line ]
+
+def series(meter_id, start, count, step=0.4, first=1000):
+    return [ [ start + n * step, meter_id, first + n ] for n in range(count) ]
+
+
+def test_nodes_publish_each_reading_once(broker):
+    # a hears every reading of meter 1, b every other one; c alone hears meter 2
+    meter_1 = series('1', 3, 10)
+    nodes = [
+        start_node(broker, 'a', meter_1, 10),
+        start_node(broker, 'b', meter_1[::2], 10),
+        start_node(broker, 'c', series('2', 3, 5), 10),
+    ]
+    wait_ready(nodes)
+    outputs = [ node.communicate(timeout=30)[0] for node in nodes ]
+    readings = published(outputs)
+    keys = [ (r['meter_id'], r['consumption']) for r in readings ]
+    # Every reading exactly once
+    assert sorted(keys) == sorted([ ('1', r[2]) for r in meter_1 ] + [ ('2', r[2]) for r in series('2', 3, 5) ])
+    # By the node with the best reception
+    assert { r['node'] for r in readings if r['meter_id'] == '1' } == { 'a' }
+    assert { r['node'] for r in readings if r['meter_id'] == '2' } == { 'c' }
+
+def test_takeover_when_owner_dies(broker):
+    meter_1 = series('1', 3, 20)
+    owner = start_node(broker, 'a', meter_1, 14)
+    backup = start_node(broker, 'b', meter_1[::2], 14)
+    wait_ready([ owner, backup ])
+    sleep(6)
+    owner.kill()
+    killed_at = 6
+    owner_out = owner.communicate()[0]
+    backup_out = backup.communicate(timeout=30)[0]
+    by_owner = { r['consumption'] for r in published([ owner_out ]) }
+    by_backup = published([ backup_out ])
+    assert by_owner
+    # Each reading b heard after a was gone is published, by b
+    heard_later = { r[2] for r in meter_1[::2] if r[0] > killed_at + 0.5 }
+    assert heard_later
+    assert heard_later <= { r['consumption'] for r in by_backup }
+    assert not by_owner & { r['consumption'] for r in by_backup }
+
+
+class FakeClient:
+    def __init__(self):
+        self.handlers = {}
+        self.published = []
+
+    def add_handler(self, topic, handler, qos=0):
+        self.handlers[topic] = handler
+
+    def publish(self, topic, payload, qos=None, retain=False):
+        self.published.append(topic)
+
+
+def test_handled_by_dispatch(logger):
+    inbox = queue.Queue()
+    mqtt_client = m.MQTTClient(logger, '127.0.0.1', 1883, log_level=0, inbox=inbox)
+    cluster = clst.Cluster('a', 'test/cluster', logger, log_level=0)
+    cluster.attach(mqtt_client, on_reading=lambda reading: None)
+    message = mqtt.MQTTMessage(topic=b'test/cluster/nodes/b')
+    message.payload = json.dumps({ 'node': 'b', 'meters': { '1': { 'rate': 10, 'age': 0 } } }).encode()
+    # As paho's network thread calls it
+    mqtt_client.on_message(mqtt_client.client, None, message)
+    assert 'b' not in cluster.nodes
+    assert m.dispatch(inbox, logger) == 1
+    assert 'b' in cluster.nodes
+
+def test_forgets_old_meters_and_nodes(logger, monkeypatch):
+    now = [ 1000.0 ]
+    monkeypatch.setattr(clst, 'monotonic', lambda: now[0])
+    cluster = clst.Cluster('a', 'test/cluster', logger, owner_timeout=300, rate_window=3600, heartbeat_interval=15, log_level=0)
+    cluster.attach(FakeClient(), on_reading=lambda reading: None)
+    for n in range(100):
+        cluster._on_heartbeat('test/cluster/nodes/b', json.dumps({ 'node': 'b', 'meters': { f'm{n}': { 'rate': 1, 'age': 0 } } }))
+        cluster.handle_local({ 'meter_id': f'local{n}', 'consumption': n })
+        cluster._on_remote_reading('test/cluster/readings/x', json.dumps({ 'node': f'n{n}', 'rate': 1, 'reading': { 'meter_id': 'x', 'consumption': n } }))
+    assert len(cluster.receptions) == 201
+    # Only node b and the meter heard last stay
+    now[0] += 301
+    cluster._on_heartbeat('test/cluster/nodes/b', json.dumps({ 'node': 'b', 'meters': { 'm0': { 'rate': 1, 'age': 0 } } }))
+    cluster.heartbeat()
+    assert set(cluster.receptions) == { 'm0' }
+    assert set(cluster.nodes) == { 'b' }
+    # The rate of the local meters is kept for the rate window
+    assert len(cluster.heard) == 100
+    now[0] += 3600
+    cluster.last_heartbeat = 0
+    cluster.heartbeat()
+    assert cluster.heard == {}
+    assert cluster.receptions == {} and cluster.nodes == {}
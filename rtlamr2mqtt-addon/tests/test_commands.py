@@ -0,0 +1,37 @@
+"""
+Messages of the command topic.
+"""
+
+import pytest
+import rtlamr2mqtt as app
+
+
+@pytest.mark.parametrize('payload, expected', [
+    (b'reload', ('reload', [])),
+    (b'  READ 33333333 44444444\n', ('read', [ '33333333', '44444444' ])),
+    ('watch 55555555', ('watch', [ '55555555' ])),
+    (b'', (None, [])),
+    (b'   ', (None, [])),
+    # Unknown commands are returned, the main loop logs them
+    (b'explode now', ('explode', [ 'now' ])),
+    (b'\xffread', ('\ufffdread', [])),
+])
+def test_text(payload, expected):
+    assert app.parse_command(payload) == expected
+
+@pytest.mark.parametrize('payload, expected', [
+    (b'{"command": "read", "meter_id": "33333333"}', ('read', [ '33333333' ])),
+    (b'{"command": "Read", "meter_id": 33333333}', ('read', [ '33333333' ])),
+    (b'{"command": "unwatch", "meter_ids": [ 1, "2" ]}', ('unwatch', [ '1', '2' ])),
+    (b'{"command": "stats"}', ('stats', [])),
+    (b'{"command": "read", "meter_id": null}', ('read', [])),
+    (b'{"command": "bogus"}', ('bogus', [])),
+    # Without a command
+    (b'{"meter_id": "33333333"}', (None, [ '33333333' ])),
+    (b'{"command": null}', (None, [])),
+    # Malformed
+    (b'{"command": "read"', (None, [])),
+    (b'{command: read}', (None, [])),
+])
+def test_json(payload, expected):
+    assert app.parse_command(payload) == expected
@@ -0,0 +1,136 @@
+"""
+Where the unwatched meters are dropped, with the CPU time of the processes stubbed.
+"""
+
+import logging
+import pytest
+import helpers.filtering as flt
+
+
+class Cpu:
+    """
+    CPU seconds of the add-on and of the decoder, set by the tests.
+    """
+    def __init__(self):
+        self.addon = 0.0
+        self.decoder = 0.0
+        self.calls = 0
+
+    def process_tree_cpu_time(self, pid):
+        self.calls += 1
+        return self.decoder
+
+
+@pytest.fixture
+def cpu(monkeypatch):
+    stub = Cpu()
+    monkeypatch.setattr(flt, 'process_time', lambda: stub.addon)
+    monkeypatch.setattr(flt.tune, 'process_tree_cpu_time', stub.process_tree_cpu_time)
+    return stub
+
+
+def lines(controller, watched, unwatched):
+    for _ in range(watched):
+        controller.on_line(True)
+    for _ in range(unwatched):
+        controller.on_line(False)
+
+def evaluate(controller, cpu, start, addon, decoder, watched=100, unwatched=0, pid=42):
+    """
+    One evaluation window from start, using that much CPU. Returns what tick() returns at its end.
+    """
+    controller.tick(pid, now=start)
+    lines(controller, watched, unwatched)
+    cpu.addon += addon
+    cpu.decoder += decoder
+    return controller.tick(pid, now=start + controller.evaluation)
+
+
+def test_line_meter_id():
+    assert flt.line_meter_id('{"Type":"SCM","Message":{"ID":00123,"Consumption":5}}') == '123'
+    assert flt.line_meter_id('{"Type":"R900","Message":{"ID":9,"EndpointID":456}}') == '9'
+    assert flt.line_meter_id({ 'Message': { 'EndpointID': 22222222 } }) == '22222222'
+    assert flt.line_meter_id('rtlamr starting') is None
+
+def test_auto_with_discovery_stays_in_python(cpu, logger, caplog):
+    caplog.set_level(logging.INFO)
+    controller = flt.FilterController(logger, mode='auto', discovery=True, evaluation=60)
+    assert 'needs discovery: false' in caplog.text
+    assert controller.placement == 'python'
+    assert not evaluate(controller, cpu, 0, addon=30, decoder=1, unwatched=10000)
+    # Nothing is measured
+    assert cpu.calls == 0
+    assert controller.measured == {}
+    assert controller.filter_ids({ '1', '2' }) is None
+
+def test_auto_without_unwatched_meters(cpu, logger):
+    controller = flt.FilterController(logger, mode='auto', discovery=False, evaluation=60, min_unwatched_rate=10)
+    # 5 unwatched lines per minute are not worth restarting rtlamr
+    assert not evaluate(controller, cpu, 0, addon=3, decoder=1, unwatched=5)
+    assert controller.placement == 'python'
+    assert controller.measured['python'] == { 'cpu': 4.0, 'rate': 105.0, 'unwatched_rate': 5.0, 'time': 60 }
+
+def test_auto_measures_rtlamr_and_keeps_the_cheapest(cpu, logger):
+    controller = flt.FilterController(logger, mode='auto', discovery=False, evaluation=60, retry=6)
+    # Many unwatched meters: rtlamr is tried
+    assert evaluate(controller, cpu, 0, addon=6, decoder=2, unwatched=1000)
+    assert controller.placement == 'rtlamr'
+    assert controller.filter_ids({ '2', '1' }) == [ '1', '2' ]
+    # rtlamr is restarted, a new PID: cheaper, so it is kept
+    assert not evaluate(controller, cpu, 100, addon=1, decoder=2, pid=43)
+    assert controller.placement == 'rtlamr'
+    assert controller.measured['rtlamr']['cpu'] == 3.0
+    assert controller.switches == 1
+
+def test_auto_goes_back_to_python(cpu, logger):
+    controller = flt.FilterController(logger, mode='auto', discovery=False, evaluation=60, margin=0.1)
+    assert evaluate(controller, cpu, 0, addon=4, decoder=1, unwatched=1000)
+    # Filtering in rtlamr costs more
+    assert evaluate(controller, cpu, 100, addon=1, decoder=5, pid=43)
+    assert controller.placement == 'python'
+    assert controller.filter_ids({ '1' }) is None
+    # Only 5 % cheaper than rtlamr, under the margin: still python
+    assert not evaluate(controller, cpu, 200, addon=4.7, decoder=1, unwatched=1000, pid=44)
+    assert controller.placement == 'python'
+
+def test_auto_measures_again_after_retry(cpu, logger):
+    controller = flt.FilterController(logger, mode='auto', discovery=False, evaluation=60, retry=2)
+    assert evaluate(controller, cpu, 0, addon=4, decoder=1, unwatched=1000)
+    assert evaluate(controller, cpu, 100, addon=1, decoder=5, pid=43)
+    # The measurement of rtlamr is older than retry evaluations
+    assert evaluate(controller, cpu, 300, addon=4, decoder=1, unwatched=1000, pid=44)
+    assert controller.placement == 'rtlamr'
+
+def test_window_restarts_with_the_decoder(cpu, logger):
+    controller = flt.FilterController(logger, mode='auto', discovery=False, evaluation=60)
+    controller.tick(42, now=0)
+    cpu.addon += 100
+    # rtlamr restarted in the middle of the window, its CPU time was not spent with this placement
+    assert not controller.tick(43, now=60)
+    assert controller.measured == {}
+    assert not controller.tick(43, now=100)
+    # The decoder is gone
+    cpu.decoder = None
+    assert not controller.tick(43, now=130)
+    assert controller.measured == {}
+
+def test_fixed_modes(cpu, logger):
+    # rtlamr filters when asked to, even with discovery
+    controller = flt.FilterController(logger, mode='rtlamr', discovery=True)
+    assert controller.placement == 'rtlamr'
+    assert not controller.tick(42, now=0) and cpu.calls == 0
+    # Not with the NumPy decoder
+    assert flt.FilterController(logger, mode='rtlamr', can_filter=False).placement == 'python'
+    assert flt.FilterController(logger, mode='python', discovery=False).placement == 'python'
+
+def test_configure(cpu, logger):
+    controller = flt.FilterController(logger, mode='auto', discovery=False)
+    assert controller.configure('rtlamr', False, True)
+    assert controller.placement == 'rtlamr'
+    # Back to auto, the placement is kept until it is measured
+    assert not controller.configure('auto', False, True)
+    assert controller.placement == 'rtlamr'
+    # Discovery needs every meter
+    assert controller.configure('auto', True, True)
+    assert controller.placement == 'python'
+    assert controller.stats() == { 'mode': 'auto', 'placement': 'python', 'switches': 2, 'measured': {} }
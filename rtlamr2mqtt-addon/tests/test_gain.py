@@ -0,0 +1,194 @@
+"""
+Tuner gain calibration, with synthetic readings on a stubbed clock and proxy.
+"""
+
+import json
+import logging
+import pytest
+import helpers.gain as gn
+
+
+class FakeProxy:
+    def __init__(self, gain_count=None):
+        self.gain_count = gain_count
+        self.gain = None
+        self.gains = []
+
+    def set_gain(self, gain):
+        self.gain = gain
+        self.gains.append(gain)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+        self.wall = 1700000000.0
+
+    def advance(self, seconds):
+        self.now += seconds
+        self.wall += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    stub = Clock()
+    monkeypatch.setattr(gn, 'monotonic', lambda: stub.now)
+    monkeypatch.setattr(gn, 'time', lambda: stub.wall)
+    return stub
+
+
+def calibration(tmp_path, proxy, meter_ids=('1', '2', '3'), **kwargs):
+    kwargs.setdefault('dwell', 60)
+    return gn.GainCalibration(proxy, set(meter_ids), logging.getLogger('rtlamr2mqtt-tests'), key='rtl_tcp|0',
+                              cache_path=str(tmp_path / 'gain.json'), log_level=0, **kwargs)
+
+def listen(gain, clock, heard, messages):
+    """
+    One step: the meters in heard, and messages decoded in all.
+    """
+    for n in range(messages):
+        gain.on_message(heard[n % len(heard)] if heard else 'unwatched')
+    clock.advance(gain.dwell)
+    gain.tick()
+
+
+def test_waits_for_the_tuner(tmp_path, clock):
+    proxy = FakeProxy()
+    gain = calibration(tmp_path, proxy)
+    gain.tick()
+    assert gain.state == 'waiting'
+    assert proxy.gains == []
+    proxy.gain_count = 3
+    gain.tick()
+    assert gain.state == 'calibrating'
+    assert gain.steps == [ 'auto', 0, 1, 2 ]
+    assert proxy.gains == [ 'auto' ]
+
+def test_sweep_and_score(tmp_path, clock):
+    proxy = FakeProxy(gain_count=3)
+    gain = calibration(tmp_path, proxy)
+    gain.tick()
+    # Each gain in turn: the most meters heard wins, then the most messages
+    listen(gain, clock, [ '1', '2' ], 40)
+    assert proxy.gains == [ 'auto', 0 ]
+    listen(gain, clock, [ '1' ], 100)
+    listen(gain, clock, [ '1', '2', '3' ], 30)
+    assert gain.state == 'calibrating'
+    # Unwatched meters count as messages, not as heard meters
+    listen(gain, clock, [ '1', '2', '3', 'x', 'y' ], 50)
+    assert gain.state == 'locked'
+    assert gain.gain == 2
+    assert proxy.gains == [ 'auto', 0, 1, 2, 2 ]
+    assert gain.results == {
+        'auto': { 'rate': 40.0, 'heard': 0.667 },
+        0: { 'rate': 100.0, 'heard': 0.333 },
+        1: { 'rate': 30.0, 'heard': 1.0 },
+        2: { 'rate': 50.0, 'heard': 1.0 },
+    }
+    cached = json.loads((tmp_path / 'gain.json').read_text())
+    assert (cached['key'], cached['gain_count'], cached['gain'], cached['rate']) == ('rtl_tcp|0', 3, 2, 50.0)
+
+def test_cache_reused(tmp_path, clock):
+    proxy = FakeProxy(gain_count=2)
+    gain = calibration(tmp_path, proxy, interval=86400)
+    gain.tick()
+    for _ in range(3):
+        listen(gain, clock, [ '1', '2', '3' ], 10)
+    assert gain.state == 'locked'
+    # After a restart, the same receiver
+    proxy = FakeProxy(gain_count=2)
+    again = calibration(tmp_path, proxy, interval=86400)
+    again.tick()
+    assert again.state == 'locked'
+    assert (again.gain, again.locked_rate) == (gain.gain, 10.0)
+    assert proxy.gains == [ gain.gain ]
+    assert again.calibrations == 0
+
+@pytest.mark.parametrize('change', [ 'receiver', 'tuner', 'age', 'corrupted' ])
+def test_cache_not_reused(tmp_path, clock, change):
+    proxy = FakeProxy(gain_count=2)
+    gain = calibration(tmp_path, proxy, interval=86400)
+    gain.tick()
+    for _ in range(3):
+        listen(gain, clock, [ '1' ], 10)
+    proxy = FakeProxy(gain_count=3 if change == 'tuner' else 2)
+    again = calibration(tmp_path, proxy, interval=86400)
+    if change == 'receiver':
+        again.key = 'rtl_tcp|1'
+    elif change == 'age':
+        clock.advance(86401)
+    elif change == 'corrupted':
+        (tmp_path / 'gain.json').write_text('{')
+    again.tick()
+    assert again.state == 'calibrating'
+
+def test_nothing_heard(tmp_path, clock):
+    proxy = FakeProxy(gain_count=2)
+    gain = calibration(tmp_path, proxy)
+    gain.tick()
+    for _ in range(3):
+        listen(gain, clock, [], 0)
+    # The automatic gain, not saved for the next start
+    assert gain.state == 'locked'
+    assert gain.gain == 'auto'
+    assert proxy.gain == 'auto'
+    assert not (tmp_path / 'gain.json').exists()
+    # Calibrated again once messages are decoded
+    for n in range(5):
+        gain.on_message('1')
+    clock.advance(gain.window)
+    gain.tick()
+    assert gain.state == 'calibrating'
+    assert gain.calibrations == 2
+
+def test_unwatched_meters_only(tmp_path, clock):
+    proxy = FakeProxy(gain_count=1)
+    gain = calibration(tmp_path, proxy)
+    gain.tick()
+    listen(gain, clock, [], 10)
+    listen(gain, clock, [], 20)
+    # No watched meter heard, the most messages wins
+    assert gain.gain == 0
+    assert (tmp_path / 'gain.json').exists()
+
+def test_rate_drop(tmp_path, clock):
+    proxy = FakeProxy(gain_count=1)
+    gain = calibration(tmp_path, proxy, interval=0)
+    gain.tick()
+    listen(gain, clock, [ '1' ], 60)
+    listen(gain, clock, [ '1' ], 100)
+    assert (gain.state, gain.gain, gain.locked_rate) == ('locked', 0, 100.0)
+    # 60 messages per minute over the window: not a drop
+    for _ in range(600):
+        gain.on_message('1')
+    clock.advance(gain.window)
+    gain.tick()
+    assert gain.state == 'locked'
+    # 40 per minute, under half of the calibrated rate
+    for _ in range(400):
+        gain.on_message('1')
+    clock.advance(gain.window)
+    gain.tick()
+    assert gain.state == 'calibrating'
+
+def test_recalibrate_interval(tmp_path, clock):
+    proxy = FakeProxy(gain_count=1)
+    gain = calibration(tmp_path, proxy, interval=3600)
+    gain.tick()
+    listen(gain, clock, [ '1' ], 10)
+    listen(gain, clock, [ '1' ], 10)
+    assert gain.state == 'locked'
+    clock.advance(3600)
+    gain.tick()
+    assert gain.state == 'calibrating'
+    assert gain.stats()['step'] == '1/2'
+
+def test_cache_not_writable(tmp_path, clock):
+    proxy = FakeProxy(gain_count=1)
+    gain = calibration(tmp_path / 'missing', proxy)
+    gain.tick()
+    listen(gain, clock, [ '1' ], 10)
+    listen(gain, clock, [ '1' ], 10)
+    # Still locked, only for this run
+    assert gain.state == 'locked'
+    assert not gain.save()
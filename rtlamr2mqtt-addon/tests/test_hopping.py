@@ -0,0 +1,112 @@
+"""
+Frequency groups and the hopping scheduler, on a stubbed clock and proxy.
+"""
+
+import pytest
+import helpers.hopping as hop
+import rtlamr2mqtt as app
+
+
+class FakeProxy:
+    def __init__(self):
+        self.frequencies = []
+
+    def set_frequency(self, frequency):
+        self.frequencies.append(frequency)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [ 1000.0 ]
+    monkeypatch.setattr(hop, 'monotonic', lambda: now[0])
+    return now
+
+
+def scheduler(groups, **kwargs):
+    return hop.HoppingScheduler(groups, FakeProxy(), logger=None, log_level=0, **kwargs)
+
+
+METERS = {
+    '1': {},
+    '2': { 'frequency': 912000000, 'transmit_interval': 10 },
+    '3': { 'frequency': 915000000, 'transmit_interval': 60 },
+    '4': { 'frequency': 916900000 },
+}
+
+
+def test_frequency_groups():
+    groups = hop.frequency_groups(METERS)
+    # The default frequency and 912 MHz are less than 2 MHz apart, listened to at their center
+    assert groups == {
+        (912000000 + hop.DEFAULT_FREQUENCY) // 2: { 'meters': [ '2', '1' ], 'interval': 10 },
+        (915000000 + 916900000) // 2: { 'meters': [ '3', '4' ], 'interval': 30 },
+    }
+    assert hop.needs_hopping(METERS)
+
+def test_one_frequency():
+    assert hop.frequency_groups({ '1': {}, '2': { 'transmit_interval': 300 } }, default_interval=60) == {
+        hop.DEFAULT_FREQUENCY: { 'meters': [ '1', '2' ], 'interval': 60 },
+    }
+    assert not hop.needs_hopping({ '1': {}, '2': { 'frequency': hop.DEFAULT_FREQUENCY + hop.USABLE_BANDWIDTH } })
+    assert hop.needs_hopping({ '1': {}, '2': { 'frequency': hop.DEFAULT_FREQUENCY + hop.USABLE_BANDWIDTH + 1 } })
+    assert hop.frequency_groups({}) == {}
+
+def test_dwell_limits(clock):
+    groups = { 900000000: { 'meters': [ '1' ], 'interval': 2 }, 920000000: { 'meters': [ '2' ], 'interval': 500 } }
+    hopping = scheduler(groups, min_dwell=5, max_dwell=120)
+    assert hopping.dwell(900000000) == 5
+    assert hopping.dwell(920000000) == 120
+    assert hopping.proxy.frequencies == [ 900000000 ]
+
+def test_moves_on_when_all_heard(clock):
+    hopping = scheduler(hop.frequency_groups(METERS))
+    first, second = hopping.frequencies
+    hopping.on_reading('1')
+    hopping.tick()
+    assert hopping.proxy.frequencies == [ first ]
+    hopping.on_reading('2')
+    hopping.tick()
+    # Before the end of the slot
+    assert hopping.proxy.frequencies == [ first, second ]
+    assert hopping.stats()[first]['miss_rate'] == 0
+    assert hopping.stats()[first]['slots'] == 1
+
+def test_missed_meters_lengthen_the_slot(clock):
+    hopping = scheduler(hop.frequency_groups(METERS), min_dwell=5, max_dwell=120)
+    first, second = hopping.frequencies
+    assert hopping.dwell(first) == 10
+    # Only one of the two meters
+    hopping.on_reading('1')
+    clock[0] += 9
+    hopping.tick()
+    assert hopping.proxy.frequencies == [ first ]
+    clock[0] += 1
+    hopping.tick()
+    assert hopping.proxy.frequencies == [ first, second ]
+    assert hopping.state[first]['miss_rate'] == pytest.approx(0.15)
+    assert hopping.dwell(first) == pytest.approx(11.5)
+    # Nothing heard on the second group
+    clock[0] += 30
+    hopping.tick()
+    assert hopping.state[second]['miss_rate'] == pytest.approx(0.3)
+    assert hopping.proxy.frequencies == [ first, second, first ]
+
+def test_readings_of_the_other_group(clock):
+    hopping = scheduler(hop.frequency_groups(METERS))
+    first, second = hopping.frequencies
+    # Heard on the first group, the meters of the second one do not end its slot
+    hopping.on_reading('3')
+    hopping.on_reading('4')
+    hopping.on_reading('unknown')
+    hopping.tick()
+    assert hopping.proxy.frequencies == [ first ]
+    assert set(hopping.stats()[second]['last_heard']) == { '3', '4' }
+
+def test_repeated_readings_heard(clock):
+    # Meters reading the same value are printed by rtlamr, and counted by the hopping
+    config = { 'general': { 'decoder': 'rtlamr', 'gain_calibration': False }, 'meters': METERS }
+    assert not app.unique_output(config)
+    assert app.drop_repeated(config)
+    config['meters'] = { '1': {}, '2': {} }
+    assert app.unique_output(config)
+    assert not app.drop_repeated(config)
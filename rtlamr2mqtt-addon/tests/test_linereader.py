@@ -0,0 +1,95 @@
+"""
+Lines read from a pipe with bounded memory.
+"""
+
+import os
+import pytest
+import helpers.linereader as lr
+
+
+@pytest.fixture
+def pipe():
+    """
+    The reading end as a binary file, and a function writing to the other end.
+    """
+    read_fd, write_fd = os.pipe()
+    reader = os.fdopen(read_fd, 'rb')
+    writer = os.fdopen(write_fd, 'wb', buffering=0)
+    yield reader, writer
+    if not writer.closed:
+        writer.close()
+    if not reader.closed:
+        reader.close()
+
+
+def test_line_split_across_chunks(pipe):
+    reader, writer = pipe
+    lines = lr.LineReader(reader, chunk_size=8)
+    writer.write(b'{"Time":')
+    # One chunk read, the line is not complete yet
+    assert lines.fill() == 8
+    assert lines.readline() == ''
+    writer.write(b'"now"}\r\nnext\n')
+    assert lines.readline() == '{"Time":"now"}'
+    assert lines.readline() == 'next'
+    assert lines.readline() == ''
+    assert lines.stats['lines'] == 2
+
+def test_line_longer_than_max_line(pipe):
+    reader, writer = pipe
+    lines = lr.LineReader(reader, max_line=10, chunk_size=8)
+    writer.write(b'0123456789abcdefghij\nkept\n')
+    assert lines.drain() == [ '0123456789', 'kept' ]
+    assert lines.stats['truncated'] == 1
+    assert lines.stats['discarded_bytes'] == 10
+    # The line was cut once, not once per chunk
+    assert lines.stats['lines'] == 2
+
+def test_long_line_across_chunks_then_short_one(pipe):
+    reader, writer = pipe
+    lines = lr.LineReader(reader, max_line=10, chunk_size=8)
+    writer.write(b'01234')
+    writer.write(b'56789abcdef')
+    assert lines.drain() == [ '0123456789' ]
+    # The end of the long line is still dropped up to its newline
+    writer.write(b'ghij\nkept')
+    assert lines.drain() == []
+    writer.write(b'\n')
+    assert lines.drain() == [ 'kept' ]
+    assert lines.stats['truncated'] == 1
+    assert lines.stats['discarded_bytes'] == 10
+
+def test_last_line_without_newline(pipe):
+    reader, writer = pipe
+    lines = lr.LineReader(reader)
+    writer.write(b'first\nlast')
+    assert lines.drain() == [ 'first' ]
+    writer.close()
+    assert lines.drain() == [ 'last' ]
+    assert lines.stats['unterminated'] == 1
+    assert lines.eof
+    assert lines.readline() == ''
+
+def test_drain_limit(pipe):
+    reader, writer = pipe
+    lines = lr.LineReader(reader, chunk_size=16)
+    writer.write(b''.join(b'line %d\n' % n for n in range(25)))
+    assert lines.drain(limit=10) == [ f'line {n}' for n in range(10) ]
+    # The others are not lost
+    assert lines.drain(limit=10) == [ f'line {n}' for n in range(10, 20) ]
+    assert lines.drain() == [ f'line {n}' for n in range(20, 25) ]
+    assert lines.drain() == []
+
+def test_stats_kept_from_one_reader_to_the_next(pipe):
+    reader, writer = pipe
+    stats = lr.new_stats()
+    lines = lr.LineReader(reader, stats=stats)
+    writer.write(b'one\n')
+    assert lines.drain() == [ 'one' ]
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b'two\n')
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as second:
+        assert lr.LineReader(second, stats=stats).drain() == [ 'two' ]
+    assert stats['lines'] == 2
+    assert stats['bytes'] == 8
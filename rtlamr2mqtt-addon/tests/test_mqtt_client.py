@@ -0,0 +1,165 @@
+"""
+Delivery metrics of the MQTT client, with a stand-in for the paho client, and the dispatch of its messages.
+"""
+
+import queue
+import threading
+from time import monotonic, sleep
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.reasoncodes import ReasonCode
+import helpers.mqtt_client as m
+
+
+SUCCESS = ReasonCode(PacketTypes.PUBACK, 'Success')
+
+
+class MessageInfo:
+    def __init__(self, mid):
+        self.mid = mid
+        self.rc = mqtt.MQTT_ERR_SUCCESS
+
+
+class FakePaho:
+    """
+    Acknowledges each message from publish() itself, before it returns,
+    as paho's network thread can do on a fast broker.
+    Messages with QoS 1 are only acknowledged when ack_early is True.
+    """
+    def __init__(self, ack_early, delay=0):
+        self.ack_early = ack_early
+        self.delay = delay
+        self.mid = 0
+        self.unacked = []
+        self.published = []
+        self.disconnected_after = None
+        self.on_publish = None
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        # A slow network
+        sleep(self.delay)
+        self.mid += 1
+        self.published.append(topic)
+        if qos == 0 or self.ack_early:
+            self.on_publish(self, None, self.mid, SUCCESS, None)
+        else:
+            self.unacked.append(self.mid)
+        return MessageInfo(self.mid)
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+    def disconnect(self):
+        self.disconnected_after = list(self.published)
+
+
+def publish_all(client, messages, timeout=5):
+    client.connected.set()
+    client.loop_start()
+    for topic, qos in messages:
+        client.publish(topic, 'payload', qos=qos)
+    deadline = monotonic() + timeout
+    while client.metrics['published'] < len(messages) and monotonic() < deadline:
+        sleep(0.01)
+    client.loop_stop()
+
+
+def make_client(logger, ack_early, delay=0):
+    client = m.MQTTClient(logger, '127.0.0.1', 1883, log_level=0)
+    client.client = FakePaho(ack_early, delay)
+    client.client.on_publish = client.on_publish
+    return client
+
+
+def test_ack_before_publish_returns(logger):
+    client = make_client(logger, ack_early=True)
+    publish_all(client, [ ('a', 1) ] * 50 + [ ('b', 0) ] * 50)
+    stats = client.stats()
+    assert stats['published'] == 100
+    assert stats['delivered'] == 100
+    # Nothing left waiting for an acknowledgement
+    assert stats['inflight'] == 0
+    assert client.acked == {}
+    assert stats['last_latency'] is not None
+
+def test_ack_after_publish_returns(logger):
+    client = make_client(logger, ack_early=False)
+    publish_all(client, [ ('a', 1) ] * 10)
+    assert client.stats()['inflight'] == 10
+    for mid in client.client.unacked:
+        client.on_publish(client.client, None, mid, SUCCESS, None)
+    stats = client.stats()
+    assert stats['inflight'] == 0
+    assert stats['delivered'] == 10
+
+def test_callbacks(logger):
+    client = m.MQTTClient(logger, '127.0.0.1', 1883, log_level=0)
+    assert client.client._callback_api_version == mqtt.CallbackAPIVersion.VERSION2
+    client.client = FakePaho(ack_early=True)
+    client.on_connect(client.client, None, None, ReasonCode(PacketTypes.CONNACK, 'Not authorized'), None)
+    assert not client.connected.is_set()
+    client.on_connect(client.client, None, None, ReasonCode(PacketTypes.CONNACK, 'Success'), None)
+    assert client.connected.is_set()
+    assert client.metrics['connects'] == 1
+    client.on_disconnect(client.client, None, None, ReasonCode(PacketTypes.DISCONNECT, 'Unspecified error'), None)
+    assert not client.connected.is_set()
+    assert client.metrics['disconnects'] == 1
+
+def test_disconnect_waits_for_the_publisher(logger):
+    client = make_client(logger, ack_early=True, delay=0.05)
+    client.connected.set()
+    client.loop_start()
+    for n in range(10):
+        client.publish(f'topic/{n}', 'payload', qos=1)
+    client.disconnect(timeout=5)
+    # The last message taken from the queue was published before disconnecting
+    assert client.client.disconnected_after == [ f'topic/{n}' for n in range(10) ]
+    client.loop_stop()
+
+def test_disconnect_deadline(logger):
+    client = make_client(logger, ack_early=True, delay=0.5)
+    client.connected.set()
+    client.loop_start()
+    for n in range(10):
+        client.publish(f'topic/{n}', 'payload', qos=1)
+    start = monotonic()
+    client.disconnect(timeout=0.2)
+    assert monotonic() - start < 0.5
+    assert len(client.client.disconnected_after) < 10
+    client.loop_stop()
+
+def test_dispatch_waits_for_the_first_message_only(logger):
+    inbox = queue.Queue()
+    handled = []
+    start = monotonic()
+    assert m.dispatch(inbox, logger, timeout=0.2) == 0
+    assert monotonic() - start >= 0.2
+    # A message arrives while waiting, the next ones are handled without waiting
+    threading.Timer(0.1, inbox.put, [ (lambda topic, payload: handled.append(payload), 'a', b'1') ]).start()
+    start = monotonic()
+    assert m.dispatch(inbox, logger, timeout=5) == 1
+    assert monotonic() - start < 1
+    for n in range(3):
+        inbox.put((lambda topic, payload: handled.append(payload), 'a', n))
+    start = monotonic()
+    assert m.dispatch(inbox, logger, timeout=5) == 3
+    assert monotonic() - start < 1
+    assert handled == [ b'1', 0, 1, 2 ]
+
+def test_dispatch_handler_error(logger, caplog):
+    inbox = queue.Queue()
+    handled = []
+    def fail(topic, payload):
+        raise KeyError(payload)
+    inbox.put((fail, 'rtlamr/command', b'bad'))
+    inbox.put((lambda topic, payload: handled.append(payload), 'rtlamr/command', b'good'))
+    # Logged, the other messages are still handled
+    assert m.dispatch(inbox, logger) == 2
+    assert handled == [ b'good' ]
+    assert 'Failed to handle MQTT message on rtlamr/command' in caplog.text
@@ -0,0 +1,95 @@
+"""
+MQTT payloads written by the readings pipeline, compared with json.dumps.
+"""
+
+import json
+import pytest
+import helpers.pipeline as pl
+import helpers.read_output as ro
+import helpers.sinks as snk
+
+
+LASTSEEN = '2026-10-19T10:55:58.123456+00:00'
+
+LINES = [
+    # SCM
+    '{"Time":"2026-10-19T10:55:58.1","Offset":0,"Length":0,"Type":"SCM","Message":'
+    '{"ID":33333333,"Type":7,"TamperPhy":0,"TamperEnc":1,"Consumption":1234567,"ChecksumVal":25453}}',
+    # SCM+
+    '{"Time":"2026-10-19T10:55:58.2","Offset":0,"Length":0,"Type":"SCM+","Message":'
+    '{"FrameSync":5795,"ProtocolID":30,"EndpointType":7,"EndpointID":22222222,"Consumption":987,"Tamper":2304,"PacketCRC":41511}}',
+    # IDM, with a list
+    '{"Time":"2026-10-19T10:55:58.3","Offset":0,"Length":0,"Type":"IDM","Message":'
+    '{"Preamble":5440,"PacketLength":92,"ApplicationVersion":4,"ERTType":7,"ERTSerialNumber":11111111,'
+    '"ConsumptionIntervalCount":42,"TamperCounters":"AgMAAAAA","LastConsumptionCount":4200,'
+    '"DifferentialConsumptionIntervals":[0,1,2,0,15],"TransmitTimeOffset":1184,"SerialNumberCRC":6069}}',
+    # R900, with booleans, a float and a string that is not ASCII
+    '{"Time":"2026-10-19T10:55:58.4","Offset":0,"Length":0,"Type":"R900","Message":'
+    '{"ID":44444444,"Unkn1":163,"NoUse":0,"BackFlow":false,"Consumption":5,"Unkn3":0,"Leak":true,"LeakNow":0,'
+    '"Signal":-12.5,"Note":"caf\\u00e9 \\"a\\""}}',
+]
+
+METERS = {
+    '33333333': { 'name': 'electric' },
+    '22222222': { 'name': 'gas', 'format': '#####.###' },
+    '11111111': { 'name': 'electric 2', 'decimals': 2, 'attributes_exclude': [ 'TamperCounters' ] },
+    '44444444': { 'name': 'water', 'decimals': 3, 'attributes_include': [ 'Leak', 'Signal', 'Note', 'protocol' ] },
+}
+
+
+class RecordingClient:
+    name = 'test'
+    base_topic = 'rtlamr'
+
+
+def expected(line):
+    """
+    The payloads as they were built with dictionaries and json.dumps.
+    """
+    parsed = ro.get_message(line)
+    meter = METERS[parsed['meter_id']]
+    reading = parsed['consumption']
+    if meter.get('decimals'):
+        reading = ro.format_number_with_decimals(reading, meter['decimals'])
+    elif meter.get('format'):
+        reading = ro.format_number(reading, meter['format'])
+    include, exclude = meter.get('attributes_include'), meter.get('attributes_exclude') or []
+    attributes = { key: value for key, value in parsed['message'].items()
+                   if (include is None or key in include) and key not in exclude }
+    return [
+        (f'rtlamr/{parsed["meter_id"]}/state', json.dumps({ 'reading': reading, 'lastseen': LASTSEEN }).encode()),
+        (f'rtlamr/{parsed["meter_id"]}/attributes', json.dumps(attributes, separators=(',', ':')).encode()),
+    ]
+
+def run(lines, size=1024):
+    pipeline = pl.Pipeline([
+        ('identify', pl.identify),
+        ('decode', pl.decode),
+        ('format', pl.formatter(lambda: METERS, lambda: LASTSEEN, lambda: 1000.0)),
+    ])
+    sink = snk.MQTTSink(RecordingClient(), METERS, logger=None)
+    sink.writer = pl.PayloadWriter(size=size)
+    return list(sink.serialize(list(pipeline.run(lines))))
+
+
+@pytest.mark.parametrize('line', LINES, ids=[ 'scm', 'scm+', 'idm', 'r900' ])
+def test_payloads_as_json_dumps(line):
+    assert run([ line ]) == expected(line)
+
+def test_buffer_reused():
+    # A long payload grows the buffer, the next shorter ones are not followed by its end
+    payloads = run(LINES + LINES, size=64)
+    assert payloads == [ payload for each in LINES for payload in expected(each) ] * 2
+
+def test_numpy_decoder_messages():
+    # The NumPy decoder messages are already decoded, with the same fields
+    message = json.loads(LINES[0])
+    assert run([ message ]) == expected(LINES[0])
+    # Not modified, the decoder message is shared
+    assert message == json.loads(LINES[0])
+
+def test_writer_values():
+    writer = pl.PayloadWriter(size=4)
+    for value in [ 0, -12, 2 ** 70, 1.5, 1e-7, True, None, 'é\n"', [ 1, 'a', 2.5 ], { 'a': [ True ] } ]:
+        assert writer.compact([ ('k', value) ]) == json.dumps({ 'k': value }, separators=(',', ':')).encode()
+        assert writer.state(value, None) == json.dumps({ 'reading': value, 'lastseen': None }).encode()
@@ -0,0 +1,179 @@
+"""
+Reloading the configuration: only what has changed is restarted.
+"""
+
+import copy
+import logging
+import pytest
+import yaml
+import helpers.config as cnf
+import rtlamr2mqtt as app
+
+
+BASE = {
+    'general': { 'verbosity': 'info', 'rtltcp_host': '127.0.0.1:1234' },
+    'mqtt': { 'host': '127.0.0.1', 'base_topic': 'rtlamr' },
+    'custom_parameters': { 'rtlamr': '-unique=true', 'rtltcp': '-s 2048000' },
+    'meters': [
+        { 'id': 33333333, 'protocol': 'scm', 'name': 'water' },
+        { 'id': 44444444, 'protocol': 'scm', 'name': 'gas' },
+    ],
+}
+
+
+class RecordingClient:
+    """
+    An MQTT client that keeps what is published.
+    """
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload, retain=False, **kwargs):
+        self.published.append((topic, payload))
+
+
+def load(tmp_path, options, name='rtlamr2mqtt.yaml'):
+    path = tmp_path / name
+    path.write_text(yaml.safe_dump(options))
+    err, msg, config = cnf.load_config(str(path), supervisor=False)
+    assert err == 'success', msg
+    return path, config
+
+def changed(tmp_path, edit, base=None):
+    """
+    The changes found after edit() modifies the base options.
+    """
+    base = BASE if base is None else base
+    _, old_config = load(tmp_path, base, 'old.yaml')
+    options = copy.deepcopy(base)
+    edit(options)
+    _, new_config = load(tmp_path, options, 'new.yaml')
+    return cnf.diff_config(old_config, new_config)
+
+def restarted(changes):
+    return { key for key in [ 'rtltcp', 'rtlamr', 'mqtt', 'sinks', 'cluster' ] if changes[key] }
+
+
+def test_meters_only(tmp_path):
+    def edit(options):
+        options['meters'][0]['name'] = 'cold water'
+        options['meters'][1] = { 'id': 55555555, 'protocol': 'scm', 'name': 'heat' }
+    changes = changed(tmp_path, edit)
+    assert restarted(changes) == set()
+    assert changes['meters_changed'] == [ '33333333' ]
+    assert changes['meters_added'] == [ '55555555' ]
+    assert changes['meters_removed'] == [ '44444444' ]
+
+def test_meter_protocol(tmp_path):
+    def edit(options):
+        options['meters'].append({ 'id': 55555555, 'protocol': 'scm+' })
+    # rtlamr is not told the protocols of the meters
+    assert restarted(changed(tmp_path, edit)) == set()
+    numpy = copy.deepcopy(BASE)
+    numpy['general']['decoder'] = 'numpy'
+    assert restarted(changed(tmp_path, edit, numpy)) == { 'rtlamr' }
+
+def test_hopping_frequencies(tmp_path):
+    hopping = copy.deepcopy(BASE)
+    hopping['meters'][1]['frequency'] = 915000000
+    # Still hopping, only the scheduler changes
+    assert restarted(changed(tmp_path, lambda options: options['meters'][1].update(frequency=920000000), hopping)) == set()
+    # Not hopping anymore, the decoder reads from rtl_tcp
+    assert restarted(changed(tmp_path, lambda options: options['meters'][1].pop('frequency'), hopping)) == { 'rtlamr' }
+
+def test_nothing_changed(tmp_path):
+    changes = changed(tmp_path, lambda options: None)
+    assert restarted(changes) == set()
+    assert changes['meters_added'] == changes['meters_removed'] == changes['meters_changed'] == []
+
+@pytest.mark.parametrize('edit', [
+    lambda options: options['general'].update(rtltcp_host='192.168.1.10:1234,192.168.1.11:1234'),
+    lambda options: options['general'].update(device_id='001:005'),
+    lambda options: options['custom_parameters'].update(rtltcp='-s 2048000 -p 1'),
+])
+def test_rtltcp_settings(tmp_path, edit):
+    # rtlamr connects to rtl_tcp, it is restarted with it
+    assert restarted(changed(tmp_path, edit)) == { 'rtltcp', 'rtlamr' }
+
+@pytest.mark.parametrize('edit', [
+    lambda options: options['custom_parameters'].update(rtlamr='-unique=true -single=true'),
+    lambda options: options['general'].update(decoder='numpy'),
+    lambda options: options['general'].update(decoder_symbol_length=32),
+    lambda options: options['meters'][1].update(frequency=915000000),
+])
+def test_rtlamr_settings(tmp_path, edit):
+    assert restarted(changed(tmp_path, edit)) == { 'rtlamr' }
+
+def test_mqtt_and_cluster_settings(tmp_path):
+    assert restarted(changed(tmp_path, lambda options: options['mqtt'].update(port=1884))) == { 'mqtt' }
+    assert restarted(changed(tmp_path, lambda options: options.update(cluster={ 'enabled': True }))) == { 'cluster' }
+
+
+class Reload:
+    """
+    reload_config() on the base options, with shutdown() recorded.
+    """
+    def __init__(self, tmp_path, monkeypatch):
+        self.path, self.config = load(tmp_path, BASE)
+        self.client = RecordingClient()
+        self.meter_ids = set(self.config['meters'])
+        self.stopped = []
+        monkeypatch.setattr(app, 'shutdown', lambda rtlamr=None, rtltcp=None, **kwargs: self.stopped.append((rtlamr, rtltcp)))
+
+    def __call__(self, edit):
+        options = copy.deepcopy(BASE)
+        edit(options)
+        self.path.write_text(yaml.safe_dump(options))
+        return app.reload_config(str(self.path), self.config, [ self.client ], self.meter_ids, 'rtlamr', 'rtltcp', [])
+
+@pytest.fixture
+def reload(tmp_path, monkeypatch):
+    return Reload(tmp_path, monkeypatch)
+
+
+def test_reload_meters_in_place(reload):
+    def edit(options):
+        options['meters'][0]['name'] = 'cold water'
+        options['meters'][1] = { 'id': 55555555, 'protocol': 'scm', 'name': 'heat' }
+    config, rtlamr, rtltcp, sinks = reload(edit)
+    # Nothing is restarted
+    assert (rtlamr, rtltcp, sinks) == ('rtlamr', 'rtltcp', [])
+    assert reload.stopped == []
+    assert config['meters']['33333333']['name'] == 'cold water'
+    assert reload.meter_ids == { '33333333', '55555555' }
+    topics = { topic: payload for topic, payload in reload.client.published }
+    # The removed meter is removed from Home Assistant, the others announced again
+    assert topics['homeassistant/device/44444444/config'] == ''
+    assert 'homeassistant/device/55555555/config' in topics
+    assert 'homeassistant/device/33333333/config' in topics
+
+def test_reload_rtltcp_hosts(reload):
+    config, rtlamr, rtltcp, _ = reload(lambda options: options['general'].update(rtltcp_host='192.168.1.10:1234'))
+    assert reload.stopped == [ ('rtlamr', 'rtltcp') ]
+    assert (rtlamr, rtltcp) == (None, None)
+    assert config['general']['rtltcp_host'] == '192.168.1.10:1234'
+
+def test_reload_rtlamr_only(reload):
+    _, rtlamr, rtltcp, _ = reload(lambda options: options['custom_parameters'].update(rtlamr='-unique=true -single=true'))
+    assert reload.stopped == [ ('rtlamr', None) ]
+    assert (rtlamr, rtltcp) == (None, 'rtltcp')
+
+def test_reload_keeps_mqtt_and_cluster(reload, caplog):
+    caplog.set_level(logging.WARNING)
+    def edit(options):
+        options['mqtt']['port'] = 1884
+        options['cluster'] = { 'enabled': True, 'node_id': 'other' }
+    config, rtlamr, rtltcp, _ = reload(edit)
+    assert 'MQTT settings have changed' in caplog.text
+    assert 'Cluster settings have changed' in caplog.text
+    # The running settings are kept until the add-on is restarted
+    assert config['brokers'][0]['port'] == 1883
+    assert config['cluster'] == reload.config['cluster']
+    assert (rtlamr, rtltcp) == ('rtlamr', 'rtltcp')
+
+def test_reload_invalid_file(reload):
+    reload.path.write_text('general: [')
+    config, rtlamr, rtltcp, _ = app.reload_config(str(reload.path), reload.config, [ reload.client ], reload.meter_ids,
+                                                  'rtlamr', 'rtltcp', [])
+    assert config is reload.config
+    assert (rtlamr, rtltcp) == ('rtlamr', 'rtltcp')
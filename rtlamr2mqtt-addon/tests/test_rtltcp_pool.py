@@ -0,0 +1,114 @@
+"""
+Choice of the remote rtl_tcp server, against fake rtl_tcp servers.
+"""
+
+import socket
+import threading
+import pytest
+import helpers.rtltcp_pool as pool
+
+
+class FakeRtlTcp:
+    """
+    Accepts connections and sends the rtl_tcp header, like an idle rtl_tcp server.
+    """
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.host = f'127.0.0.1:{self.sock.getsockname()[1]}'
+        self.connections = 0
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            conn.sendall(b'RTL0' + bytes(8))
+            conn.close()
+
+    def stop(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def servers():
+    fakes = [ FakeRtlTcp(), FakeRtlTcp() ]
+    yield fakes
+    for fake in fakes:
+        fake.stop()
+
+def closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    host = f'127.0.0.1:{sock.getsockname()[1]}'
+    sock.close()
+    return host
+
+
+def test_primary_first(servers, logger):
+    rtltcp_pool = pool.RtlTcpPool([ fake.host for fake in servers ], logger, probe_timeout=1)
+    host = rtltcp_pool.candidate()
+    assert host == servers[0].host
+    rtltcp_pool.activate(host)
+    stats = rtltcp_pool.stats()
+    # Not penalised for being used
+    assert stats[servers[0].host]['failures'] == 0
+    assert stats[servers[0].host]['healthy'] is not False
+    assert stats[servers[0].host]['active']
+
+def test_primary_kept_when_probed_healthy(servers, logger):
+    rtltcp_pool = pool.RtlTcpPool([ fake.host for fake in servers ], logger, probe_timeout=1)
+    for fake in servers:
+        assert rtltcp_pool.probe(fake.host)
+    # Starting again, e.g. after rtlamr was restarted, stays on the active server
+    assert rtltcp_pool.candidate() == servers[0].host
+    assert all(health['failures'] == 0 for health in rtltcp_pool.stats().values())
+
+def test_failed_start_moves_on(servers, logger):
+    rtltcp_pool = pool.RtlTcpPool([ fake.host for fake in servers ], logger, probe_timeout=1, log_level=0)
+    host = rtltcp_pool.candidate()
+    # rtlamr could not start on it
+    rtltcp_pool.mark_failed(host)
+    assert rtltcp_pool.candidate([ host ]) == servers[1].host
+    assert rtltcp_pool.stats()[host]['failures'] == 1
+
+def test_failed_probe_moves_on(servers, logger):
+    down = closed_port()
+    rtltcp_pool = pool.RtlTcpPool([ down, servers[1].host ], logger, probe_timeout=1, log_level=0)
+    assert not rtltcp_pool.probe(down)
+    assert rtltcp_pool.candidate() == servers[1].host
+    rtltcp_pool.activate(servers[1].host)
+    assert rtltcp_pool.stats()[servers[1].host]['active']
+
+def test_lowest_latency_when_active_failed(servers, logger):
+    third = FakeRtlTcp()
+    try:
+        rtltcp_pool = pool.RtlTcpPool([ servers[0].host, servers[1].host, third.host ], logger, probe_timeout=1, log_level=0)
+        for host in rtltcp_pool.hosts:
+            rtltcp_pool.probe(host)
+        rtltcp_pool.health[servers[1].host]['latency'] = 0.5
+        rtltcp_pool.health[third.host]['latency'] = 0.001
+        rtltcp_pool.mark_failed(servers[0].host)
+        assert rtltcp_pool.candidate() == third.host
+    finally:
+        third.stop()
+
+def test_all_failed_probed_again(servers, logger):
+    rtltcp_pool = pool.RtlTcpPool([ fake.host for fake in servers ], logger, probe_timeout=1, log_level=0)
+    for fake in servers:
+        rtltcp_pool.mark_failed(fake.host)
+    # Both are back, they are probed again instead of giving up
+    assert rtltcp_pool.candidate() in [ fake.host for fake in servers ]
+
+def test_none_left(logger):
+    hosts = [ closed_port(), closed_port() ]
+    rtltcp_pool = pool.RtlTcpPool(hosts, logger, probe_timeout=1, log_level=0)
+    assert rtltcp_pool.candidate(tried=hosts[:1]) == hosts[1]
+    rtltcp_pool.mark_failed(hosts[1])
+    assert rtltcp_pool.candidate(tried=hosts) is None
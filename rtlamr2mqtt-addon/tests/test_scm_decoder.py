@@ -0,0 +1,140 @@
+"""
+NumPy SCM/SCM+ decoder, on synthetic packets modulated as rtl_tcp samples.
+"""
+
+import socket
+import threading
+from time import monotonic, sleep
+import pytest
+import helpers.scm_decoder as scm
+
+np = pytest.importorskip('numpy')
+
+SYMBOL_LENGTH = 8
+
+
+def scm_packet(meter_id, consumption, meter_type=7):
+    """
+    A 12 bytes SCM packet, with its BCH checksum.
+    """
+    bits = [ int(b) for b in scm.PROTOCOLS['scm']['preamble'] ]
+    bits += [ int(b) for b in format((meter_id >> 24) & 3, '02b') ]
+    bits += [ 0, 0, 0 ] + [ int(b) for b in format(meter_type, '04b') ] + [ 0, 0 ]
+    bits += [ int(b) for b in format(consumption, '024b') ]
+    bits += [ int(b) for b in format(meter_id & 0xFFFFFF, '024b') ]
+    data = np.packbits(bits + [ 0 ] * 16).tobytes()
+    return data[:10] + scm.crc16(data[2:10], 0x6F63).to_bytes(2, 'big')
+
+def scmplus_packet(meter_id, consumption):
+    """
+    A 16 bytes SCM+ packet, with its CRC.
+    """
+    body = bytes([ 0x16, 0xA3, 0x1E, 0x07 ]) + meter_id.to_bytes(4, 'big') + consumption.to_bytes(4, 'big') + bytes(2)
+    return body + (scm.crc16(body[2:], 0x1021, 0xFFFF) ^ 0xFFFF).to_bytes(2, 'big')
+
+def modulate(packets, gap=4000, noise=6, seed=1):
+    """
+    On-off keyed, Manchester encoded packets, as 8 bits I/Q samples with a random phase and noise.
+    """
+    rng = np.random.default_rng(seed)
+    chips = []
+    for packet in packets:
+        chips.append(np.zeros(gap))
+        for bit in np.unpackbits(np.frombuffer(packet, np.uint8)):
+            chips.append(np.repeat([ bit, 1 - bit ], SYMBOL_LENGTH).astype(float))
+    chips.append(np.zeros(gap))
+    amplitude = np.concatenate(chips) * 40 + 3
+    phase = rng.uniform(0, 2 * np.pi)
+    i = 127.4 + amplitude * np.cos(phase) + rng.normal(0, noise, len(amplitude))
+    q = 127.4 + amplitude * np.sin(phase) + rng.normal(0, noise, len(amplitude))
+    return np.clip(np.stack([ i, q ], 1).ravel(), 0, 255).astype(np.uint8).tobytes()
+
+def decode(raw, protocols=('scm', 'scm+'), block=65536):
+    decoder = scm.BlockDecoder(protocols, symbol_length=SYMBOL_LENGTH)
+    messages = []
+    for start in range(0, len(raw), block):
+        messages += decoder.decode(raw[start:start + block])
+    # Flush the tail kept for the next block
+    messages += decoder.decode(bytes(2 * decoder.packet_span))
+    return decoder, messages
+
+def ids(messages):
+    return [ (m['Type'], m['Message'].get('ID', m['Message'].get('EndpointID')), m['Message']['Consumption']) for m in messages ]
+
+
+def test_packets_round_trip():
+    assert scm.parse_scm(scm_packet(33333333, 12345))['Message']['ID'] == 33333333
+    assert scm.parse_scmplus(scmplus_packet(22222222, 987654))['Message']['EndpointID'] == 22222222
+
+def test_decodes_scm_and_scmplus():
+    raw = modulate([ scm_packet(33333333, 12345), scmplus_packet(22222222, 987654), scm_packet(44444444, 5) ])
+    decoder, messages = decode(raw)
+    assert sorted(ids(messages)) == sorted([ ('SCM', 33333333, 12345), ('SCM+', 22222222, 987654), ('SCM', 44444444, 5) ])
+    assert decoder.stats['decoded'] == 3
+
+def test_packet_across_blocks():
+    raw = modulate([ scm_packet(33333333, 12345) ], gap=3000)
+    # The packet starts in the first block and ends in the following ones
+    _, messages = decode(raw, block=2 * 3000 + 500)
+    assert ids(messages) == [ ('SCM', 33333333, 12345) ]
+
+def test_only_configured_protocols():
+    raw = modulate([ scm_packet(33333333, 12345), scmplus_packet(22222222, 987654) ])
+    _, messages = decode(raw, protocols=[ 'scm+' ])
+    assert ids(messages) == [ ('SCM+', 22222222, 987654) ]
+
+def test_corrupted_packet_dropped():
+    packet = bytearray(scm_packet(33333333, 12345))
+    packet[6] ^= 0x10
+    decoder, messages = decode(modulate([ bytes(packet) ]))
+    assert messages == []
+    assert decoder.stats['crc_errors'] >= 1
+
+def test_noise_only():
+    _, messages = decode(modulate([], gap=50000, noise=20))
+    assert messages == []
+
+def test_meter_protocols():
+    assert scm.meter_protocols({ '1': { 'protocol': 'scm' } }) == [ 'scm' ]
+    assert scm.meter_protocols({ '1': { 'protocol': 'SCM+' }, '2': { 'protocol': 'scm' } }) == [ 'scm', 'scm+' ]
+    # Without a protocol, a meter can be either
+    assert scm.meter_protocols({ '1': {} }) == [ 'scm', 'scm+' ]
+
+def serve_once(raw, port):
+    """
+    A rtl_tcp server for one client: the header, then the samples once the tuner is set up.
+    """
+    server = socket.create_server(('127.0.0.1', 0))
+    port.append(server.getsockname()[1])
+    conn, _ = server.accept()
+    conn.sendall(b'RTL0' + bytes(8))
+    # Sample rate, frequency and gain mode
+    received = b''
+    while len(received) < 15:
+        received += conn.recv(15 - len(received))
+    conn.sendall(raw)
+    conn.shutdown(socket.SHUT_WR)
+    conn.recv(1)
+    conn.close()
+    server.close()
+
+def test_burst_drained_at_once(logger):
+    # Many meters at once
+    raw = modulate([ scm_packet(10000000 + n, n) for n in range(30) ], gap=500)
+    port = []
+    threading.Thread(target=serve_once, args=(raw, port), daemon=True).start()
+    while not port:
+        sleep(0.01)
+    decoder = scm.NumpyDecoder(f'127.0.0.1:{port[0]}', [ 'scm' ], symbol_length=SYMBOL_LENGTH,
+                               block_samples=4096, logger=logger, log_level=0)
+    assert decoder.start()
+    deadline = monotonic() + 10
+    while decoder.poll() is None and monotonic() < deadline:
+        sleep(0.05)
+    # All of them are waiting, a loop iteration takes up to limit
+    messages = decoder.stdout.drain(limit=10)
+    assert len(messages) == 10
+    messages += decoder.stdout.drain()
+    assert sorted(m['Message']['ID'] for m in messages) == [ 10000000 + n for n in range(30) ]
+    assert decoder.stdout.drain() == []
+    assert decoder.decoder.stats['dropped'] == 0
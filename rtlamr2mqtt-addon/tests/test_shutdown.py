@@ -0,0 +1,103 @@
+"""
+Signals during the startup: the add-on stops its children and exits.
+"""
+
+import os
+import sys
+import signal
+import socket
+import subprocess
+import threading
+from time import monotonic, sleep
+import pytest
+from conftest import APP_DIR
+
+
+STUCK_RTLTCP = '''#!/bin/sh
+echo $$ > "{pid_file}"
+echo "Found 1 device(s)"
+exec sleep 300
+'''
+
+CONFIG = '''general:
+  verbosity: info
+mqtt:
+  base_topic: rtlamr
+meters:
+  - id: 33333333
+    protocol: scm
+'''
+
+
+class SilentServer:
+    """
+    Accepts connections and never answers, like a Supervisor that does not respond.
+    """
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.address = f'127.0.0.1:{self.sock.getsockname()[1]}'
+        self.connections = []
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                self.connections.append(self.sock.accept()[0])
+            except OSError:
+                return
+
+    def stop(self):
+        self.sock.close()
+        for conn in self.connections:
+            conn.close()
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    # A zombie is gone too
+    with open(f'/proc/{pid}/stat', encoding='utf-8') as f:
+        return f.read().split(')')[-1].split()[0] != 'Z'
+
+
+@pytest.mark.skipif(not os.access('/usr/bin/unbuffer', os.X_OK), reason='unbuffer (expect) is not installed')
+def test_sigterm_while_warming_up(tmp_path):
+    pid_file = tmp_path / 'rtl_tcp.pid'
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    rtltcp = bin_dir / 'rtl_tcp'
+    rtltcp.write_text(STUCK_RTLTCP.format(pid_file=pid_file))
+    rtltcp.chmod(0o755)
+    config = tmp_path / 'rtlamr2mqtt.yaml'
+    config.write_text(CONFIG)
+    supervisor = SilentServer()
+    # No MQTT host: the broker is looked up from the Supervisor, which does not answer
+    env = dict(os.environ, PATH=f'{bin_dir}:{os.environ["PATH"]}', RTLAMR2MQTT_USE_MOCK='1',
+               SUPERVISOR_TOKEN='token', HTTP_PROXY=f'http://{supervisor.address}', NO_PROXY='')
+    app = subprocess.Popen([ sys.executable, os.path.join(APP_DIR, 'rtlamr2mqtt.py'), str(config) ],
+                           env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    try:
+        deadline = monotonic() + 20
+        while not pid_file.exists() and monotonic() < deadline:
+            sleep(0.1)
+        assert pid_file.exists(), 'rtl_tcp was not started'
+        rtltcp_pid = int(pid_file.read_text())
+        sleep(0.5)
+        # rtl_tcp is not ready and the Supervisor has not answered
+        assert app.poll() is None
+        assert alive(rtltcp_pid)
+        start = monotonic()
+        app.send_signal(signal.SIGTERM)
+        output = app.communicate(timeout=20)[0]
+        assert monotonic() - start < 10, output
+        assert 'Signal 15 received' in output
+        assert not alive(rtltcp_pid), output
+    finally:
+        if app.poll() is None:
+            app.kill()
+            app.communicate()
+        supervisor.stop()
@@ -0,0 +1,166 @@
+"""
+Sinks writing to a local stand-in server and to files.
+"""
+
+import csv
+import json
+import base64
+from time import monotonic, sleep
+import helpers.pipeline as pl
+import helpers.sinks as snk
+
+
+def make_reading(meter_id='22222222', consumption=9480653, time=1746480311.0):
+    message = { 'ID': int(meter_id), 'Type': 7, 'TamperPhy': 0, 'Consumption': consumption }
+    reading = pl.Reading(meter_id, 'SCM', consumption, message, ('ID', 'Consumption'))
+    reading.lastseen = '2025-05-05T21:25:11+00:00'
+    reading.time = time
+    return reading
+
+def run(sink, readings, timeout=10):
+    """
+    Queue the readings, in one batch, and wait for the sink to write them or give up.
+    It does not retry once it is stopped.
+    """
+    for reading in readings:
+        sink.put(reading)
+    sink.start()
+    deadline = monotonic() + timeout
+    while sink.stats['written'] + sink.stats['failed'] < len(readings) and monotonic() < deadline:
+        sleep(0.01)
+    sink.stop()
+    return sink
+
+
+def test_influxdb_v2(stand_in, logger):
+    sink = snk.InfluxDBSink(stand_in.url, bucket='meters', org='home', token='secret', flush_interval=0, logger=logger)
+    run(sink, [ make_reading(), make_reading('33333333', 1978208, 1746480312.5) ])
+    assert sink.stats['written'] == 2
+    assert len(stand_in.requests) == 1
+    request = stand_in.requests[0]
+    assert request['path'] == '/api/v2/write'
+    assert request['params'] == { 'bucket': 'meters', 'org': 'home', 'precision': 'ns' }
+    assert request['headers']['Authorization'] == 'Token secret'
+    assert request['body'].decode().split('\n') == [
+        'rtlamr,meter_id=22222222,protocol=SCM consumption=9480653i,reading=9480653.0 1746480311000000000',
+        'rtlamr,meter_id=33333333,protocol=SCM consumption=1978208i,reading=1978208.0 1746480312500000000',
+    ]
+
+def test_influxdb_v1(stand_in, logger):
+    sink = snk.InfluxDBSink(stand_in.url, measurement='water meter', database='home', username='user', password='pass', flush_interval=0, logger=logger)
+    run(sink, [ make_reading() ])
+    request = stand_in.requests[0]
+    assert request['path'] == '/write'
+    assert request['params'] == { 'db': 'home', 'precision': 'ns' }
+    assert request['headers']['Authorization'] == 'Basic ' + base64.b64encode(b'user:pass').decode()
+    assert request['body'].decode().startswith('water\\ meter,meter_id=22222222,')
+
+def test_influxdb_retries(stand_in, logger):
+    stand_in.responses = [ 500, 503 ]
+    sink = snk.InfluxDBSink(stand_in.url, bucket='meters', retries=3, retry_backoff=0.01, flush_interval=0, logger=logger, log_level=0)
+    run(sink, [ make_reading() ])
+    # Written on the third attempt
+    assert len(stand_in.requests) == 3
+    assert sink.stats['written'] == 1
+    assert sink.stats['failed'] == 0
+
+def test_webhook(stand_in, logger):
+    sink = snk.WebhookSink(f'{stand_in.url}/readings', headers={ 'X-Token': 'abc' }, batch_size=10, flush_interval=0, logger=logger)
+    run(sink, [ make_reading(), make_reading('33333333', 1978208) ])
+    assert sink.stats['written'] == 2
+    request = stand_in.requests[0]
+    assert request['path'] == '/readings'
+    assert request['headers']['X-Token'] == 'abc'
+    body = stand_in.json(0)
+    assert [ reading['meter_id'] for reading in body ] == [ '22222222', '33333333' ]
+    assert body[0]['reading'] == 9480653
+    assert body[0]['message'] == { 'Type': 7, 'TamperPhy': 0, 'protocol': 'SCM' }
+
+def test_webhook_gives_up(stand_in, logger):
+    stand_in.responses = [ 500 ] * 10
+    sink = snk.WebhookSink(stand_in.url, retries=2, retry_backoff=0.01, flush_interval=0, logger=logger, log_level=0)
+    run(sink, [ make_reading() ])
+    assert len(stand_in.requests) == 3
+    assert sink.stats['written'] == 0
+    assert sink.stats['failed'] == 1
+
+def test_webhook_unreachable(logger):
+    # Nothing listens on port 9 of the loopback
+    sink = snk.WebhookSink('http://127.0.0.1:9/readings', timeout=1, retries=1, retry_backoff=0.01, flush_interval=0, logger=logger, log_level=0)
+    run(sink, [ make_reading() ])
+    assert sink.stats['failed'] == 1
+
+def test_queue_drops_oldest(logger):
+    sink = snk.WebhookSink('http://127.0.0.1:9', max_queue=2, flush_interval=0, logger=logger)
+    # Not started, the readings stay in the queue
+    for n in range(5):
+        sink.put(make_reading(consumption=n))
+    assert sink.stats['dropped'] == 3
+    assert [ sink.queue.get_nowait().consumption for _ in range(2) ] == [ 3, 4 ]
+
+def test_file_ndjson(tmp_path, logger):
+    path = tmp_path / 'readings.ndjson'
+    sink = run(snk.FileSink(str(path), flush_interval=0, logger=logger), [ make_reading(), make_reading('33333333', 1978208) ])
+    assert sink.stats['written'] == 2
+    lines = [ json.loads(line) for line in path.read_text().splitlines() ]
+    assert [ line['meter_id'] for line in lines ] == [ '22222222', '33333333' ]
+    assert lines[1]['consumption'] == 1978208
+    assert lines[0]['lastseen'] == '2025-05-05T21:25:11+00:00'
+
+def test_file_csv_header_once(tmp_path, logger):
+    path = tmp_path / 'readings.csv'
+    run(snk.FileSink(str(path), file_format='csv', flush_interval=0, logger=logger), [ make_reading() ])
+    run(snk.FileSink(str(path), file_format='csv', flush_interval=0, logger=logger), [ make_reading('33333333', 1978208) ])
+    rows = list(csv.DictReader(path.open()))
+    assert [ row['meter_id'] for row in rows ] == [ '22222222', '33333333' ]
+    assert rows[0]['protocol'] == 'SCM'
+    assert rows[1]['reading'] == '1978208'
+
+def test_file_rotation(tmp_path, logger):
+    path = tmp_path / 'readings.ndjson'
+    sink = snk.FileSink(str(path), max_bytes=1, backup_count=2, batch_size=1, flush_interval=0, logger=logger)
+    for n in range(4):
+        sink.write([ make_reading(consumption=n) ])
+    # Rotated before each write once the file is not empty, only 2 backups are kept
+    assert json.loads(path.read_text())['consumption'] == 3
+    assert json.loads((tmp_path / 'readings.ndjson.1').read_text())['consumption'] == 2
+    assert json.loads((tmp_path / 'readings.ndjson.2').read_text())['consumption'] == 1
+    assert not (tmp_path / 'readings.ndjson.3').exists()
+
+def test_sinks_named_by_config(tmp_path, logger):
+    config = {
+        'meters': {},
+        'sinks': [
+            { 'type': 'file', 'name': 'file', 'path': str(tmp_path / 'a') },
+            { 'type': 'webhook', 'name': 'webhook-1', 'url': 'http://127.0.0.1:9' },
+            { 'type': 'webhook', 'name': 'webhook-2', 'url': 'http://127.0.0.1:9' },
+        ],
+    }
+    sinks = snk.build_sinks(config, [], logger)
+    try:
+        assert [ sink.name for sink in sinks ] == [ 'file', 'webhook-1', 'webhook-2' ]
+        assert sinks[2]._thread.name == 'sink-webhook-2'
+    finally:
+        for sink in sinks:
+            sink.stop()
+
+def test_sink_names_from_config(tmp_path):
+    import helpers.config as cnf
+    path = tmp_path / 'config.yaml'
+    path.write_text('''
+mqtt:
+  host: 127.0.0.1
+sinks:
+  - { type: webhook, url: "http://a" }
+  - { type: file, path: "/tmp/readings" }
+  - { type: webhook, url: "http://b" }
+  - { type: webhook, name: backup, url: "http://c" }
+meters:
+  - { id: 22222222, protocol: scm, name: energy }
+''')
+    err, msg, config = cnf.load_config(str(path), supervisor=False)
+    assert err == 'success', msg
+    assert [ sink['name'] for sink in config['sinks'] ] == [ 'webhook-1', 'file', 'webhook-2', 'backup' ]
+    path.write_text(path.read_text().replace('name: backup', 'name: file'))
+    err, msg, _ = cnf.load_config(str(path), supervisor=False)
+    assert err == 'error'
@@ -0,0 +1,37 @@
+"""
+Availability of the meters, with and without rtlamr -unique.
+"""
+
+import helpers.staleness as stale
+
+
+def test_missed_readings():
+    tracker = stale.StalenessTracker({ '1': {}, '2': { 'transmit_interval': 60 } }, now=0)
+    assert tracker.expire(now=89) == []
+    assert tracker.expire(now=90) == [ '1' ]
+    assert tracker.expire(now=180) == [ '2' ]
+    assert tracker.all_unavailable()
+    assert tracker.on_reading('1', now=200)
+    assert not tracker.all_unavailable()
+
+def test_unique_same_value_stays_available():
+    tracker = stale.StalenessTracker({ '1': {}, '2': { 'transmit_interval': 60 } }, unique=True, now=0)
+    # Silent for hours: the value did not change
+    assert tracker.expire(now=3 * 3600 - 1) == []
+    assert not tracker.all_unavailable()
+    assert sorted(tracker.expire(now=3 * 3600)) == [ '1', '2' ]
+
+def test_unique_learned_interval():
+    tracker = stale.StalenessTracker({ '1': {} }, unique=True, now=0)
+    for hour in range(1, 6):
+        tracker.on_reading('1', now=hour * 2 * 3600)
+    # Read every 2 hours: that is its interval now
+    assert tracker.stats(now=10 * 3600)['1']['interval'] == 2 * 3600
+    assert tracker.expire(now=10 * 3600 + 3 * 2 * 3600 - 1) == []
+
+def test_unique_changed_on_reload():
+    tracker = stale.StalenessTracker({ '1': {} }, now=0)
+    assert tracker.interval('1') == 30
+    tracker.unique = True
+    tracker.update_meters({ '1': {} })
+    assert tracker.interval('1') == 3600
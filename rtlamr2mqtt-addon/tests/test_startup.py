@@ -0,0 +1,26 @@
+"""
+Startup phases running in the background.
+"""
+
+import threading
+from time import monotonic
+import helpers.startup as su
+
+
+def test_result_does_not_wait_past_timeout(logger):
+    startup = su.Startup(logger, log_level=0)
+    release = threading.Event()
+    startup.run('receiver', lambda: release.wait(10) and ('rtltcp', 'rtlamr'), default=(None, None))
+    start = monotonic()
+    # Stuck warm-up: no result yet
+    assert startup.result('receiver', timeout=0.2) is None
+    assert monotonic() - start < 1
+    assert startup.running('receiver')
+    release.set()
+    assert startup.result('receiver', timeout=5) == ('rtltcp', 'rtlamr')
+    assert 'receiver' in startup.stats()['phases']
+
+def test_failed_phase_default(logger):
+    startup = su.Startup(logger, log_level=0)
+    startup.run('receiver', lambda: 1 / 0, default=(None, None))
+    assert startup.result('receiver', timeout=5) == (None, None)
@@ -0,0 +1,122 @@
+"""
+RTL-SDR devices found in a fake sysfs tree, and the hotplug monitor on top of it.
+"""
+
+import sys
+import subprocess
+import helpers.usb_utils as usbutil
+import helpers.hotplug as hotplug
+import rtlamr2mqtt as app
+
+
+def monitor(sysfs, logger):
+    return hotplug.UsbHotplugMonitor(logger, sysfs_root=str(sysfs.root), use_netlink=False, log_level=0)
+
+
+def test_finds_rtl_sdr_devices(sysfs):
+    sysfs.plug('1-1.2', 12)
+    sysfs.plug('1-1.1', 9, usb_id='0bda:2832', serial=None)
+    # Not a RTL-SDR
+    sysfs.plug('1-1.3', 5, usb_id='046d:c52b')
+    # Being removed: no ids left
+    (sysfs.root / '1-1.4').mkdir()
+    assert usbutil.find_rtl_sdr_devices(str(sysfs.root)) == [ '001:009', '001:012' ]
+    devices = usbutil.list_rtl_sdr_devices(str(sysfs.root))
+    assert devices[1] == { 'id': '001:012', 'usb_id': '0bda:2838', 'port': '1-1.2', 'serial': '00000001' }
+    assert devices[0]['serial'] is None
+
+def test_no_devices(sysfs):
+    assert usbutil.find_rtl_sdr_devices(str(sysfs.root)) == []
+
+def test_replugged_found_by_serial(sysfs, logger):
+    sysfs.plug('1-1.2', 12, serial='00000102')
+    sysfs.plug('1-1.3', 13, serial='00000103')
+    usb_monitor = monitor(sysfs, logger)
+    assert usb_monitor.resolve('001:012') == '001:012'
+    sysfs.unplug('1-1.2')
+    usb_monitor.rescan()
+    assert not usb_monitor.present('001:012')
+    # Plugged back in another port, with a new device number
+    sysfs.plug('1-1.4', 15, serial='00000102')
+    assert usb_monitor.rescan() == ([ '001:015' ], [])
+    assert usb_monitor.resolve('001:012') == '001:015'
+    assert usb_monitor.get_events() == [ ('remove', '001:012'), ('add', '001:015') ]
+
+def test_replugged_found_by_port(sysfs, logger):
+    # Same default serial number on both dongles
+    sysfs.plug('1-1.2', 12)
+    sysfs.plug('1-1.3', 13)
+    usb_monitor = monitor(sysfs, logger)
+    assert usb_monitor.present('001:013')
+    sysfs.unplug('1-1.3')
+    sysfs.plug('1-1.3', 16)
+    usb_monitor.rescan()
+    assert usb_monitor.resolve('001:013') == '001:016'
+    # Not the other dongle
+    sysfs.unplug('1-1.3')
+    usb_monitor.rescan()
+    assert usb_monitor.resolve('001:013') is None
+
+def test_configured_by_serial(sysfs, logger):
+    sysfs.plug('1-1.2', 12, serial='00000102')
+    usb_monitor = monitor(sysfs, logger)
+    assert usb_monitor.resolve('serial:00000102') == '001:012'
+    assert not usb_monitor.present('serial:00000999')
+
+def test_any_device(sysfs, logger):
+    usb_monitor = monitor(sysfs, logger)
+    assert not usb_monitor.present('0')
+    sysfs.plug('1-1.2', 12)
+    usb_monitor.rescan()
+    assert usb_monitor.resolve('0') == '001:012'
+
+def test_unknown_id_plugged_later(sysfs, logger):
+    usb_monitor = monitor(sysfs, logger)
+    assert not usb_monitor.present('001:012')
+    sysfs.plug('1-1.2', 12)
+    usb_monitor.rescan()
+    assert usb_monitor.present('001:012')
+
+
+class RunningProcess:
+    returncode = None
+
+    def poll(self):
+        return None
+
+
+def dead_process():
+    process = subprocess.Popen([ sys.executable, '-c', 'pass' ], stdout=subprocess.PIPE)
+    process.wait()
+    return process
+
+def test_rtltcp_died_with_device_unplugged(sysfs, logger, monkeypatch):
+    started = []
+    monkeypatch.setattr(app, 'start_rtltcp', lambda config, usb_monitor: started.append(usb_monitor.resolve('001:012')) or RunningProcess())
+    config = { 'general': { 'device_id': '001:012' } }
+    sysfs.plug('1-1.2', 12, serial='00000102')
+    usb_monitor = monitor(sysfs, logger)
+    assert usb_monitor.present('001:012')
+    # rtl_tcp dies as the device is unplugged, before the monitor scans again
+    sysfs.unplug('1-1.2')
+    rtltcp, rtlamr, state = app.keep_rtltcp_running(config, dead_process(), None, usb_monitor)
+    assert (rtltcp, rtlamr, state) == (None, None, 'unplugged')
+    assert started == []
+    # Still waiting
+    assert app.keep_rtltcp_running(config, None, None, usb_monitor)[2] == 'unplugged'
+    # Plugged back in, with a new device number
+    sysfs.plug('1-1.2', 14, serial='00000102')
+    usb_monitor.rescan()
+    rtltcp, _, state = app.keep_rtltcp_running(config, None, None, usb_monitor)
+    assert state == 'running' and rtltcp is not None
+    assert started == [ '001:014' ]
+
+def test_rtltcp_died_with_device_plugged(sysfs, logger, monkeypatch):
+    started = []
+    monkeypatch.setattr(app, 'start_rtltcp', lambda config, usb_monitor: started.append(True) or None)
+    sysfs.plug('1-1.2', 12)
+    usb_monitor = monitor(sysfs, logger)
+    # Restarted right away, it fails
+    _, _, state = app.keep_rtltcp_running({ 'general': { 'device_id': '0' } }, dead_process(), None, usb_monitor)
+    assert state == 'failed'
+    assert started == [ True ]